@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks the attachment transfers of WebClient against a local server.
+
+Usage: python bench/attachment_transfer.py [size in MB ...]
+
+An attachment of each size (default 1, 16 and 64 MB) is uploaded then
+downloaded through a local stand-in of the trac attachment pages. The
+streaming transfers are compared with buffered transfers, which hold the
+whole attachment in memory as the plugin would without streaming. Each
+mode runs in a forked child process so that the reported peak RSS is the
+one of the client only.
+"""
+import os, sys, time, shutil, tempfile
+from StringIO import StringIO
+from wikisync.tests.server import AttachmentHandler, FORM_TOKEN
+from wikisync.util import WebClient, MultipartStream, file_digest
+
+SIZES = (1, 16, 64)
+
+def create_file(directory, size):
+    path = os.path.join(directory, "attachment-%sMB.bin" % size)
+    block = os.urandom(1048576)
+    with open(path, "wb") as f:
+        for i in xrange(size):
+            f.write(block)
+    return path
+
+def streaming(wc, path, filename):
+    wc.upload_attachment("WikiStart", filename, path)
+    target = open(os.devnull, "wb")
+    try:
+        return wc.download_attachment("WikiStart", filename, target)
+    finally:
+        target.close()
+
+def buffered(wc, path, filename):
+    body = MultipartStream({"__FORM_TOKEN": FORM_TOKEN},
+        [("attachment", filename, path)])
+    data = body.read()
+    f = wc.open("attachment/wiki/WikiStart/", StringIO(data), "POST", {
+        "Content-Type": body.content_type,
+        "Content-Length": str(len(data)),
+    })
+    f.read()
+    f.close()
+    del data
+    f = wc.open("raw-attachment/wiki/WikiStart/%s" % filename,
+        headers={"Cache-Control": "no-store"})
+    data = f.read()
+    f.close()
+    return file_digest(StringIO(data))
+
+def run_forked(transfer, url, path):
+    """Transfers the file in a child process, returns (seconds, peak rss
+    KB)"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        wc = WebClient(url)
+        start = time.time()
+        size, digest = transfer(wc, path, os.path.basename(path))
+        elapsed = time.time() - start
+        wc.close()
+        assert size == os.path.getsize(path), "Incomplete transfer"
+        os.write(w, repr(elapsed))
+        os._exit(0)
+    os.close(w)
+    data = ""
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    pid, status, rusage = os.wait4(pid, 0)
+    assert status == 0, "Transfer failed"
+    return float(data), rusage.ru_maxrss
+
+def main(sizes):
+    directory = tempfile.mkdtemp(prefix="wikisync-bench-")
+    root = os.path.join(directory, "remote")
+    os.mkdir(root)
+    server = AttachmentHandler.create_server(root).start()
+    try:
+        print "%8s %10s %10s %14s" % ("size", "mode", "MB/s", "peak RSS KB")
+        for size in sizes:
+            path = create_file(directory, size)
+            for label, transfer in (("buffered", buffered),
+                ("streaming", streaming)):
+                elapsed, rss = run_forked(transfer, server.url, path)
+                # uploaded and downloaded
+                print "%6dMB %10s %10.2f %14d" % (size, label,
+                    size * 2 / elapsed, rss)
+            os.remove(path)
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks the HTML version link parsers against the test fixtures.
+
+Usage: python bench/parse_html.py [repeat]
+
+Every fixture is parsed 'repeat' times (default 50) by the streaming parser
+and by the previous genshi based parser. Each parser runs in a forked child
+process so that the reported peak RSS is not shared between them.
+"""
+import os, sys, time, resource, urllib
+from StringIO import StringIO
+from urlparse import urlparse, parse_qs
+from genshi.input import HTMLParser
+from pkg_resources import resource_filename
+from wikisync.util import safe_str, safe_unicode, parse_recent_changes, \
+    parse_timeline, parse_wiki
+
+FIXTURES = (
+    ("RecentChanges.edgewall.html", "recent_changes", "/wiki"),
+    ("RecentChanges.default.html", "recent_changes", "/trac/wiki"),
+    ("Timeline.edgewall.html", "timeline", "/wiki"),
+    ("Timeline.default.html", "timeline", "/trac/wiki"),
+    ("WikiStart.edgewall.html", "wiki", "/wiki"),
+    ("WikiStart.default.html", "wiki", "/trac/wiki"),
+)
+
+STREAMING = {
+    "recent_changes": parse_recent_changes,
+    "timeline": parse_timeline,
+    "wiki": parse_wiki,
+}
+
+def legacy_parse(source, check_data, path_prefix):
+    """The genshi based parser, prior to the streaming parser"""
+    f = StringIO(source)
+    parser = HTMLParser(f)
+    counter = 0
+    found_level = -1
+    map = {}
+    path_prefix = path_prefix or "/"
+    if not path_prefix.endswith("/"):
+        path_prefix = "%s/" % path_prefix
+    path_prefix_len = len(path_prefix)
+    for kind, data, pos in parser:
+        if kind == "START":
+            counter += 1
+            if found_level != -1:
+                href = data[1].get("href", None)
+                if href and href.startswith(path_prefix):
+                    url = urlparse(href)
+                    path = safe_unicode(
+                        urllib.unquote(
+                            safe_str(url.path[path_prefix_len:])
+                        ).decode("utf-8")
+                    )
+                    if path in map:
+                        item = map[path]
+                    else:
+                        item = map[path] = {
+                            "name":path,
+                            "remote_version":1
+                        }
+                    if url.query:
+                        qs = parse_qs(url.query)
+                        version = "version" in qs and int(qs["version"][0]) or 0
+                        if item["remote_version"] < version:
+                            item["remote_version"] = version
+            elif check_data(data):
+               found_level = counter
+        elif kind == "END":
+            counter -= 1
+            if found_level and counter < found_level:
+                break
+    return map.values()
+
+LEGACY = {
+    "recent_changes": lambda source, prefix: legacy_parse(source,
+        lambda data: data[1].get("id", None) == "wikipage", prefix),
+    "timeline": lambda source, prefix: legacy_parse(source,
+        lambda data: data[1].get("id", None) == "content", prefix),
+    "wiki": lambda source, prefix: legacy_parse(source,
+        lambda data: data[1].get("class", None) == "trac-modifiedby", prefix),
+}
+
+def load_fixtures():
+    fixtures = []
+    for name, kind, prefix in FIXTURES:
+        with open(resource_filename("wikisync.tests", name), "rb") as f:
+            fixtures.append((name, kind, prefix, f.read()))
+    return fixtures
+
+def run(parsers, fixtures, repeat):
+    """Returns a list of (name, bytes, seconds, results)"""
+    stats = []
+    for name, kind, prefix, source in fixtures:
+        parse = parsers[kind]
+        start = time.time()
+        for i in xrange(repeat):
+            results = parse(StringIO(source), prefix) \
+                if parsers is STREAMING else parse(source, prefix)
+        stats.append((name, len(source) * repeat, time.time() - start,
+            len(results)))
+    return stats
+
+def run_forked(parsers, fixtures, repeat):
+    """Runs the parsers in a child process, returns (stats, peak rss KB)"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        stats = run(parsers, fixtures, repeat)
+        os.write(w, repr(stats))
+        os._exit(0)
+    os.close(w)
+    data = ""
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    pid, status, rusage = os.wait4(pid, 0)
+    return eval(data), rusage.ru_maxrss
+
+def main(repeat):
+    fixtures = load_fixtures()
+    print "%-28s %10s %10s %8s %8s" % ("fixture", "parser", "MB/s",
+        "pages", "speedup")
+    totals = {}
+    for label, parsers in (("legacy", LEGACY), ("streaming", STREAMING)):
+        totals[label] = run_forked(parsers, fixtures, repeat)
+    legacy = dict([(s[0], s) for s in totals["legacy"][0]])
+    for label in ("legacy", "streaming"):
+        stats, rss = totals[label]
+        for name, size, elapsed, count in stats:
+            print "%-28s %10s %10.2f %8d %7.1fx" % (name, label,
+                size / elapsed / 1048576, count, legacy[name][2] / elapsed)
+        size = sum([s[1] for s in stats])
+        elapsed = sum([s[2] for s in stats])
+        print "%-28s %10s %10.2f %8s %7s  peak RSS %d KB" % ("TOTAL", label,
+            size / elapsed / 1048576, "", "", rss)
+
+if __name__ == "__main__":
+    main(len(sys.argv) > 1 and int(sys.argv[1]) or 50)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks RegExpFilter against the previous implementation.
+
+Usage: python bench/regexp_filter.py [patterns] [names]
+
+Builds an ignore list of 'patterns' expressions (default 300), mostly
+literal names and prefixes such as 'Trac*' with a few general regular
+expressions, and matches 'names' page names (default 50000) against it.
+"""
+import re, sys, time
+from wikisync.util import RegExpFilter, get_regexp_filter
+
+class LegacyRegExpFilter(object):
+    """The RegExpFilter prior to the prefix index"""
+
+    def __init__(self, filters):
+        if isinstance(filters, basestring):
+            filters = filters.split()
+        self._regexes = filters and [re.compile(f) for f in filters] or []
+
+    def matches(self, name):
+        for r in self._regexes:
+            if r.match(name):
+                return True
+        return False
+
+def ignorelist(size):
+    patterns = []
+    for i in xrange(size):
+        kind = i % 10
+        if kind < 5:
+            patterns.append("Ignored%sPage" % i)
+        elif kind < 8:
+            patterns.append("Prefix%s*" % i)
+        elif kind < 9:
+            patterns.append("Section%s/.*" % i)
+        else:
+            patterns.append("(?!^Keep%s$)Regex%s[0-9]+" % (i, i))
+    return "\n".join(patterns)
+
+def page_names(size, patterns):
+    names = []
+    for i in xrange(size):
+        j = i % patterns
+        kind = i % 7
+        if kind == 0:
+            names.append("Ignored%sPage" % j)
+        elif kind == 1:
+            names.append("Prefix%sChild" % j)
+        elif kind == 2:
+            names.append("Section%s/Child%s" % (j, i))
+        elif kind == 3:
+            names.append("Regex%s%s" % (j, i))
+        else:
+            names.append("Regular/Page%s" % i)
+    return names
+
+def measure(label, factory, filters, names, base=None):
+    start = time.time()
+    f = factory(filters)
+    build = time.time() - start
+    start = time.time()
+    results = [f.matches(name) for name in names]
+    elapsed = time.time() - start
+    print "%-10s build %8.2f ms  match %8.2f ms  %10.0f names/s %8s" % (
+        label, build * 1000, elapsed * 1000, len(names) / elapsed,
+        base and "%.1fx" % (base / elapsed) or "")
+    return results, elapsed
+
+def main(patterns, size):
+    filters = ignorelist(patterns)
+    names = page_names(size, patterns)
+    print "%s patterns, %s names" % (patterns, size)
+    expected, base = measure("legacy", LegacyRegExpFilter, filters, names)
+    results, elapsed = measure("indexed", RegExpFilter, filters, names, base)
+    assert results == expected, "results differ"
+    print "%s names ignored" % sum(results)
+    get_regexp_filter(filters)
+    start = time.time()
+    for i in xrange(1000):
+        get_regexp_filter(filters)
+    print "cached lookup %.2f us" % ((time.time() - start) * 1000)
+
+if __name__ == "__main__":
+    main(len(sys.argv) > 1 and int(sys.argv[1]) or 300,
+        len(sys.argv) > 2 and int(sys.argv[2]) or 50000)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks end-to-end synchronizations against a local fake trac server.
+
+Usage: python bench/sync_e2e.py [options] [pages ...]
+
+For each number of pages (default 100 and 1000), the remote wikis are
+created on a local stand-in of a trac server, see TracHandler, and an
+empty EnvironmentStub is synchronized with it: a full refresh, a pull of
+every page, a push of every page edited locally, a batch refresh and an
+incremental refresh. The synchronizations run in a forked child process so
+that the reported peak RSS is the one of the client only, and the requests
+are counted by the server.
+
+The server latency, bandwidth and authentication, and the transport of the
+client, the html pages or XML-RPC, are set with the options, see --help. With --check, the command fails when a phase performs more
+requests than its budget in BUDGETS.
+"""
+import os, sys, time, resource, tempfile, shutil
+from optparse import OptionParser
+from wikisync.batch import BatchSync, refresh_remote
+from wikisync.connection import ConnectionPool
+from wikisync.plugin import WikiSyncEnvironment
+from wikisync.rpc import get_transport
+from wikisync.tests.server import TracHandler
+from wikisync.util import WebClient
+from trac.test import EnvironmentStub
+from trac.wiki.model import WikiPage
+
+SIZES = (100, 1000)
+
+# maximum requests of a phase as (per page, fixed), the fixed part covers
+# the login, the 401 challenges and the edit form read by the first push
+BUDGETS = {
+    "full refresh": (0, 3),
+    "pull": (2, 0),
+    "push": (3, 2),
+    "batch refresh": (0.5, 1),
+    "incremental refresh": (0, 1),
+}
+
+def synchronize(url, options, report):
+    """Runs the phases, calls report(phase, seconds, pages) after each"""
+    env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+    env.path = tempfile.mkdtemp(prefix="wikisync-bench-")
+    pool = ConnectionPool()
+    wc = get_transport(WebClient(url, options.auth and "admin",
+        options.auth and "admin", pool=pool), options.transport)
+    try:
+        WikiSyncEnvironment(env).upgrade_environment(env.get_db_cnx())
+        batch = BatchSync(env, wc, options.concurrency)
+        def run(phase, fn):
+            start = time.time()
+            pages = fn()
+            report(phase, time.time() - start, pages)
+        def full_refresh():
+            refresh_remote(env, wc, full=True)
+            return len(batch.dao.query())
+        def sync(action):
+            names = [item.name for item in batch.dao.query()]
+            for result in batch.run([(name, action) for name in names],
+                "bench", "127.0.0.1"):
+                if not result.ok:
+                    raise RuntimeError("Cannot %s '%s': %s" % \
+                        (action, result.name, result.error))
+            return len(names)
+        def push():
+            for item in batch.dao.query():
+                page = WikiPage(env, item.name)
+                page.text += "Edited locally.\n"
+                page.save("bench", "", "127.0.0.1")
+            batch.dao.repair_local_versions()
+            return sync("push")
+        def incremental_refresh():
+            refresh_remote(env, wc)
+            return len(batch.dao.query())
+        run("full refresh", full_refresh)
+        run("pull", lambda: sync("pull"))
+        run("push", push)
+        run("batch refresh", lambda: sync("refresh"))
+        run("incremental refresh", incremental_refresh)
+    finally:
+        wc.close()
+        pool.clear()
+        shutil.rmtree(env.path)
+
+def run_forked(url, options):
+    """Synchronizes in a child process, yields a (phase, seconds, pages,
+    peak rss KB) tuple as each phase completes"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        def report(phase, seconds, pages):
+            os.write(w, "%s\t%r\t%s\t%s\n" % (phase, seconds, pages,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        try:
+            synchronize(url, options, report)
+        except Exception, e:
+            sys.stderr.write("%s\n" % e)
+            os._exit(1)
+        os._exit(0)
+    os.close(w)
+    f = os.fdopen(r)
+    try:
+        for line in iter(f.readline, ""):
+            phase, seconds, pages, rss = line.rstrip("\n").split("\t")
+            yield phase, float(seconds), int(pages), int(rss)
+    finally:
+        f.close()
+        pid, status = os.waitpid(pid, 0)
+        assert status == 0, "Synchronization failed"
+
+def main():
+    parser = OptionParser(usage="%prog [options] [pages ...]")
+    parser.add_option("--page-size", type="int", default=2048,
+        help="size in bytes of the remote wiki text (default 2048)")
+    parser.add_option("--latency", type="float", default=5,
+        help="milliseconds before each response (default 5)")
+    parser.add_option("--bandwidth", type="int", default=0,
+        help="KB per second of each response, 0 for unlimited (default)")
+    parser.add_option("--auth", choices=("basic", "digest"),
+        help="authentication required by the login page")
+    parser.add_option("--transport", choices=("html", "xmlrpc"),
+        default="html", help="transport of the client (default html)")
+    parser.add_option("--concurrency", type="int", default=4,
+        help="number of concurrent transfers (default 4)")
+    parser.add_option("--check", action="store_true", default=False,
+        help="fails when a phase exceeds its requests budget")
+    options, args = parser.parse_args()
+    sizes = [int(arg) for arg in args] or SIZES
+    print "latency %sms, bandwidth %s, auth %s, transport %s, " \
+        "concurrency %s" % (options.latency, options.bandwidth and \
+            "%sKB/s" % options.bandwidth or "unlimited", 
+            options.auth or "none", options.transport, options.concurrency)
+    print "%6s %20s %10s %10s %14s %14s" % ("pages", "phase", "pages/s",
+        "seconds", "requests/page", "peak RSS KB")
+    exceeded = []
+    for size in sizes:
+        server = TracHandler.create_server(size, options.page_size,
+            options.auth, latency=options.latency / 1000.0,
+            bandwidth=options.bandwidth * 1024,
+            rpc=options.transport == "xmlrpc").start()
+        try:
+            requests = 0
+            for phase, seconds, pages, rss in run_forked(server.url, options):
+                count = server.requests - requests
+                requests = server.requests
+                print "%6d %20s %10.1f %10.2f %14.2f %14d" % (size, phase,
+                    pages / seconds, seconds, float(count) / max(pages, 1),
+                    rss)
+                per_page, fixed = BUDGETS[phase]
+                if count > per_page * pages + fixed:
+                    exceeded.append("%s pages %s: %s requests" % \
+                        (size, phase, count))
+        finally:
+            server.stop()
+    if options.check and exceeded:
+        print "Requests budget exceeded:\n  %s" % "\n  ".join(exceeded)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
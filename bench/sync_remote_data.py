@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks WikiSyncDao.sync_remote_data against growing remote datasets.
+
+Usage: python bench/sync_remote_data.py [size ...]
+
+Each run starts from an EnvironmentStub populated with 'size' local wiki
+pages, half of which already have a wikisync state, and reconciles a remote
+dataset of 'size' pages that partially overlaps the local pages. The legacy
+row-by-row reconciliation is measured for comparison on the smaller sizes.
+"""
+import sys, time
+from wikisync.plugin import WikiSyncEnvironment
+from wikisync.model import WikiSyncDao
+from wikisync.util import RegExpFilter
+from trac.test import EnvironmentStub
+
+SIZES = (100, 1000, 5000, 10000, 50000)
+
+LEGACY_MAX_SIZE = 5000
+
+def setup_env(size):
+    env = EnvironmentStub()
+    WikiSyncEnvironment(env).upgrade_environment(env.get_db_cnx())
+    @env.with_transaction()
+    def do_populate(db):
+        cursor = db.cursor()
+        cursor.executemany("""
+            INSERT INTO wiki(name, version, time, author, ipnr, text)
+            VALUES (%s, %s, 0, 'bench', '127.0.0.1', '')
+        """, [("LocalPage%s" % i, 1 + i % 3) for i in xrange(size)])
+        cursor.executemany("""
+            INSERT INTO wikisync(name, remote_version, local_version)
+            VALUES (%s, %s, %s)
+        """, [("LocalPage%s" % i, 1, 1 + i % 3) for i in xrange(0, size, 2)])
+    return env
+
+def remote_dataset(size):
+    # a quarter of the remote pages are new, the rest overlaps local pages
+    offset = size / 4
+    return [
+        {"name": "LocalPage%s" % (i - offset), "remote_version": 2} \
+            if i >= offset else \
+        {"name": "RemotePage%s" % i, "remote_version": 1}
+        for i in xrange(size)
+    ]
+
+def legacy_sync_remote_data(dao, dataset, ignore_filter=None):
+    sync_time = time.time()
+    processed = set()
+    for data in dataset:
+        name = data.get("name", None)
+        item = dao.find(name)
+        if not item:
+            if ignore_filter and ignore_filter.matches(name):
+                data["ignore"] = 1
+            dao.create(dao.factory(sync_time=sync_time, **data))
+        else:
+            if not item.sync_time:
+                if ignore_filter and ignore_filter.matches(item.name):
+                    item = item.replace(ignore=1)
+            dao.update(item.replace(sync_time=sync_time, **data))
+        processed.add(name)
+    db = dao.env.get_read_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT name FROM wikisync")
+    for name in set([row[0] for row in cursor.fetchall()]) - processed:
+        item = dao.find(name)
+        if not item.local_version:
+            dao.delete(item)
+        else:
+            dao.update(item.replace(remote_version=None,
+                sync_remote_version=None, sync_time=sync_time))
+
+def measure(size, fn):
+    env = setup_env(size)
+    dao = WikiSyncDao(env)
+    dataset = remote_dataset(size)
+    ignore_filter = RegExpFilter("Remote.*5$")
+    start = time.time()
+    fn(dao, dataset, ignore_filter)
+    elapsed = time.time() - start
+    env.reset_db()
+    return elapsed
+
+def main(sizes):
+    print "%10s %12s %12s %14s" % ("pages", "bulk (s)", "legacy (s)",
+        "bulk pages/s")
+    for size in sizes:
+        bulk = measure(size,
+            lambda dao, dataset, f: dao.sync_remote_data(dataset, f))
+        legacy = size <= LEGACY_MAX_SIZE and "%12.3f" % measure(size,
+            legacy_sync_remote_data) or "%12s" % "-"
+        print "%10d %12.3f %s %14d" % (size, bulk, legacy, size / bulk)
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -1,2 +1,3 @@
 # -*- coding: utf-8 -*-
-from plugin import *
\ No newline at end of file
+from plugin import *
+from admin import *
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import getopt, re, time
+from fnmatch import fnmatchcase
+from wikisync.model import WikiSyncDao, WIKISYNC_STATUSES
+from wikisync.jobs import JobQueue, JobRunner
+from wikisync.plugin import WikiSyncMixin
+from wikisync.util import safe_int, safe_unicode, jsonify
+from trac.core import *
+from trac.admin.api import IAdminCommandProvider, AdminCommandError
+from trac.util.text import printout, print_table
+
+__all__ = ["WikiSyncAdminCommand"]
+
+# author and address recorded in pulled wiki pages, as per the
+# trac-admin wiki commands
+ADMIN_AUTHOR = "trac"
+
+ADMIN_ADDR = "127.0.0.1"
+
+# actions performed by 'wikisync sync' by status, see wikisync.js
+SYNC_ACTIONS = {
+    "unknown": "refresh",
+    "new": "push",
+    "modified": "push",
+    "missing": "pull",
+    "outdated": "pull",
+}
+
+# actions of the conflict resolutions, see the '--resolve' option
+CONFLICT_ACTIONS = {
+    "modified": "push",
+    "outdated": "pull",
+}
+
+# status filter of each command when '--status' is not set
+DEFAULT_STATUSES = {
+    "refresh": tuple([s for s in WIKISYNC_STATUSES if s != "ignored"]),
+    "pull": ("missing", "outdated"),
+    "push": ("new", "modified"),
+    "sync": tuple(sorted(SYNC_ACTIONS)),
+    # only runs the queued jobs
+    "resume": (),
+}
+
+_LONG_OPTIONS = ["status=", "concurrency=", "time-limit=", "resolve=",
+    "full", "json"]
+
+_ARGS = "[--status=<status,...>] [--concurrency=<n>] " \
+    "[--time-limit=<seconds>] [--json] [glob...]"
+
+_HELP = """
+
+Only pages with names matching one of the glob patterns are synchronized,
+e.g. 'Project*'.
+
+--status: comma separated status of the pages to synchronize, one of
+%s (default %%s).
+
+--concurrency: maximum number of pages transferred concurrently with the
+remote server (default from the '[wikisync] concurrency' option).
+
+--time-limit: no more pages are synchronized after this number of seconds,
+the remaining pages are reported as skipped.
+
+--json: prints the progress as a json object per line, for use in scripts.
+""" % ", ".join(WIKISYNC_STATUSES)
+
+class WikiSyncAdminCommand(Component, WikiSyncMixin):
+    """Provides the 'wikisync' commands of trac-admin, synchronizing
+    pages without a browser, e.g. from a scheduled job."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider
+    def get_admin_commands(self):
+        yield ("wikisync refresh", "[--full] " + _ARGS,
+            "Check the remote server for updates"
+            "\n\nWithout glob or status filters, the remote updates of all "
+            "pages are read from the remote timeline, or from the complete "
+            "remote page index with --full. Otherwise the matching pages "
+            "are checked one by one." + _HELP % "all but ignored",
+            self._complete_page, self._do_refresh)
+        yield ("wikisync pull", _ARGS,
+            "Copy pages from the remote server" + \
+            _HELP % ", ".join(DEFAULT_STATUSES["pull"]),
+            self._complete_page, self._do_pull)
+        yield ("wikisync push", _ARGS,
+            "Update pages to the remote server" + \
+            _HELP % ", ".join(DEFAULT_STATUSES["push"]),
+            self._complete_page, self._do_push)
+        yield ("wikisync sync", "[--full] [--resolve=<modified|outdated>] " + \
+            _ARGS,
+            "Check for updates and synchronize pages"
+            "\n\nThe remote updates are read first, from the complete "
+            "remote page index with --full, pages of unknown status "
+            "are then checked one by one. Modified and new pages are "
+            "updated to the remote server, outdated and missing pages are "
+            "copied from the remote server."
+            "\n\n--resolve: synchronizes conflict pages as 'modified' "
+            "(updated to the remote server) or as 'outdated' (copied from "
+            "the remote server), conflict pages are skipped otherwise." + \
+            _HELP % ", ".join(DEFAULT_STATUSES["sync"]),
+            self._complete_page, self._do_sync)
+        yield ("wikisync resume", "[--concurrency=<n>] "
+            "[--time-limit=<seconds>] [--json]",
+            "Run the queued synchronization jobs"
+            "\n\nSynchronizes the pages queued from the Wiki Sync page, "
+            "or left by an interrupted command. Transfers completed before "
+            "the interruption are not repeated.",
+            None, self._do_resume)
+        yield ("wikisync queue", "[--json]",
+            "Show the queued synchronization jobs",
+            None, self._do_queue)
+
+    def _complete_page(self, args):
+        return [item.name for item in
+            WikiSyncDao(self.env).query(prefix=args and args[-1] or None)]
+
+    def _do_refresh(self, *args):
+        self._run("refresh", args)
+
+    def _do_pull(self, *args):
+        self._run("pull", args)
+
+    def _do_push(self, *args):
+        self._run("push", args)
+
+    def _do_sync(self, *args):
+        self._run("sync", args)
+
+    def _do_resume(self, *args):
+        self._run("resume", args)
+
+    def _do_queue(self, *args):
+        queue = JobQueue(self.env)
+        status = queue.status()
+        if "--json" in args:
+            printout(jsonify(status))
+            return
+        print_table([(job.id, job.name, job.action, job.state, job.attempts,
+            job.error or "") for job in queue.list(("pending", "running",
+            "failed"))], ["Id", "Page", "Action", "State", "Attempts",
+            "Error"])
+        printout("%(pending)s pending, %(running)s running, %(done)s done, "
+            "%(failed)s failed" % status + ", %.1f pages/s" % \
+            status["throughput"])
+
+    def _parse_args(self, command, args):
+        try:
+            opts, globs = getopt.gnu_getopt(args, "", _LONG_OPTIONS)
+        except getopt.GetoptError, e:
+            raise AdminCommandError(safe_unicode(e), show_usage=True)
+        options = {
+            "status": None,
+            "concurrency": self._get_concurrency(),
+            "time_limit": None,
+            "resolve": None,
+            "full": False,
+            "json": False,
+        }
+        for key, value in opts:
+            key = key[2:].replace("-", "_")
+            if key in ("concurrency", "time_limit"):
+                value = safe_int(value)
+                if value <= 0:
+                    raise AdminCommandError("Invalid --%s value" % \
+                        key.replace("_", "-"), show_usage=True)
+            elif key == "status":
+                value = [s.strip() for s in value.split(",") if s.strip()]
+                for status in value:
+                    if status not in WIKISYNC_STATUSES:
+                        raise AdminCommandError("Unsupported status '%s'" % \
+                            status, show_usage=True)
+            elif key == "resolve":
+                if command != "sync" or value not in CONFLICT_ACTIONS:
+                    raise AdminCommandError("Unsupported resolution '%s'" % \
+                        value, show_usage=True)
+            elif key == "full":
+                if command not in ("refresh", "sync"):
+                    raise AdminCommandError("Unsupported option --full",
+                        show_usage=True)
+                value = True
+            else:
+                value = True
+            options[key] = value
+        if command == "resume" and globs:
+            raise AdminCommandError("Unsupported page filter", 
+                show_usage=True)
+        # filters select the pages refreshed one by one
+        options["explicit"] = bool(globs) or options["status"] is not None
+        statuses = options["status"]
+        if statuses is None:
+            statuses = list(DEFAULT_STATUSES[command])
+            if options["resolve"]:
+                statuses.append("conflict")
+        elif command == "resume":
+            raise AdminCommandError("Unsupported option --status",
+                show_usage=True)
+        elif command == "sync":
+            for status in statuses:
+                if status == "conflict" and not options["resolve"]:
+                    raise AdminCommandError("Conflict pages require the "
+                        "--resolve option", show_usage=True)
+                if status not in SYNC_ACTIONS and status != "conflict":
+                    raise AdminCommandError("Pages of '%s' status cannot "
+                        "be synchronized" % status, show_usage=True)
+        options["status"] = statuses
+        return options, globs
+
+    def _run(self, command, args):
+        options, globs = self._parse_args(command, args)
+        progress = SyncProgress(options["json"])
+        deadline = options["time_limit"] and \
+            progress.started + options["time_limit"]
+        dao = WikiSyncDao(self.env)
+        wc = self._get_web_client()
+        try:
+            if command == "sync" or \
+                (command == "refresh" and not options["explicit"]):
+                progress.scan(self._refresh(wc, full=options["full"]))
+                if command == "refresh":
+                    progress.finish()
+                    return
+            elif command != "resume":
+                dao.sync_wiki_data()
+            queue = JobQueue(self.env)
+            runner = JobRunner(self.env, wc, options["concurrency"], self.log)
+            statuses = options["status"]
+            if command == "sync":
+                # pages of unknown status are checked first, and synchronized
+                # according to their refreshed status
+                phases = [[s for s in statuses if s == "unknown"],
+                    [s for s in statuses if s != "unknown"]]
+            else:
+                phases = [statuses]
+            for phase in phases:
+                if deadline and time.time() >= deadline:
+                    break
+                # the pages are queued first, the jobs left by an 
+                # interrupted run are resumed along
+                queue.enqueue([(item.name, 
+                    self._action(command, item, options))
+                    for item in self._select(dao, phase, globs)],
+                    ADMIN_AUTHOR, ADMIN_ADDR)
+                # the failed pages are reported, and retried by the next
+                # command
+                runner.run(deadline, progress.result, retry=False)
+            if deadline and time.time() >= deadline:
+                progress.skip([(job.name, job.action) 
+                    for job in queue.list()])
+        finally:
+            wc.close()
+            self.log.debug("Connection pool and cache: %s" % wc.stats())
+        progress.finish()
+        if progress.counts["failed"]:
+            raise AdminCommandError("%s pages failed to synchronize" % \
+                progress.counts["failed"])
+
+    def _select(self, dao, statuses, globs):
+        """Returns the WikiSync matching one of the status and globs"""
+        if not statuses:
+            return []
+        if not globs:
+            return dao.query(status=statuses)
+        items = {}
+        for glob in globs:
+            # the literal prefix of the glob narrows the query
+            prefix = re.split(r"[*?\[]", glob, 1)[0] or None
+            for item in dao.query(status=statuses, prefix=prefix):
+                if fnmatchcase(item.name, glob):
+                    items[item.name] = item
+        return [items[name] for name in sorted(items)]
+
+    def _action(self, command, item, options):
+        if command != "sync":
+            return command
+        if item.status == "conflict":
+            return CONFLICT_ACTIONS[options["resolve"]]
+        return SYNC_ACTIONS[item.status]
+
+class SyncProgress(object):
+    """Prints the progress of an admin command, either as text or as a
+    json object per line."""
+
+    def __init__(self, json=False):
+        self.json = json
+        self.started = time.time()
+        self.counts = dict.fromkeys(("synced", "failed", "skipped"), 0)
+
+    def scan(self, kind):
+        self._print("Checked remote updates (%s scan)" % kind,
+            event="scan", scan=kind)
+
+    def result(self, result):
+        """Prints a wikisync.batch.BatchResult"""
+        if result.ok:
+            self.counts["synced"] += 1
+            status = result.item and result.item.status or "unknown"
+            self._print("%s %s: %s" % (result.action, result.name,
+                status.upper()), event="synced", name=result.name,
+                action=result.action, status=status)
+        else:
+            self.counts["failed"] += 1
+            error = safe_unicode(result.error)
+            self._print("%s %s: ERROR %s" % (result.action, result.name,
+                error), event="failed", name=result.name,
+                action=result.action, error=error)
+
+    def skip(self, tasks):
+        for name, action in tasks:
+            self.counts["skipped"] += 1
+            self._print("%s %s: SKIPPED" % (action, name), event="skipped",
+                name=name, action=action)
+
+    def finish(self):
+        elapsed = round(time.time() - self.started, 3)
+        self._print("%(synced)s synced, %(failed)s failed, "
+            "%(skipped)s skipped" % self.counts + " in %.1fs" % elapsed,
+            event="finished", elapsed=elapsed, **self.counts)
+
+    def _print(self, text, **data):
+        printout(self.json and jsonify(data) or text)
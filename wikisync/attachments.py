@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+import os, tempfile, time
+from collections import namedtuple
+from wikisync.metrics import instrumented
+from wikisync.util import file_digest, safe_unicode
+from trac.attachment import Attachment
+from trac.util.datefmt import to_utimestamp
+
+_FIELDS = ("name", "filename", "size", "digest", "local_time", "remote_time",
+    "sync_time")
+
+_SELECT_SQL = "SELECT %s FROM wikisync_attachment" % ",".join(_FIELDS)
+
+class AttachmentRecord(namedtuple("AttachmentRecord", _FIELDS)):
+    """Represents the last synchronized state of a wiki attachment.
+
+    The 'size' and 'digest' describe the synchronized content, 'local_time'
+    is the time of the local attachment in microseconds, 'remote_time' the
+    remote time as parsed from the remote attachment list.
+    """
+
+    __slots__ = ()
+
+class LocalAttachment(namedtuple("LocalAttachment",
+    ("filename", "size", "time", "path", "description"))):
+    """Represents a local wiki attachment, read by AttachmentSync.prepare()
+    for use by the worker threads."""
+
+    __slots__ = ()
+
+class AttachmentState(namedtuple("AttachmentState",
+    ("name", "local", "records"))):
+    """The local attachments and the AttachmentRecord of a wiki, by
+    filename."""
+
+    __slots__ = ()
+
+class AttachmentTransfer(namedtuple("AttachmentTransfer",
+    ("filename", "size", "digest", "remote_time", "path"))):
+    """Represents a synchronized attachment. The 'path' is a temporary file
+    replacing the local attachment, or None if the local attachment is
+    already identical."""
+
+    __slots__ = ()
+
+class AttachmentDao(object):
+    """Persistence interface of the AttachmentRecord objects."""
+
+    def __init__(self, env):
+        self.env = env
+
+    @instrumented("db", "db_calls")
+    def find_all(self, name):
+        """Returns a dict of the AttachmentRecord of a wiki, by filename"""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute(_SELECT_SQL + " WHERE name=%s", (name,))
+        return dict([(row[1], AttachmentRecord(*row)) for row in cursor])
+
+    @instrumented("db", "db_calls")
+    def save(self, records):
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            for record in records:
+                cursor.execute("""
+                    DELETE FROM wikisync_attachment
+                    WHERE name=%s AND filename=%s
+                """, (record.name, record.filename))
+                cursor.execute("""
+                    INSERT INTO wikisync_attachment(%s) VALUES (%s)
+                """ % (",".join(_FIELDS), ",".join(["%s"] * len(_FIELDS))),
+                    record)
+
+    @instrumented("db", "db_calls")
+    def delete(self, name, filenames):
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.executemany("""
+                DELETE FROM wikisync_attachment
+                WHERE name=%s AND filename=%s
+            """, [(name, filename) for filename in filenames])
+
+class AttachmentSync(object):
+    """Synchronizes the attachments of wiki pages with the remote server.
+
+    The transfers are streamed between the remote server and the disk, an
+    attachment is never loaded in memory as a whole. Attachments are only
+    transferred when their size or time differs from the last synchronized
+    state, and local attachments are only replaced when the content digest
+    differs. Deleted attachments are not propagated.
+
+    As with BatchSync, prepare() and apply() access the database and must
+    be called by the same thread, pull() and push() only perform the remote
+    requests and are called by the worker threads.
+    """
+
+    def __init__(self, env, log=None):
+        self.env = env
+        self.log = log or env.log
+        self.dao = AttachmentDao(env)
+
+    def prepare(self, name):
+        """Returns the AttachmentState of a wiki"""
+        local = {}
+        for attachment in Attachment.select(self.env, "wiki", name):
+            local[attachment.filename] = LocalAttachment(
+                attachment.filename,
+                attachment.size,
+                to_utimestamp(attachment.date),
+                attachment.path,
+                attachment.description
+            )
+        return AttachmentState(name, local, self.dao.find_all(name))
+
+    def unchanged(self, state):
+        """Returns True if none of the local attachments has changed since
+        last synchronized, comparing the size and time only"""
+        for local in state.local.values():
+            record = state.records.get(local.filename)
+            if not _same_local(local, record):
+                return False
+        return True
+
+    def pull(self, wc, state):
+        """Downloads the remote attachments that have changed, returns an
+        array of AttachmentTransfer.
+
+        @param wc: an instance of wikisync.util.WebClient.
+        @param state: an AttachmentState returned by prepare().
+        """
+        plan = []
+        try:
+            for remote in wc.get_remote_attachments(state.name):
+                filename = remote["filename"]
+                local = state.local.get(filename)
+                record = state.records.get(filename)
+                if _same_remote(remote, record):
+                    if _same_local(local, record):
+                        continue
+                    if local and local.size == record.size and \
+                        _local_digest(local) == record.digest:
+                        plan.append(AttachmentTransfer(filename,
+                            record.size, record.digest, remote["time"],
+                            None))
+                        continue
+                plan.append(self._download(wc, state.name, remote, local))
+        except Exception, e:
+            self.discard(plan)
+            raise e
+        return plan
+
+    def push(self, wc, state):
+        """Uploads the local attachments that have changed, returns an
+        array of AttachmentTransfer.
+
+        @param wc: an instance of wikisync.util.WebClient.
+        @param state: an AttachmentState returned by prepare().
+        """
+        if not state.local:
+            return []
+        remotes = dict([(remote["filename"], remote)
+            for remote in wc.get_remote_attachments(state.name)])
+        plan = []
+        uploaded = {}
+        for filename, local in sorted(state.local.items()):
+            remote = remotes.get(filename)
+            record = state.records.get(filename)
+            remote_unchanged = _same_remote(remote, record)
+            if remote_unchanged and _same_local(local, record):
+                continue
+            size, digest = _local_digest(local, True)
+            if remote_unchanged and (size, digest) == \
+                (record.size, record.digest):
+                plan.append(AttachmentTransfer(filename, size, digest,
+                    remote["time"], None))
+                continue
+            wc.upload_attachment(state.name, filename, local.path,
+                local.description)
+            self.log.debug("Uploaded attachment '%s' of wiki '%s' "
+                "(%s bytes)" % (filename, state.name, size))
+            uploaded[filename] = (size, digest)
+        if uploaded:
+            # the remote time is only known from the attachment list
+            for remote in wc.get_remote_attachments(state.name):
+                if remote["filename"] in uploaded:
+                    size, digest = uploaded.pop(remote["filename"])
+                    plan.append(AttachmentTransfer(remote["filename"], size,
+                        digest, remote["time"], None))
+            if uploaded:
+                raise RuntimeError("Cannot find uploaded attachments '%s' "
+                    "of wiki '%s'" % ("', '".join(uploaded), state.name))
+        return plan
+
+    def apply(self, state, plan, author=None, addr=None):
+        """Replaces the local attachments downloaded by pull() and records
+        the synchronized states, the temporary files are removed."""
+        try:
+            records = []
+            sync_time = int(time.time() * 1000000)
+            for transfer in plan:
+                local = state.local.get(transfer.filename)
+                local_time = local and local.time
+                if transfer.path:
+                    local_time = self._replace(state.name, transfer, local,
+                        author, addr)
+                records.append(AttachmentRecord(state.name,
+                    transfer.filename, transfer.size, transfer.digest,
+                    local_time, transfer.remote_time, sync_time))
+            self.dao.save(records)
+            # records of the attachments removed locally
+            synced = set([record.filename for record in records])
+            self.dao.delete(state.name, [filename
+                for filename in state.records
+                if filename not in state.local and filename not in synced])
+        finally:
+            self.discard(plan)
+
+    def discard(self, plan):
+        """Removes the temporary files of an unapplied plan"""
+        for transfer in plan:
+            if transfer.path and os.path.isfile(transfer.path):
+                os.remove(transfer.path)
+
+    def _download(self, wc, name, remote, local):
+        filename = remote["filename"]
+        fd, path = tempfile.mkstemp(prefix="wikisync-")
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                size, digest = wc.download_attachment(name, filename, f)
+            finally:
+                f.close()
+            if local and local.size == size and \
+                _local_digest(local) == digest:
+                # identical content, the local attachment is kept
+                os.remove(path)
+                path = None
+                self.log.debug("Attachment '%s' of wiki '%s' has not "
+                    "changed" % (filename, name))
+            else:
+                self.log.debug("Downloaded attachment '%s' of wiki '%s' "
+                    "(%s bytes)" % (filename, name, size))
+        except Exception, e:
+            os.remove(path)
+            raise e
+        return AttachmentTransfer(filename, size, digest, remote["time"], path)
+
+    def _replace(self, name, transfer, local, author, addr):
+        """Replaces the local attachment with the downloaded file, returns
+        the time of the new attachment. The local attachment is deleted and
+        the new one inserted in a single transaction, the local file is
+        moved aside meanwhile, and restored if the insert fails."""
+        backup = None
+        if local:
+            fd, backup = tempfile.mkstemp(prefix="wikisync-",
+                dir=os.path.dirname(local.path))
+            os.close(fd)
+            os.remove(backup)
+            os.rename(local.path, backup)
+        attachment = Attachment(self.env, "wiki", name)
+        attachment.author = author
+        attachment.ipnr = addr
+        attachment.description = local and local.description or None
+        try:
+            @self.env.with_transaction()
+            def execute(db):
+                if local:
+                    Attachment(self.env, "wiki", name,
+                        local.filename).delete(db)
+                f = open(transfer.path, "rb")
+                try:
+                    attachment.insert(transfer.filename, f, transfer.size,
+                        db=db)
+                finally:
+                    f.close()
+        except Exception, e:
+            if backup:
+                self._restore(name, local, backup)
+            raise e
+        if backup:
+            os.remove(backup)
+        self.log.debug("Replaced attachment '%s' of wiki '%s'" % \
+            (transfer.filename, name))
+        return to_utimestamp(attachment.date)
+
+    def _restore(self, name, local, backup):
+        """Moves the local file back in place of a failed replacement"""
+        try:
+            if os.path.isfile(local.path):
+                # the partially written file of the new attachment
+                os.remove(local.path)
+            os.rename(backup, local.path)
+        except OSError, e:
+            self.log.error("Attachment '%s' of wiki '%s' is lost, its "
+                "content remains in %s: %s" % (local.filename, name, backup,
+                e))
+
+def _same_local(local, record):
+    return bool(local and record) and \
+        (local.size, local.time) == (record.size, record.local_time)
+
+def _same_remote(remote, record):
+    return bool(remote and record) and \
+        (remote["size"], safe_unicode(remote["time"])) == \
+        (record.size, record.remote_time)
+
+def _local_digest(local, with_size=False):
+    f = open(local.path, "rb")
+    try:
+        size, digest = file_digest(f)
+    finally:
+        f.close()
+    return with_size and (size, digest) or digest
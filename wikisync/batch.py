@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+import threading, time, Queue
+from collections import namedtuple
+from wikisync.model import WikiSyncDao
+from wikisync.attachments import AttachmentSync
+from wikisync.delta import DEFAULT_DELTA_MIN_SIZE
+from wikisync.metrics import METRICS, PageTrace, instrumented
+from wikisync.tree import compare_tree, tree_supported
+from wikisync.util import text_digest, jsonify
+from trac.core import TracError
+from trac.wiki.model import WikiPage
+
+BATCH_ACTIONS = ("refresh", "pull", "push")
+
+DEFAULT_CONCURRENCY = 4
+
+DEFAULT_INCREMENTAL_DAYS = 7
+
+# refresh batches of at least this number of pages read the remote versions
+# from the remote index in a single request, instead of a request per page.
+# The index lists every remote wiki, smaller batches are cheaper to refresh
+# one by one.
+PROBE_BATCH_SIZE = 20
+
+# marks a prepared page that requires no transfer
+_UNCHANGED = object()
+
+@instrumented("scan")
+def refresh_remote(env, client, ignore_filter=None, 
+    incremental_days=DEFAULT_INCREMENTAL_DAYS, full=False, log=None):
+    """Updates the remote states of all WikiSync.
+    
+    Only the remote timeline since the last successful scan is fetched, 
+    unless a full scan is requested or the timeline window cannot be 
+    trusted: no full scan was performed within the last 'incremental_days'
+    days (removed remote pages are only detected by full scans), or the 
+    timeline cannot be retrieved. A full scan parses the remote 
+    'RecentChanges' page instead.
+    
+    When the remote server runs WikiSync as well, the remote states are 
+    compared as hash trees instead, only the differing subtrees are read, 
+    see wikisync.tree.compare_tree().
+    
+    Returns 'tree', 'full' or 'incremental' depending on the scan performed.
+    """
+    log = log or env.log
+    dao = WikiSyncDao(env)
+    scan_time = time.time()
+    if tree_supported(client):
+        try:
+            changed, removed = compare_tree(client, dao.get_remote_entries())
+        except Exception, e:
+            log.warning("Unable to compare remote tree, "
+                "performing timeline refresh: %s" % e)
+        else:
+            dao.sync_remote_data(changed, ignore_filter, partial=True,
+                removed=removed)
+            dao.set_scan_time(scan_time, full=True)
+            log.debug("Refreshed %s remote changes and %s removals "
+                "from the remote tree" % (len(changed), len(removed)))
+            METRICS.count("scans", kind="tree")
+            return "tree"
+    last_scan_time = dao.get_scan_time()
+    last_full_scan_time = dao.get_scan_time(full=True)
+    if not full and last_scan_time and last_full_scan_time and \
+        scan_time - last_full_scan_time < incremental_days * 86400:
+        # the remote server includes changes up to the end of the day 'date',
+        # pad the window by a day on both ends to account for timezones
+        date = scan_time + 86400
+        days = int((date - last_scan_time) / 86400) + 2
+        try:
+            results = client.get_remote_updates(date, days)
+        except Exception, e:
+            log.warning("Unable to read remote timeline, "
+                "performing full refresh: %s" % e)
+        else:
+            dao.sync_remote_data(results, ignore_filter, partial=True)
+            dao.set_scan_time(scan_time)
+            log.debug("Refreshed %s remote changes within %s days" % \
+                (len(results), days))
+            METRICS.count("scans", kind="incremental")
+            return "incremental"
+    results = client.get_remote_list()
+    dao.sync_remote_data(results, ignore_filter)
+    dao.set_scan_time(scan_time, full=True)
+    log.debug("Refreshed %s remote pages" % len(results))
+    METRICS.count("scans", kind="full")
+    return "full"
+
+class BatchResult(namedtuple("BatchResult",
+    ("name", "action", "item", "error"))):
+    """Represents the outcome of a single page synchronization."""
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+class BatchSync(object):
+    """Synchronizes multiple wiki pages with the remote server.
+
+    Remote transfers are performed by a bounded pool of worker threads,
+    each using a WebClient that shares the authenticated session of the
+    primary client. Local wiki pages and WikiSync states are only written
+    by the thread calling run(), keeping the database access serialized.
+
+    The attachments of the pulled and pushed pages are synchronized along,
+    unless 'ignore_attachment' is set, see AttachmentSync.
+
+    The texts of the pages of at least 'delta_min_size' are transferred as
+    deltas of their last synchronized version, see wikisync.delta.
+    """
+
+    def __init__(self, env, client, concurrency=DEFAULT_CONCURRENCY,
+        log=None):
+        """
+        @param env: the trac environment.
+        @param client: an instance of wikisync.util.WebClient, the workers
+            operates on clones of this client.
+        @param concurrency: maximum number of concurrent remote requests.
+        @param log: optional logger, defaults to env.log.
+        """
+        self.env = env
+        self.client = client
+        self.concurrency = max(1, concurrency or 1)
+        self.log = log or env.log
+        self.dao = WikiSyncDao(env)
+        self.attachments = AttachmentSync(env, self.log)
+        from wikisync.plugin import CONFIG_SECTION
+        self.log_metrics = env.config.getbool(CONFIG_SECTION, "log_metrics",
+            False)
+        self.delta_min_size = env.config.getint(CONFIG_SECTION,
+            "delta_min_size", DEFAULT_DELTA_MIN_SIZE)
+
+    def run(self, tasks, author=None, addr=None, callback=None):
+        """Synchronizes the pages and returns an array of BatchResult,
+        in the same order as the tasks.
+
+        @param tasks: an iterable of (name, action) tuple, where action is
+            one of 'refresh', 'pull' or 'push'.
+        @param author: the author recorded in pulled wiki pages.
+        @param addr: the ip address recorded in pulled wiki pages.
+        @param callback: optional callable, invoked with each BatchResult
+            as soon as the page is processed.
+        """
+        METRICS.count("batches")
+        with METRICS.timed("batch"):
+            return self._run(tasks, author, addr, callback)
+
+    def _run(self, tasks, author, addr, callback):
+        results = []
+        # the timings and counters of each page, by task index
+        traces = []
+        jobs = Queue.Queue()
+        probes = []
+        for index, (name, action) in enumerate(tasks):
+            results.append(None)
+            trace = PageTrace(name, action)
+            traces.append(trace)
+            try:
+                with METRICS.tracing(trace):
+                    job = self._prepare(name, action)
+                    if job[3] is _UNCHANGED:
+                        item = self._apply_unchanged(job[2])
+                        results[index] = self._result(name, action, item,
+                            None, callback, trace)
+                    elif action == "refresh":
+                        probes.append((index,) + job)
+                    else:
+                        jobs.put((index,) + job)
+            except Exception, e:
+                results[index] = self._result(name, action, None, e, callback,
+                    trace)
+        if len(probes) >= PROBE_BATCH_SIZE:
+            probes = self._probe(probes, results, callback, traces)
+        for job in probes:
+            jobs.put(job)
+        pending = jobs.qsize()
+        if not pending:
+            return results
+        self.client.authenticate()
+        # clients transferring many pages per request, e.g. RpcClient,
+        # receive the jobs in chunks spread over the workers
+        chunk = max(1, min(getattr(self.client, "batch_size", 1), 
+            -(-pending // self.concurrency)))
+        done = Queue.Queue()
+        workers = [
+            threading.Thread(target=self._work, 
+                args=(jobs, done, traces, chunk))
+            for i in range(min(self.concurrency, pending))
+        ]
+        for worker in workers:
+            worker.setDaemon(True)
+            worker.start()
+        while pending:
+            index, name, action, item, payload, attachments, plan, error = \
+                done.get()
+            pending -= 1
+            if not error:
+                try:
+                    with METRICS.tracing(traces[index]):
+                        apply = getattr(self, "_apply_%s" % action)
+                        item = apply(name, item, payload, author, addr)
+                        if plan is not None:
+                            self.attachments.apply(attachments, plan, author,
+                                addr)
+                            plan = None
+                except Exception, e:
+                    error = e
+            if plan:
+                self.attachments.discard(plan)
+            results[index] = self._result(name, action, item, error, callback,
+                traces[index])
+        for worker in workers:
+            worker.join()
+        return results
+
+    def _probe(self, jobs, results, callback, traces):
+        """Refreshes the pages from a single request of their remote
+        versions, returns the jobs to refresh one by one, all of them if the
+        request fails, or the pages whose version could not be read"""
+        try:
+            versions = self.client.get_remote_versions(
+                [job[1] for job in jobs])
+        except Exception, e:
+            self.log.warning("Unable to read remote versions, refreshing "
+                "pages one by one: %s" % e)
+            return jobs
+        unknown = []
+        for job in jobs:
+            index, name, action, item, payload, attachments = job
+            if name not in versions:
+                unknown.append(job)
+                continue
+            info = []
+            if versions.get(name):
+                info = [{"name": name, "remote_version": versions[name]}]
+            error = None
+            try:
+                with METRICS.tracing(traces[index]):
+                    item = self._apply_refresh(name, item, info, None, None)
+            except Exception, e:
+                error = e
+            results[index] = self._result(name, action, item, error,
+                callback, traces[index])
+        return unknown
+
+    def _result(self, name, action, item, error, callback, trace):
+        if error:
+            self.log.error("Failed to %s wiki '%s': %s" % \
+                (action, name, error))
+        METRICS.count("pages", action=action,
+            outcome=error and "failed" or "ok")
+        METRICS.observe("page", time.time() - trace.started)
+        if self.log_metrics:
+            self.log.info("wikisync.page %s" % \
+                jsonify(trace.as_dict(error is None)))
+        result = BatchResult(name, action, item, error)
+        if callback:
+            callback(result)
+        return result
+
+    def _prepare(self, name, action):
+        """Reads the local states required by the workers, returns a
+        (name, action, item, payload, attachments) tuple, where attachments
+        is the AttachmentState of the page, or None if ignored. The payload
+        of a pull is the base of a delta transfer, see _base()."""
+        if action not in BATCH_ACTIONS:
+            raise ValueError("Unsupported action '%s'" % action)
+        if action == "refresh":
+            return name, action, None, None, None
+        item = self.dao.find(name)
+        if not item:
+            raise ValueError("Missing wiki '%s'" % name)
+        attachments = None
+        if not item.ignore_attachment:
+            attachments = self.attachments.prepare(item.name)
+        if action == "push":
+            wiki = WikiPage(self.env, item.name)
+            assert wiki.version > 0, "Cannot find wiki '%s'" % item.name
+            digest = text_digest(wiki.text)
+            if digest == item.sync_local_digest and item.remote_version \
+                and item.remote_version == item.sync_remote_version:
+                # the local text is identical to the last synchronized text,
+                # and the remote wiki has not changed since
+                item = item.replace(local_version=wiki.version)
+                if not attachments or \
+                    self.attachments.unchanged(attachments):
+                    return name, action, item, _UNCHANGED, None
+                # only the attachments are pushed
+                return name, action, item, None, attachments
+            return name, action, item, (wiki.text, wiki.comment,
+                self._base(item)), attachments
+        return name, action, item, self._base(item), attachments
+
+    def _base(self, item):
+        """Returns the (remote version, text) of the last synchronized text
+        of a wiki, or None if unknown or smaller than 'delta_min_size'"""
+        if not self.delta_min_size or not item.sync_remote_version or \
+            not item.sync_local_version or not item.sync_remote_digest:
+            return None
+        wiki = WikiPage(self.env, item.name, item.sync_local_version)
+        if not wiki.exists or len(wiki.text) < self.delta_min_size or \
+            text_digest(wiki.text) != item.sync_remote_digest:
+            return None
+        return item.sync_remote_version, wiki.text
+
+    def _work(self, jobs, done, traces, chunk=1):
+        """Worker thread, performs the remote requests only. The jobs are
+        taken 'chunk' at a time, their texts are transferred in bulk."""
+        try:
+            wc = self.client.clone()
+        except Exception, e:
+            # e.g. the session cannot be renewed, the jobs left are failed
+            # as a result is awaited for every job
+            while True:
+                try:
+                    job = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                done.put(job + (None, e))
+        try:
+            while True:
+                batch = []
+                while len(batch) < chunk:
+                    try:
+                        batch.append(jobs.get_nowait())
+                    except Queue.Empty:
+                        break
+                if not batch:
+                    break
+                transferred = len(batch) > 1 and \
+                    self._transfer_many(wc, batch) or {}
+                for index, name, action, item, payload, attachments in batch:
+                    plan = None
+                    error = None
+                    try:
+                        with METRICS.tracing(traces[index]):
+                            if action == "refresh":
+                                payload = wc.get_remote_version(name)
+                            elif action == "pull":
+                                if index in transferred:
+                                    payload = _checked(transferred[index])
+                                else:
+                                    payload = wc.pull(item.name, 
+                                        item.remote_version, payload)
+                                if attachments:
+                                    plan = self.attachments.pull(wc,
+                                        attachments)
+                            elif action == "push":
+                                if payload:
+                                    text, comment, base = payload
+                                    if index in transferred:
+                                        info = _checked(transferred[index])
+                                    else:
+                                        info = wc.push(item.name, text,
+                                            comment, item.remote_version or 0,
+                                            base)
+                                    payload = (info, text_digest(text))
+                                if attachments:
+                                    plan = self.attachments.push(wc,
+                                        attachments)
+                    except Exception, e:
+                        error = e
+                    done.put((index, name, action, item, payload, attachments,
+                        plan, error))
+        finally:
+            wc.close()
+
+    def _transfer_many(self, wc, jobs):
+        """Pulls and pushes the texts of the jobs in bulk, see RpcClient.
+        Returns a dict of the text or the remote info by job index, or of
+        the exception raised for the page. The pages with a delta base are
+        transferred one by one."""
+        pulls = [job for job in jobs if job[2] == "pull" and not job[4]]
+        pushes = [job for job in jobs if job[2] == "push" and job[4] and
+            not job[4][2]]
+        transferred = {}
+        for transfer, selected, pages in (
+            (wc.pull_many, pulls, [(job[3].name, job[3].remote_version)
+                for job in pulls]),
+            (wc.push_many, pushes, [(job[3].name,) + tuple(job[4][:2])
+                for job in pushes])):
+            if not selected:
+                continue
+            try:
+                results = transfer(pages)
+            except Exception, e:
+                results = [e] * len(selected)
+            for job, result in zip(selected, results):
+                transferred[job[0]] = result
+        return transferred
+
+    def _apply_refresh(self, name, item, info, author, addr):
+        item = self.dao.find(name)
+        if not item:
+            wiki = WikiPage(self.env, name)
+            if wiki.exists:
+                item = self.dao.factory(
+                    name=name,
+                    local_version=wiki.version,
+                    sync_time=time.time()
+                )
+                item = self.dao.create(item)
+                self.log.debug("Created '%s' wikisync" % name)
+        if info:
+            info = info[0]
+            info["sync_time"] = time.time()
+            if item:
+                item = self.dao.update(item.replace(**info))
+            else:
+                item = self.dao.create(self.dao.factory(**info))
+            self.log.debug("Updated '%s' wikisync info %s" % (name, info))
+        elif item:
+            item = self.dao.update(item.replace(sync_time=time.time()))
+        return item
+
+    def _apply_unchanged(self, item):
+        item = item.synchronized(item.sync_local_digest)
+        self.dao.update(item)
+        self.log.debug("Content has not changed, marked wiki '%s' "
+            "as synced" % item.name)
+        return item
+
+    def _apply_pull(self, name, item, text, author, addr):
+        from wikisync.plugin import DEFAULT_SIGNATURE
+        wiki = WikiPage(self.env, item.name)
+        digest = text_digest(text)
+        if wiki.exists and text_digest(wiki.text) == digest:
+            return self._apply_unchanged(item.replace(
+                local_version=wiki.version,
+                sync_local_digest=digest
+            ))
+        wiki.text = text
+        if not len(wiki.text) and not wiki.version:
+            # BUGFIX: account for empy remote wiki Page,
+            # which throws a Page not modified exception when
+            # saving for the first time (default wiki.text = '')
+            wiki.text = " "
+        try:
+            with METRICS.timed("wiki_save"):
+                wiki.save(author, DEFAULT_SIGNATURE, addr)
+        except TracError, e:
+            if wiki.text != wiki.old_text:
+                raise e
+            else:
+                self.log.debug("Content has not changed, "
+                               "skipping '%s'" % item.name)
+        item = item.replace(
+            local_version=wiki.version
+        ).synchronized(digest)
+        self.dao.update(item)
+        self.log.debug("Pulled wiki '%s'" % item.name)
+        return item
+
+    def _apply_push(self, name, item, payload, author, addr):
+        if not payload:
+            # the text has not changed, only the attachments were pushed
+            return self._apply_unchanged(item)
+        info, digest = payload
+        item = item.replace(**info).synchronized(digest)
+        self.dao.update(item)
+        self.log.debug("Pushed wiki '%s'" % item.name)
+        return item
+
+def _checked(result):
+    """Returns the result of a bulk transfer, raises the exception of a
+    failed page"""
+    if isinstance(result, Exception):
+        raise result
+    return result
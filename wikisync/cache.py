@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+import os, socket, tempfile, threading, time, urllib2, mimetools
+from hashlib import sha1
+from StringIO import StringIO
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "wikisync-cache")
+
+# leftover response body that is read when a response is closed early,
+# allowing the response to be cached, see wikisync.connection.MAX_DRAIN_SIZE
+MAX_FILL_SIZE = 64 * 1024
+
+# response headers that are not replayed from the cache
+_EXCLUDED_HEADERS = ("set-cookie", "set-cookie2", "connection",
+    "keep-alive", "transfer-encoding")
+
+class ResponseCache(object):
+    """Stores HTTP response bodies on disk together with their validators
+    (ETag and Last-Modified).
+
+    Each entry is kept as a body file and a json metadata file named after
+    the sha1 digest of the cache key. The total size of the body files is
+    bounded by 'max_size' bytes, the least recently used entries are
+    evicted first.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+        max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._size = 0
+        self._counters = dict.fromkeys(
+            ("hits", "misses", "stored", "evicted"), 0)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+    def configure(self, max_size=None):
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            self._evict()
+
+    def key(self, namespace, url):
+        return sha1("%s\n%s" % (namespace, url)).hexdigest()
+
+    def get(self, key):
+        """Returns a (metadata, body file) tuple, or None if the key is
+        not cached. The returned file remains readable even if the entry
+        is evicted afterwards."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            try:
+                with open(self._path(key, ".json"), "rb") as f:
+                    meta = json.load(f)
+                body = open(self._path(key), "rb")
+            except (IOError, OSError, ValueError):
+                self._remove(key)
+                return None
+            self._entries[key][1] = time.time()
+            return meta, body
+
+    def touch(self, key):
+        """Marks the entry as recently used"""
+        with self._lock:
+            if key in self._entries:
+                now = time.time()
+                self._entries[key][1] = now
+                try:
+                    os.utime(self._path(key, ".json"), (now, now))
+                except OSError:
+                    pass
+
+    def writer(self):
+        """Returns a (file, path) tuple of a temporary file for a new entry,
+        see commit() and discard()."""
+        fd, path = tempfile.mkstemp(prefix=".tmp", dir=self.directory)
+        return os.fdopen(fd, "wb"), path
+
+    def commit(self, key, path, meta):
+        """Stores the temporary body file at 'path' under 'key'"""
+        size = os.path.getsize(path)
+        if size > self.max_size:
+            self.discard(path)
+            return False
+        fd, meta_path = tempfile.mkstemp(prefix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            json.dump(meta, f)
+        with self._lock:
+            self._remove(key)
+            os.rename(path, self._path(key))
+            os.rename(meta_path, self._path(key, ".json"))
+            self._entries[key] = [size, time.time()]
+            self._size += size
+            self._counters["stored"] += 1
+            self._evict()
+        return True
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def clear(self):
+        """Removes all entries"""
+        with self._lock:
+            for key in self._entries.keys():
+                self._remove(key)
+
+    def stats(self):
+        """Returns a dict of cache counters, 'hits' are requests answered
+        with '304 Not Modified' and served from the cache."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+            stats["size"] = self._size
+            return stats
+
+    def _path(self, key, suffix=""):
+        return os.path.join(self.directory, key + suffix)
+
+    def _load(self):
+        for name in os.listdir(self.directory):
+            if name.startswith(".tmp"):
+                # left over by an interrupted process
+                self.discard(os.path.join(self.directory, name))
+                continue
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            try:
+                size = os.path.getsize(self._path(key))
+                last_used = os.path.getmtime(self._path(key, ".json"))
+            except OSError:
+                continue
+            self._entries[key] = [size, last_used]
+            self._size += size
+        self._evict()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._size -= entry[0]
+        for suffix in ("", ".json"):
+            try:
+                os.remove(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+        entries = sorted(self._entries.items(), key=lambda e: e[1][1])
+        for key, (size, last_used) in entries:
+            if self._size <= self.max_size:
+                break
+            self._remove(key)
+            self._counters["evicted"] += 1
+
+# caches shared by all WebClient, by directory
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def get_cache(directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+    """Returns the process wide ResponseCache of the directory"""
+    directory = os.path.abspath(directory)
+    with _CACHES_LOCK:
+        cache = _CACHES.get(directory)
+        if not cache:
+            cache = _CACHES[directory] = ResponseCache(directory, max_size)
+        else:
+            cache.configure(max_size)
+        return cache
+
+class CachingReader(object):
+    """Reads a response body, copying the data to a cache entry. The entry
+    is only committed when the body is read entirely."""
+
+    def __init__(self, cache, key, meta, response):
+        self._cache = cache
+        self._key = key
+        self._meta = meta
+        self._response = response
+        self._remaining = _content_length(response)
+        self._file, self._path = cache.writer()
+
+    def read(self, amt=None):
+        if self._response is None:
+            return ""
+        if amt is None or amt < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        self._write(data, not data or amt is None or amt < 0)
+        return data
+
+    recv = read
+
+    def close(self):
+        response = self._response
+        if response is None:
+            return
+        if self._file and self._remaining is not None and \
+            0 < self._remaining <= MAX_FILL_SIZE:
+            try:
+                self._write(response.read(), True)
+            except (socket.error, IOError):
+                pass
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._cache.discard(self._path)
+        self._response = None
+        response.close()
+
+    def _write(self, data, eof):
+        if not self._file:
+            return
+        self._file.write(data)
+        if self._remaining is not None:
+            self._remaining -= len(data)
+            eof = eof or self._remaining <= 0
+        if eof:
+            self._file.close()
+            self._file = None
+            self._cache.commit(self._key, self._path, self._meta)
+
+    def __del__(self):
+        if self._response is not None:
+            self.close()
+
+def _content_length(response):
+    try:
+        return int(response.info().getheader("Content-Length"))
+    except (TypeError, ValueError):
+        return None
+
+class CacheHandler(urllib2.BaseHandler):
+    """Revalidates cached GET responses with If-None-Match and
+    If-Modified-Since headers, replaying the cached response when the
+    server replies with '304 Not Modified'.
+
+    The handler runs before urllib2.HTTPErrorProcessor, which would
+    otherwise raise the '304' response as an error.
+    """
+
+    handler_order = 900
+
+    def __init__(self, cache, namespace=""):
+        """
+        @param cache: an instance of ResponseCache.
+        @param namespace: separates the cache entries of different users,
+            typically a hash of the credentials.
+        """
+        self.cache = cache
+        self.namespace = namespace
+
+    def http_request(self, req):
+        if req.get_method() != "GET" or req.has_data() or \
+            "no-store" in (req.get_header("Cache-control") or ""):
+            # e.g. attachment downloads, streamed to disk by the caller
+            return req
+        key = self.cache.key(self.namespace, req.get_full_url())
+        req._wikisync_cache = (key, None)
+        entry = self.cache.get(key)
+        if entry:
+            meta, body = entry
+            req._wikisync_cache = (key, entry)
+            if meta.get("etag"):
+                req.add_unredirected_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified"):
+                req.add_unredirected_header("If-Modified-Since",
+                    meta["last_modified"])
+        return req
+
+    def http_response(self, req, response):
+        key, entry = getattr(req, "_wikisync_cache", (None, None))
+        if not key:
+            return response
+        req._wikisync_cache = (None, None)
+        if response.code == 304 and entry:
+            response.read()
+            response.close()
+            meta, body = entry
+            self.cache.touch(key)
+            self.cache.count("hits")
+            headers = mimetools.Message(StringIO(meta["headers"]))
+            cached = urllib2.addinfourl(body, headers, meta["url"])
+            cached.code = meta.get("code", 200)
+            cached.msg = meta.get("msg", "OK")
+            cached.transfer = getattr(response, "transfer", None)
+            return cached
+        if entry:
+            entry[1].close()
+        if response.code != 200:
+            return response
+        self.cache.count("misses")
+        headers = response.info()
+        etag = headers.getheader("ETag")
+        last_modified = headers.getheader("Last-Modified")
+        if not (etag or last_modified) or \
+            "no-store" in (headers.getheader("Cache-Control") or ""):
+            return response
+        meta = {
+            "url": response.geturl(),
+            "code": response.code,
+            "msg": response.msg,
+            "etag": etag,
+            "last_modified": last_modified,
+            "headers": "".join([h for h in headers.headers
+                if h.split(":", 1)[0].strip().lower()
+                    not in _EXCLUDED_HEADERS]),
+        }
+        fp = socket._fileobject(CachingReader(self.cache, key, meta,
+            response), close=True)
+        cached = urllib2.addinfourl(fp, headers, response.geturl())
+        cached.code = response.code
+        cached.msg = response.msg
+        cached.transfer = getattr(response, "transfer", None)
+        return cached
+
+    https_request = http_request
+    https_response = http_response
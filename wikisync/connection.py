@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+import httplib, socket, threading, time, urllib2, zlib
+from urllib2 import URLError
+
+DEFAULT_MAX_CONNECTIONS = 4
+
+DEFAULT_IDLE_TIMEOUT = 60
+
+# leftover response body that is drained when a response is closed early,
+# allowing the connection to be reused
+MAX_DRAIN_SIZE = 64 * 1024
+
+# content encodings decoded by the handlers, in order of preference
+ACCEPT_ENCODING = "gzip, deflate"
+
+# size of the compressed chunks read from the socket while decoding
+DECODE_CHUNK_SIZE = 16 * 1024
+
+class ConnectionPool(object):
+    """Keeps HTTP/1.1 connections alive across requests.
+
+    Connections are pooled by scheme and host, with at most 'max_connections'
+    connections per host. Requests exceeding the limit waits for a pooled
+    connection to be released, or falls back to a connection that is closed
+    after use when none becomes available within 'wait_timeout' seconds.
+    Connections idle for more than 'idle_timeout' seconds are evicted.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT, wait_timeout=10):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Condition()
+        self._idle = {}
+        self._active = {}
+        self._counters = dict.fromkeys(
+            ("created", "reused", "evicted", "discarded", "overflow",
+             "received", "decoded"), 0)
+
+    def configure(self, max_connections=None, idle_timeout=None):
+        with self._lock:
+            if max_connections:
+                self.max_connections = max_connections
+            if idle_timeout:
+                self.idle_timeout = idle_timeout
+            self._lock.notify_all()
+
+    def acquire(self, key, factory, fresh=False):
+        """Returns a (connection, reused, pooled) tuple for the given key.
+
+        @param key: a (scheme, host) tuple.
+        @param factory: callable returning a new connection.
+        @param fresh: when True, idle connections are not reused.
+        """
+        deadline = time.time() + self.wait_timeout
+        with self._lock:
+            self._evict(time.time())
+            while True:
+                idle = self._idle.get(key)
+                if idle and not fresh:
+                    conn, last_used = idle.pop()
+                    self._active[key] = self._active.get(key, 0) + 1
+                    self._counters["reused"] += 1
+                    return conn, True, True
+                if idle and fresh:
+                    conn, last_used = idle.pop(0)
+                    conn.close()
+                    self._counters["discarded"] += 1
+                    continue
+                if self._active.get(key, 0) < self.max_connections:
+                    self._active[key] = self._active.get(key, 0) + 1
+                    self._counters["created"] += 1
+                    return factory(), False, True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._counters["overflow"] += 1
+                    return factory(), False, False
+                self._lock.wait(remaining)
+
+    def release(self, key, conn, reusable=True):
+        """Returns a connection to the pool, or closes it if the connection
+        cannot be reused."""
+        with self._lock:
+            self._active[key] = max(0, self._active.get(key, 0) - 1)
+            if reusable and conn.sock:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+            else:
+                conn.close()
+                self._counters["discarded"] += 1
+            self._lock.notify()
+
+    def evict(self):
+        """Closes all idle connections that have exceeded the idle timeout."""
+        with self._lock:
+            self._evict(time.time())
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._lock:
+            self._evict(None)
+
+    def transferred(self, received, decoded):
+        """Counts the response body bytes received on the wire and the
+        bytes after decoding the content encoding"""
+        with self._lock:
+            self._counters["received"] += received
+            self._counters["decoded"] += decoded
+
+    def stats(self):
+        """Returns a dict of pool counters, 'created' and 'reused' indicates
+        the number of new and reused connections respectively, 'received'
+        and 'decoded' the number of response body bytes on the wire and
+        after decompression."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["idle"] = sum([len(v) for v in self._idle.values()])
+            stats["active"] = sum(self._active.values())
+            return stats
+
+    def _evict(self, now):
+        for key, idle in self._idle.items():
+            keep = []
+            for conn, last_used in idle:
+                if now is None or now - last_used > self.idle_timeout:
+                    conn.close()
+                    self._counters["evicted"] += 1
+                else:
+                    keep.append((conn, last_used))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+# process wide connection pool shared by all WebClient
+POOL = ConnectionPool()
+
+class Transfer(object):
+    """Counts the bytes of a response body, on the wire ('received') and
+    after decoding the content encoding ('decoded')."""
+
+    def __init__(self, url, encoding=None):
+        self.url = url
+        self.encoding = encoding
+        self.received = 0
+        self.decoded = 0
+
+    def __repr__(self):
+        return "<Transfer %s: %s bytes received, %s bytes decoded>" % \
+            (self.url, self.received, self.decoded)
+
+class PooledResponse(object):
+    """Wraps a httplib.HTTPResponse, returning the connection to the pool
+    as soon as the response body is fully read."""
+
+    def __init__(self, pool, key, conn, response, pooled=True, 
+        transfer=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._pooled = pooled
+        self._transfer = transfer
+        self._check()
+
+    def read(self, amt=None):
+        if self._response is None:
+            return ""
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        transfer = self._transfer
+        if transfer and data:
+            transfer.received += len(data)
+            if not transfer.encoding:
+                transfer.decoded += len(data)
+                self._pool.transferred(len(data), len(data))
+            else:
+                self._pool.transferred(len(data), 0)
+        self._check()
+        return data
+
+    recv = read
+
+    def close(self):
+        response = self._response
+        if response is None:
+            return
+        if not response.isclosed() and response.length is not None \
+            and response.length <= MAX_DRAIN_SIZE:
+            try:
+                response.read()
+            except (socket.error, httplib.HTTPException):
+                pass
+        self._done(response.isclosed() and not response.will_close)
+
+    def _check(self):
+        response = self._response
+        if response is not None and (response.isclosed() or \
+            response.length == 0):
+            self._done(not response.will_close)
+
+    def _done(self, reusable):
+        response = self._response
+        self._response = None
+        if not response.isclosed():
+            response.close()
+        if self._pooled:
+            self._pool.release(self._key, self._conn, reusable)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def __del__(self):
+        if self._response is not None:
+            self.close()
+
+class DecodingResponse(object):
+    """Decompresses a gzip or deflate encoded response body as it is read,
+    without buffering the whole body."""
+
+    def __init__(self, pool, fp, transfer):
+        self._pool = pool
+        self._fp = fp
+        self._transfer = transfer
+        self._buffer = ""
+        self._eof = False
+        self._raw = False
+        self._decoder = self._decompressor()
+
+    def _decompressor(self):
+        if self._transfer.encoding == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._raw:
+            return zlib.decompressobj(-zlib.MAX_WBITS)
+        return zlib.decompressobj()
+
+    def _decompress(self, chunk):
+        try:
+            return self._decoder.decompress(chunk)
+        except zlib.error:
+            if self._transfer.encoding != "deflate" or self._raw or \
+                self._transfer.received > len(chunk):
+                raise
+            # some servers sends raw deflate data without the zlib header
+            self._raw = True
+            self._decoder = self._decompressor()
+            return self._decoder.decompress(chunk)
+
+    def _fill(self, size):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while not self._eof and (size is None or length < size):
+            chunk = self._fp.read(DECODE_CHUNK_SIZE)
+            if chunk:
+                data = self._decompress(chunk)
+            else:
+                data = self._decoder.flush()
+                self._eof = True
+            if data:
+                self._transfer.decoded += len(data)
+                self._pool.transferred(0, len(data))
+                parts.append(data)
+                length += len(data)
+        self._buffer = "".join(parts)
+
+    def read(self, amt=None):
+        if amt is None or amt < 0:
+            self._fill(None)
+            data, self._buffer = self._buffer, ""
+        else:
+            self._fill(amt)
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    recv = read
+
+    def close(self):
+        self._buffer = ""
+        self._eof = True
+        self._fp.close()
+
+class KeepAliveMixin(object):
+    """Opens urllib2 requests over pooled persistent connections.
+
+    Unless 'accept_encoding' is disabled, compressed responses are requested
+    and decoded transparently. The returned response has a 'transfer'
+    attribute, see Transfer.
+    """
+
+    def _open_pooled(self, scheme, http_class, req):
+        host = req.get_host()
+        if not host:
+            raise URLError("no host given")
+        pool = self.pool or POOL
+        key = (scheme, host)
+        factory = lambda: http_class(host, timeout=req.timeout)
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+        if self.accept_encoding and "Accept-Encoding" not in headers:
+            headers["Accept-Encoding"] = ACCEPT_ENCODING
+        conn, reused, pooled = pool.acquire(key, factory)
+        while True:
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                conn.request(req.get_method(), req.get_selector(),
+                    req.data, headers)
+                r = conn.getresponse()
+                break
+            except (socket.error, httplib.HTTPException), e:
+                if pooled:
+                    pool.release(key, conn, False)
+                else:
+                    conn.close()
+                if not reused:
+                    if isinstance(e, socket.error):
+                        raise URLError(e)
+                    raise
+                # the server has closed the idle connection, retry
+                # with a new connection
+                if hasattr(req.data, "seek"):
+                    # rewinds a streamed request body
+                    req.data.seek(0)
+                conn, reused, pooled = pool.acquire(key, factory, fresh=True)
+        encoding = (r.getheader("Content-Encoding") or "").strip().lower()
+        if encoding not in ("gzip", "deflate") or not self.accept_encoding:
+            encoding = None
+        transfer = Transfer(req.get_full_url(), encoding)
+        fp = PooledResponse(pool, key, conn, r, pooled, transfer)
+        if encoding:
+            fp = DecodingResponse(pool, fp, transfer)
+            # the headers describes the decoded body from here on
+            del r.msg["Content-Encoding"]
+            del r.msg["Content-Length"]
+        fp = socket._fileobject(fp, close=True)
+        resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        resp.transfer = transfer
+        return resp
+
+class KeepAliveHandler(KeepAliveMixin, urllib2.HTTPHandler):
+
+    def __init__(self, pool=None, debuglevel=0, accept_encoding=True):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+        self.accept_encoding = accept_encoding
+
+    def http_open(self, req):
+        return self._open_pooled("http", httplib.HTTPConnection, req)
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, urllib2.HTTPSHandler):
+
+    def __init__(self, pool=None, debuglevel=0, accept_encoding=True):
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
+        self.pool = pool
+        self.accept_encoding = accept_encoding
+
+    def https_open(self, req):
+        return self._open_pooled("https", httplib.HTTPSConnection, req)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import urllib2
+from difflib import SequenceMatcher
+from StringIO import StringIO
+from wikisync.metrics import METRICS
+from wikisync.util import safe_str, safe_unicode, text_digest, jsonify
+from trac.core import TracError
+from trac.util import get_reporter_id
+from trac.wiki.model import WikiPage
+from trac.wiki.web_ui import WikiModule
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# wikis whose last synchronized text is smaller are transferred whole
+DEFAULT_DELTA_MIN_SIZE = 8 * 1024
+
+# the remote servers without the delta endpoint, by url, see pull_delta()
+_UNSUPPORTED = set()
+
+def make_delta(base, text):
+    """Returns the operations rebuilding 'text' from 'base', line by line:
+    a positive int copies that number of lines of 'base', a negative int
+    skips lines of 'base', and a string is inserted as is."""
+    a = base.splitlines(True)
+    b = text.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in \
+        SequenceMatcher(None, a, b, False).get_opcodes():
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append(u"".join(b[j1:j2]))
+    return ops
+
+def apply_delta(base, ops):
+    """Returns the text rebuilt from 'base' by the operations of a delta,
+    see make_delta(). Raises a ValueError if the delta does not apply."""
+    lines = base.splitlines(True)
+    i = 0
+    result = []
+    for op in ops:
+        if isinstance(op, basestring):
+            result.append(op)
+        elif isinstance(op, bool) or not isinstance(op, (int, long)):
+            raise ValueError("Invalid delta operation %r" % (op,))
+        elif op >= 0:
+            if i + op > len(lines):
+                raise ValueError("Delta exceeds the base text")
+            result.extend(lines[i:i + op])
+            i += op
+        else:
+            i -= op
+    if i != len(lines):
+        raise ValueError("Delta does not cover the base text")
+    return u"".join(result)
+
+def read_delta(env, perm, name, version=None, base=None, base_digest=None):
+    """Returns a dict of the 'name', 'version' and 'digest' of a local
+    wiki, along with the 'delta' of its text from the 'base' version if
+    the digest of the base text matches 'base_digest', or the whole 'text'
+    otherwise. The 'version' is 0 if the wiki does not exist.
+
+    @param perm: the permission cache of the request, WIKI_VIEW is
+        required on the read versions of the wiki.
+    """
+    page = WikiPage(env, name, version or None)
+    perm(page.resource).require("WIKI_VIEW")
+    if not page.exists:
+        return {"name": name, "version": 0}
+    result = {
+        "name": name,
+        "version": page.version,
+        "digest": text_digest(page.text),
+    }
+    if base and base <= page.version:
+        old = WikiPage(env, name, base)
+        if old.exists and "WIKI_VIEW" in perm(old.resource) and \
+            text_digest(old.text) == base_digest:
+            result["base"] = base
+            result["delta"] = make_delta(old.text, page.text)
+            return result
+    result["text"] = page.text
+    return result
+
+def save_delta(env, req):
+    """Saves a wiki text posted as a json delta, see push_delta(). Returns
+    a (status, payload) tuple, where the status is 200 with the 'name' and
+    new 'remote_version' of the wiki, 409 if the wiki has changed since
+    the posted 'version', 412 if the delta does not apply to the local
+    base version, for the text to be posted whole, or 400 if the delta or
+    the resulting wiki is invalid.
+
+    Like the wiki edit form, WIKI_MODIFY is required on the wiki, or
+    WIKI_ADMIN if the wiki is read-only, and the wiki is validated by the
+    IWikiPageManipulator components. As json bodies are not checked for
+    the form token by trac, other content types are rejected with a 415.
+    """
+    ctype = (req.get_header("Content-Type") or "").split(";")[0].strip()
+    if ctype.lower() != "application/json":
+        return 415, {"error": "Content-Type application/json required"}
+    try:
+        data = json.loads(req.read())
+        name = data["name"]
+    except (ValueError, KeyError, TypeError), e:
+        return 400, {"error": "Invalid delta: %s" % e}
+    page = WikiPage(env, name)
+    if page.readonly:
+        req.perm(page.resource).require("WIKI_ADMIN")
+    else:
+        req.perm(page.resource).require("WIKI_MODIFY")
+    if page.version != data.get("version"):
+        return 409, {"error": "Wiki '%s' is at version %s" % \
+            (name, page.version)}
+    old = WikiPage(env, name, data.get("base") or None)
+    if not old.exists or text_digest(old.text) != data.get("base_digest"):
+        return 412, {"error": "Base version unavailable"}
+    try:
+        text = apply_delta(old.text, data.get("delta", ()))
+    except ValueError, e:
+        return 412, {"error": str(e)}
+    if text_digest(text) != data.get("digest"):
+        return 412, {"error": "Digest mismatch"}
+    page.text = text
+    errors = []
+    for manipulator in WikiModule(env).page_manipulators:
+        errors.extend([field and "%s: %s" % (field, message) or message
+            for field, message in manipulator.validate_wiki_page(req, page)])
+    if errors:
+        return 400, {"error": "Invalid wiki '%s': %s" % \
+            (name, "; ".join(errors))}
+    try:
+        page.save(get_reporter_id(req), data.get("comment"), req.remote_addr)
+    except TracError:
+        if page.text != page.old_text:
+            raise
+    return 200, {"name": name, "remote_version": page.version}
+
+def pull_delta(wc, name, version, base):
+    """Returns the text of a remote wiki transferred as a delta of a former
+    version, or None if the remote server cannot provide the delta, for
+    the text to be pulled whole.
+
+    @param wc: an instance of wikisync.util.WebClient.
+    @param version: the remote version to read, None for the latest.
+    @param base: a (remote version, text) tuple of the former version.
+    """
+    if wc.baseurl in _UNSUPPORTED:
+        return None
+    base_version, base_text = base
+    data = {
+        "name": name,
+        "base": base_version,
+        "base_digest": text_digest(base_text),
+    }
+    if version:
+        data["version"] = version
+    try:
+        f = wc.open("wikisync/delta", data, "GET")
+    except urllib2.HTTPError, e:
+        return _unsupported(wc, e)
+    try:
+        body = f.read()
+    finally:
+        wc._close(f)
+    with METRICS.timed("parse"):
+        response = json.loads(body)
+    if not response.get("version"):
+        return None
+    if "delta" in response:
+        text = apply_delta(safe_unicode(base_text), response["delta"])
+    else:
+        text = response.get("text", u"")
+    if text_digest(text) != response.get("digest"):
+        if wc.log:
+            wc.log.warning("Delta of wiki '%s' does not match, "
+                "pulling the whole text" % name)
+        return None
+    if "delta" in response:
+        _saved(len(safe_str(text)) - len(body), "pull")
+    return safe_unicode(text)
+
+def push_delta(wc, name, text, comments, version, base):
+    """Saves the text of a remote wiki as a delta of a former version,
+    returns a dict of the 'name' and the new 'remote_version', or None if
+    the remote server cannot apply the delta, for the text to be pushed
+    whole.
+
+    @param wc: an instance of wikisync.util.WebClient.
+    @param version: the current remote version.
+    @param base: a (remote version, text) tuple of the former version.
+    """
+    if wc.baseurl in _UNSUPPORTED or not version:
+        return None
+    base_version, base_text = base
+    body = safe_str(jsonify({
+        "name": name,
+        "version": int(version),
+        "base": base_version,
+        "base_digest": text_digest(base_text),
+        "delta": make_delta(safe_unicode(base_text), safe_unicode(text)),
+        "digest": text_digest(text),
+        "comment": wc._format_comment(comments),
+    }))
+    try:
+        f = wc.open("wikisync/delta", StringIO(body), "POST", {
+            "Content-Type": "application/json",
+            "Content-Length": str(len(body)),
+        })
+    except urllib2.HTTPError, e:
+        return _unsupported(wc, e)
+    try:
+        with METRICS.timed("parse"):
+            response = json.load(f)
+    finally:
+        wc._close(f)
+    _saved(len(safe_str(text)) - len(body), "push")
+    return {"name": name, "remote_version": int(response["remote_version"])}
+
+def _unsupported(wc, e):
+    # 404: the remote server is missing the WikiSync plugin
+    # 409: the remote wiki has changed since, handled by the edit form
+    # 412: the remote base version is unavailable
+    if e.code not in (404, 409, 412):
+        raise e
+    if e.fp is not None:
+        e.close()
+    if e.code == 404:
+        _UNSUPPORTED.add(wc.baseurl)
+    if wc.log:
+        wc.log.debug("Delta transfer unavailable on %s: %s" % \
+            (wc.baseurl, e))
+    return None
+
+def _saved(saved, transfer):
+    METRICS.count("delta_transfers", transfer=transfer)
+    METRICS.count("delta_bytes_saved", max(0, saved), transfer=transfer)
@@ -1,4 +1,7 @@
 (function() {
+	/* Columns of the json rows, in the order of WIKISYNC_TABLE_FIELDS and
+	 * WIKISYNC_EXTERNAL_FIELDS of wikisync/model.py, followed by the error
+	 * of the failed pages, see wikisync.tests.model */
 	var MODEL_KEYS = [
 		'name', 
 		'ignore', 
@@ -6,10 +9,18 @@
         'sync_time', 
         'sync_remote_version', 
         'sync_local_version',
-        'remote_version', 
-        'local_version', 
-        'status'
+        'remote_version',
+        'sync_local_digest',
+        'sync_remote_digest',
+        'remote_digest',
+        'local_version',
+        'status',
+        'error'
     ];
+
+    /* Milliseconds between the reads of the progress of the queued jobs,
+     * the pages are synchronized by a background runner of the server */
+    var JOBS_POLL_INTERVAL = 1000;
     
     var TREE_NODE_TEMPLATE = 
 		'<li id="<%- cid %>" class="<%- status %>">' +
@@ -59,7 +70,7 @@
 		'	<div class="wikisync-modal-overlay">&nbsp;</div>' +
 		'	<div class="wikisync-modal-panel">' +
 		'		<h2>Synchronization in progress..</h2>' +
-		'		<p>Do not close this window during synchronization.</p>' +
+		'		<p>The synchronization continues on the server if this window is closed.</p>' +
 		'		<textarea></textarea>' +
 		'		<p style="text-align:right"><input type="button" value="Stop Synchronization" /></p>' +
 		'	</div>' +
@@ -173,12 +184,6 @@
 		return base + encodeURI(_.rest(arguments).join('/'));
 	};
 	
-	var isRegExp = function(str) {
-		return _.detect('^$.()[]|'.split(''), function(c) {
-			return str.indexOf(c) >= 0;
-		}) != undefined;
-	}
-	
    	var pad = function(n) {
    		return n < 10 ? '0' + n : n;
    	}
@@ -197,6 +202,7 @@
     
     /* Represents a wiki synchronization state */
 	var WikiSyncModel = Backbone.Model.extend({
+		idAttribute: 'name',
 		defaults: {
 			resolve: 'skip',
 			status: 'unknown',
@@ -220,45 +226,202 @@
 		formToken: null,
 		initialize: function(models, opts) {
 			this.url = opts.url;
+			this.listUrl = opts.listUrl;
+			this.summaryUrl = opts.summaryUrl;
+			this.jobsUrl = opts.jobsUrl;
+			this.pageSize = opts.pageSize || 200;
+			this.query = null;
+			this.loaded = 0;
+			this.total = 0;
 		},
 		comparator: function(model) {
 			/* Always sort by name */
 			return model.get('name');
 		},
-		sync: function(model, resolveAs) {
+		load: function(query, callback) {
+			/* Loads the next page of models matching the query,
+			 * a different query replaces the loaded models */
+			var self = this,
+				reset = !_.isEqual(query, this.query),
+				offset = reset ? 0 : this.loaded,
+				seq;
+			if (!reset && (this.loading || !this.hasMore())) {
+				return false;
+			}
+			seq = this.loadSeq = (this.loadSeq || 0) + 1;
+			this.query = query;
+			this.loading = true;
+			$.ajax({
+				url: this.listUrl,
+				type: 'GET',
+				dataType: 'json',
+				traditional: true,
+				data: $.extend({ offset:offset, limit:this.pageSize }, query),
+				success: function(data) {
+					if (seq != self.loadSeq) return;
+					var items = _.reject(data.items, function(item) {
+						/* already loaded, the listing has changed since */
+						return !reset && self.get(item[0]);
+					});
+					if (reset) {
+						self.reset(items, { parse:true, silent:true });
+					} else {
+						self.add(items, { parse:true, silent:true });
+					}
+					self.loaded = offset + data.items.length;
+					self.total = data.total;
+					self.trigger('load', self);
+				},
+				complete: function(xhr, status) {
+					if (seq != self.loadSeq) return;
+					self.loading = false;
+					if (callback) {
+						callback(status == 'success');
+					}
+				}
+			});
+			return true;
+		},
+		loadAll: function(callback) {
+			/* Loads the remaining pages of the current query */
+			var self = this;
+			if (this.loading) {
+				_.delay(function() {
+					self.loadAll(callback);
+				}, 100);
+			} else if (!this.hasMore()) {
+				callback(true);
+			} else {
+				this.load(this.query, function(success) {
+					if (success) {
+						self.loadAll(callback);
+					} else {
+						callback(false);
+					}
+				});
+			}
+		},
+		hasMore: function() {
+			return this.query === null || this.loaded < this.total;
+		},
+		summary: function(callback) {
+			/* Reads the number of pages by status */
+			if (!this.summaryUrl) return;
+			$.ajax({
+				url: this.summaryUrl,
+				type: 'GET',
+				dataType: 'json',
+				success: callback
+			});
+		},
+		action: function(model, resolveAs) {
 			if (!_.isString(resolveAs)) {
 				resolveAs = model.get('status');
 			}
-			var action;
 			switch(resolveAs) {
 				case 'new':
 				case 'modified':
-					action = 'push';
-					break;
+					return 'push';
 				case 'missing':
 				case 'outdated':
-					action = 'pull';
-					break;
+					return 'pull';
 				default:
-					action = 'refresh';
+					return 'refresh';
 			}
-			var data = [
-				{ name:'name', value:model.get('name') },
-				{ name:'action', value:action }
-			];
-			this._post({ 
-				data:data,
-				beforeSend: function() {
+		},
+		queue: function(tasks, callback) {
+			/* Queues the synchronization of the pages as jobs of the server,
+			 * 'tasks' maps the actions to the models. The callback receives
+			 * the 'since' time of the queued jobs, or null on error */
+			var self = this,
+				actions = _.keys(tasks),
+				since = null;
+			var next = function() {
+				var action = actions.shift();
+				if (!action) {
+					callback(since);
+					return;
+				}
+				var data = _.map(tasks[action], function(model) {
 					model.trigger('progress', model);
-				},
-				complete: function(xhr, status) {
-					if (status == 'error') {
-						model.set({ error:xhr.responseText });
+					return { name:'name', value:model.get('name') };
+				});
+				data.push({ name:'action', value:action });
+				self._postJobs(data, function(status) {
+					if (!status) {
+						callback(null);
+						return;
 					}
-					model.trigger('complete', model, status, action);
+					if (since === null) {
+						since = status.since;
+					}
+					next();
+				});
+			};
+			next();
+		},
+		jobs: function(since, callback) {
+			/* Reads the progress of the queued jobs, the models of the jobs
+			 * completed since the 'since' time are updated and trigger the
+			 * 'complete' event. The callback receives the progress, or null
+			 * on error */
+			var self = this;
+			$.ajax({
+				url: this.jobsUrl,
+				type: 'GET',
+				dataType: 'json',
+				data: since ? { since:since } : {},
+				success: function(status) {
+					_.each(status.jobs || [], function(job) {
+						var model = job.item ? self._update(job.item) : self.get(job.name);
+						if (!model) {
+							/* not listed, the event is triggered by the collection */
+							model = new WikiSyncModel({ name:job.name });
+						}
+						if (job.error) {
+							model.set({ error:job.error });
+						}
+						(model.collection ? model : self).trigger('complete', model,
+							job.error ? 'error' : 'success', job.action);
+					});
+					callback(status);
+				},
+				error: function() {
+					callback(null);
 				}
 			});
 		},
+		cancel: function(callback) {
+			/* Removes the queued jobs not yet started */
+			this._postJobs([{ name:'action', value:'cancel' }], callback);
+		},
+		_postJobs: function(data, callback) {
+			data.push({ name:'__FORM_TOKEN', value:this.formToken });
+			$.ajax({
+				url: this.jobsUrl,
+				type: 'POST',
+				dataType: 'json',
+				data: data,
+				success: function(status) {
+					if (callback) callback(status);
+				},
+				error: function() {
+					if (callback) callback(null);
+				}
+			});
+		},
+		_update: function(item) {
+			/* Updates the model of a json row, returns the model */
+			var model = this.get(item[0]);
+			if (model) {
+				model.unset('error', { silent:true });
+				model.set(model.parse(item));
+			} else {
+				this.add([item], { parse:true });
+				model = this.get(item[0]);
+			}
+			return model;
+		},
 		ignore: function(models, isIgnore) {
 			if (!models || !models.length) return;
 			var self = this;
@@ -292,26 +455,13 @@
 				opts.data.push({ name:'__FORM_TOKEN', value:this.formToken });
 			}
 			var self = this;
-			var map = this.reduce(function(memo, model) {
-				memo[model.get('name')] = model;
-				return memo;
-			}, {});
 			$.ajax(
 				$.extend({
 					url: this.url,
 					type: 'POST',
 					dataType: 'json',
 					success: function(data, status, xhr) {
-						_.each(data, function(item) {
-							var name = item[0];
-							var model = map[name];
-							if (model) {
-								model.unset('error', { silent:true });
-								model.set(model.parse(item));
-							} else {
-								self.add([data], { parse:true });
-							}
-						});
+						_.each(data, self._update, self);
 					}
 				}, opts)
 			);
@@ -390,36 +540,46 @@
 			this.$form = this.$('#wikisync-form');
 			this.$list = this.$('#wikisync-list');
 			this.$empty = this.$('#wikisync-empty');
+			this.$loading = this.$('#wikisync-loading');
 			this.collection.formToken = this.$form.find('input[name~=__FORM_TOKEN]').val();
 			this.collection.bind('all', this.onCollectionEvent);
+			this.collection.bind('load', this.onLoad);
+			$(window).bind('scroll', this.onScroll);
 		},
 		render: function() {
-			this.renderTree();
+			this.reload();
+			this.resume();
 			return this;
 		},
+		reload: function() {
+			/* Replaces the listing with the pages matching the filter */
+			this.$loading.show();
+			this.collection.load(this.filterQuery());
+			return this;
+		},
+		filterQuery: function() {
+			/* Listing parameters of the filter options */
+			var status = ['unknown'],
+				prefix = $.trim(this.$('#filter-text').val()),
+				$input;
+			this.$('input.filter').each(function() {
+				$input = $(this);
+				if ($input.is(':checked') && !_.include(status, $input.val())) {
+					status.push($input.val());
+				}
+			});
+			return prefix ? { status:status, prefix:prefix } : { status:status };
+		},
 		renderTree: function(force, includeModels) {
 			if (force) {
 				this.filterHash = '__refresh__';
 			}
-			var filterKeys = { 'unknown':true },
-				filterKeyword = this.$('#filter-text').val(),
-				filterModels = {},
-				filterRegExp, $input, name;
-			if (filterKeyword) {
-				if (isRegExp(filterKeyword)) {
-					try {
-						filterRegExp = new RegExp(filterKeyword);
-					} catch(err) {
-						/* ignore */
-					}
-				}
-				filterKeyword = filterKeyword.toUpperCase();
-			}
-			this.$('input.filter').each(function() {
-				$input = $(this);
-				if ($input.is(':checked')) {
-					filterKeys[$input.val()] = true;
-				}
+			var query = this.filterQuery(),
+				filterKeys = {},
+				filterKeyword = query.prefix ? query.prefix.toUpperCase() : '',
+				filterModels = {};
+			_.each(query.status, function(status) {
+				filterKeys[status] = true;
 			});
 			if (_.isArray(includeModels)) {
 				_.each(includeModels, function(model) {
@@ -431,14 +591,9 @@
 					return true;
 				}
 				if (filterKeys[model.get('status')]) {
-					if (filterKeyword) {
-						name = model.get('name');
-						if (filterRegExp) {
-							return filterRegExp.exec(name);
-						}
-						return name.toUpperCase().indexOf(filterKeyword) >= 0; 
-					}
-					return true;
+					/* matches the listing filter of the server */
+					return !filterKeyword ||
+						model.get('name').toUpperCase().indexOf(filterKeyword) == 0;
 				}
 				return false;
 			});
@@ -448,7 +603,7 @@
 			if (filterHash != this.filterHash) {
 				/* avoid expensive redraw by comparing filterHash */
 				var tree = groupByModelNameHierachy(filtered);
-				var hint = '<i class="hint">Displaying ' + filtered.length + ' of ' + this.collection.length + ' pages</i>';
+				var hint = '<i class="hint">Displaying ' + filtered.length + ' of ' + this.collection.total + ' pages</i>';
 				if (tree.length) {
 					tree = [['Everything ' + hint, tree]];
 					var content = _.map(tree, function(child) {
@@ -493,55 +648,99 @@
 		},
 		sync: function(bool) {
 			if (_.isUndefined(bool)) {
-				bool = !_.isArray(this.syncPending);
+				bool = !this.syncing;
 			}
-			if (bool == _.isArray(this.syncPending)) {
+			if (bool == !!this.syncing) {
 				return this;
 			}
 			if (!bool) {
-				this.syncPending = null;
+				/* the running jobs are completed by the server */
+				this.syncing = false;
+				this.collection.cancel();
+			} else if (this.collection.hasMore()) {
+				/* every page matching the filter must be listed */
+				var self = this;
+				this.loadingAll = true;
+				this.$loading.show();
+				this.collection.loadAll(function(success) {
+					self.loadingAll = false;
+					self.$loading.hide();
+					self.renderTree();
+					if (success) {
+						self.sync(true);
+					}
+				});
 			} else {
 				var collection = this.collection,
-					pending = [],
+					tasks = {},
+					count = 0,
 					resolveConflict = this.resolveConflict,
-					$el, model;
+					$el, model, resolveAs, action;
 				this.$list.find('li').each(function() {
 					$el = $(this);
 					if ($el.is('.grouped,.ignored,.synced')) {
 						return true;
 					}
 					model = collection.getByCid($el.attr('id'));
-					if (!model || (model.get('status') == 'conflict' && resolveConflict(model) == 'skip')) {
+					if (!model) {
 						return true;
 					}
-					pending.push(model);
+					resolveAs = undefined;
+					if (model.get('status') == 'conflict') {
+						resolveAs = resolveConflict(model);
+						if (resolveAs == 'skip') {
+							return true;
+						}
+					}
+					action = collection.action(model, resolveAs);
+					(tasks[action] = tasks[action] || []).push(model);
+					count++;
 				});
-				if (!pending.length) {
+				if (!count) {
 					alert('Nothing to synchronize! Please edit your filter options.');
 				} else {
-					this.syncPending = pending;
-					this.syncNext();
+					var self = this;
+					this.syncing = true;
+					this.progressHandler('start', null, null, count + ' pages queued.');
+					this.collection.queue(tasks, function(since) {
+						if (since === null) {
+							self.progressHandler('interrupt', null, null, 'Unable to queue the pages.');
+						} else {
+							self.poll(since);
+						}
+					});
 				}
 			}
 			return this;
 		},
-		syncNext: function() {
-			var model = this.syncPending ? this.syncPending.shift() : null;
-			if (!model) {
-				this.syncPending = null;
-				return false;
-			} else {
-				var resolveAs;
-				if (model.get('status') == 'conflict') {
-					resolveAs = $('#filter-conflict-resolve').val() || model.get('resolve');
-					if (resolveAs == 'skip') {
-						this.syncNext();
-						return this;
-					}
+		resume: function() {
+			/* Follows the jobs left by a previous visit of the page */
+			var self = this;
+			this.collection.jobs(null, function(status) {
+				var count = status ? status.pending + status.running : 0;
+				if (count && !self.syncing) {
+					self.syncing = true;
+					self.progressHandler('start', null, null, 'Resuming the synchronization of ' +
+						count + ' queued pages.');
+					self.poll(status.since);
 				}
-				this.collection.sync(model, resolveAs);
-				return model;
-			}
+			});
+			return this;
+		},
+		poll: function(since) {
+			/* Reads the progress of the jobs until none remains */
+			var self = this;
+			if (!this.syncing) return;
+			this.collection.jobs(since, function(status) {
+				if (!self.syncing) return;
+				if (!status) {
+					self.progressHandler('interrupt', null, null, 'Unable to read the progress.');
+				} else if (status.pending + status.running > 0) {
+					_.delay(self.poll, JOBS_POLL_INTERVAL, status.since);
+				} else {
+					self.progressHandler('done');
+				}
+			});
 		},
 		resolveConflict: function(model) {
 			if (model.get('status') == 'conflict') {
@@ -590,16 +789,28 @@
 			this.changedModels = null;
 			return this;
 		},
-		progressHandler: function(state, model, action) {
-			if (!this.syncPending) return;
+		renderSummary: function() {
+			var $el = this.$el;
+			this.collection.summary(function(summary) {
+				_.each(summary, function(count, status) {
+					$el.find('.wikisync-form-list li.' + status + ' .count')
+						.text('(' + count + ')');
+				});
+			});
+			return this;
+		},
+		progressHandler: function(state, model, action, text) {
+			if (!this.syncing) return;
 			var complete = false,
-				message, alertMessage;
+				message = text, alertMessage;
 			if (!this.$progress) {
 				this.$progress = $(PROGRESS_PANEL_TEMPLATE).appendTo(this.$el);
-				this.errorCount = 0;
 				this.$el.css({ overflow:'hidden' });
 			}
-			if (state == 'error') {
+			if (state == 'start') {
+				this.errorCount = 0;
+				this.$progress.find('input[type="button"]').val('Stop Synchronization');
+			} else if (state == 'error') {
 				this.errorCount++;
 				message = 'ERROR: ' + model.get('name') + ' cannot be sync due to the following reason:\n' +
 					'    "' + model.get('error') + '".';
@@ -623,34 +834,34 @@
 					default:
 						message += ' is successfully synced.';
 				}
+			} else if (state == 'done') {
+				alertMessage = 'Synchronization complete.';
+				this.syncing = false;
+				complete = true;
 			} else if (state == 'interrupt') {
 				complete = true;
 				this.sync(false);
-				message = 'Interrupted';
+				message = message || 'Interrupted';
 			} else {
 				return this;
 			}
 			
-			if (!complete && !this.syncNext()) {
-				alertMessage = 'Synchronization complete.';
-				this.sync(false);
-				complete = true;
-			}
 			if (complete) {
 				this.$progress.find('input[type="button"]').val('Close');
+				this.renderSummary();
 			}
 			if (alertMessage) {
 				_.defer(function() {
 					alert(alertMessage);
 				});
 			}
-			if (message) {
-				message = '[' + formatDate() + '] ' + message;
+			if (message || alertMessage) {
+				message = message ? '[' + formatDate() + '] ' + message + '\n' : '';
 				if (alertMessage) {
-					message += '\n[' + formatDate() + '] ' + alertMessage;
+					message += '[' + formatDate() + '] ' + alertMessage + '\n';
 				}
 				var $textarea = this.$progress.find('textarea');
-				$textarea.val($textarea.val() + message + '\n');
+				$textarea.val($textarea.val() + message);
 				$textarea.attr('scrollTop', $textarea.attr('scrollHeight'));
 			}
 			return this;
@@ -679,7 +890,25 @@
 		},
 		onSync: function(evt) {
 			evt.preventDefault();
-			this.sync(!this.syncPending);
+			if (!this.loadingAll) {
+				this.sync(!this.syncing);
+			}
+		},
+		onLoad: function() {
+			if (this.loadingAll) return;
+			this.$loading.hide();
+			this.renderTree();
+			/* keeps loading until the window is filled */
+			this.onScroll();
+		},
+		onScroll: function() {
+			var $window = $(window),
+				bottom = this.$list.offset().top + this.$list.outerHeight();
+			if (!this.loadingAll && !this.collection.loading && this.collection.hasMore() &&
+				$window.scrollTop() + $window.height() > bottom - 200) {
+				this.$loading.show();
+				this.collection.load(this.collection.query);
+			}
 		},
 		onFilter: function(evt) {
 			var $el = $(evt.target);
@@ -688,7 +917,7 @@
 			} else {
 				$el.parent().removeClass('selected');
 			}
-			this.renderTree();
+			this.reload();
 		},
 		onFilterTextChange: function(evt) {
 			if (!this.filterLater) {
@@ -696,14 +925,14 @@
 				this.filterLater = _.debounce(function() {
 					if (self.filterPending) {
 						self.filterPending = false;
-						self.renderTree();
+						self.reload();
 					}
 				}, 1000);
 			}
 			if (evt.keyCode == 13) {
 				evt.preventDefault();
 				this.filterPending = false;
-				this.renderTree();
+				this.reload();
 			} else {
 				this.filterPending = true;
 				this.filterLater();
@@ -713,7 +942,7 @@
 			evt.preventDefault();
 			this.$('#filter-text').val('');
 			this.filterPending = false;
-			this.renderTree();
+			this.reload();
 		},
 		onListOver: function(evt) {
 			var $el = $(evt.target);
@@ -813,7 +1042,7 @@
 			}
 		},
 		onProgressClick: function(evt) {
-			if (this.syncPending) {
+			if (this.syncing) {
 				this.progressHandler('interrupt');
 			} else {
 				if (this.$progress) {
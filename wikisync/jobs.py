@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+import threading, time
+from collections import namedtuple
+from itertools import groupby
+from wikisync.batch import BatchSync, BATCH_ACTIONS, DEFAULT_CONCURRENCY
+from wikisync.model import WikiSyncDao
+from wikisync.util import safe_unicode
+
+JOB_STATES = ("pending", "running", "done", "failed")
+
+# number of jobs claimed at a time by a runner, the time limit of a run is
+# checked between claims
+CLAIM_SIZE = 20
+
+# number of attempts before a job is marked as failed
+MAX_ATTEMPTS = 3
+
+# seconds before a failed attempt is retried
+RETRY_DELAY = 30
+
+# seconds before a running job is considered abandoned, e.g. by a crashed
+# runner, and claimed again
+DEFAULT_LEASE = 300
+
+# seconds completed jobs are kept for the throughput statistics
+DEFAULT_RETENTION = 86400
+
+# seconds of completed jobs included in the throughput
+THROUGHPUT_WINDOW = 300
+
+# seconds without edits before an edited page is pushed, see AutoPush
+DEFAULT_AUTOPUSH_DELAY = 10
+
+# status of the edited pages pushed automatically, conflicts are left to
+# be resolved
+AUTOPUSH_STATUSES = ("modified", "new")
+
+_FIELDS = ("id", "name", "action", "state", "attempts", "error", "author",
+    "ipnr", "created", "updated")
+
+_SELECT_SQL = "SELECT %s FROM wikisync_job" % ",".join(_FIELDS)
+
+class Job(namedtuple("Job", _FIELDS)):
+    """Represents a queued synchronization of a single page"""
+
+    __slots__ = ()
+
+def _now():
+    # microseconds, as per the trac int64 time columns
+    return int(time.time() * 1000000)
+
+def _seconds(value):
+    return int(value * 1000000)
+
+class JobQueue(object):
+    """Persistence interface of the synchronization jobs.
+
+    A job is 'pending' until claimed by a runner, 'running' until the
+    transfer completes, then 'done', or 'pending' again if the attempt
+    failed, until 'failed' after MAX_ATTEMPTS. Running jobs not completed
+    within the lease, e.g. when the runner has crashed, are claimed again.
+    """
+
+    def __init__(self, env):
+        self.env = env
+
+    def enqueue(self, tasks, author=None, ipnr=None):
+        """Adds jobs for the (name, action) tasks, returns the number of jobs
+        added. Pages with a pending or running job are not added again."""
+        for name, action in tasks:
+            if action not in BATCH_ACTIONS:
+                raise ValueError("Unsupported action '%s'" % action)
+        result = []
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT name FROM wikisync_job
+                WHERE state IN ('pending', 'running')
+            """)
+            active = set([row[0] for row in cursor])
+            now = _now()
+            rows = []
+            for name, action in tasks:
+                if name not in active:
+                    active.add(name)
+                    rows.append((name, action, "pending", 0, author, ipnr,
+                        now, now))
+            cursor.executemany("""
+                INSERT INTO wikisync_job(name, action, state, attempts,
+                    author, ipnr, created, updated)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, rows)
+            result.append(len(rows))
+        return result[0]
+
+    def claim(self, limit=CLAIM_SIZE, lease=DEFAULT_LEASE):
+        """Marks up to 'limit' jobs as running and returns them, in the
+        order they were queued. Each job is claimed by a conditional update,
+        jobs claimed concurrently by another runner are left out."""
+        now = _now()
+        claimed = []
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.execute(_SELECT_SQL + """
+                WHERE (state='pending' AND (attempts=0 OR updated<=%s))
+                OR (state='running' AND updated<=%s)
+                ORDER BY id LIMIT %s
+            """, (now - _seconds(RETRY_DELAY), now - _seconds(lease),
+                int(limit)))
+            for row in cursor.fetchall():
+                job = Job(*row)
+                cursor.execute("""
+                    UPDATE wikisync_job SET state='running',
+                        attempts=attempts+1, updated=%s
+                    WHERE id=%s AND state=%s AND updated=%s
+                """, (now, job.id, job.state, job.updated))
+                if cursor.rowcount > 0:
+                    claimed.append(job._replace(state="running",
+                        attempts=job.attempts + 1, updated=now))
+        return claimed
+
+    def renew(self, jobs):
+        """Extends the lease of the running jobs, unless claimed again
+        since, see claim()"""
+        now = _now()
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.executemany("""
+                UPDATE wikisync_job SET updated=%s
+                WHERE id=%s AND state='running' AND attempts=%s
+            """, [(now, job.id, job.attempts) for job in jobs])
+
+    def next_retry(self):
+        """Returns the time, in seconds, the first of the failed attempts
+        waiting for RETRY_DELAY can be claimed again, or None if there is
+        none"""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT MIN(updated) FROM wikisync_job
+            WHERE state='pending' AND attempts>0
+        """)
+        updated = cursor.fetchone()[0]
+        if updated is None:
+            return None
+        return updated / 1000000.0 + RETRY_DELAY
+
+    def complete(self, job):
+        self._set_state(job, "done", None)
+
+    def fail(self, job, error, max_attempts=MAX_ATTEMPTS):
+        """Records the error, the job is retried unless the maximum number
+        of attempts is reached."""
+        self._set_state(job, job.attempts < max_attempts and "pending" \
+            or "failed", safe_unicode(error))
+
+    def _set_state(self, job, state, error):
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE wikisync_job SET state=%s, error=%s, updated=%s
+                WHERE id=%s
+            """, (state, error, _now(), job.id))
+
+    def list(self, states=("pending", "running")):
+        """Returns the jobs of the states, by default the jobs that are
+        not completed"""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute(_SELECT_SQL + " WHERE state IN (%s) ORDER BY id" % \
+            ",".join(["%s"] * len(states)), states)
+        return [Job(*row) for row in cursor]
+
+    def changes(self, since):
+        """Returns the jobs updated after the time 'since', in microseconds,
+        in the order they were updated"""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute(_SELECT_SQL + " WHERE updated>%s ORDER BY updated, id",
+            (int(since),))
+        return [Job(*row) for row in cursor]
+
+    def cancel(self):
+        """Removes the pending jobs, returns the number of jobs removed.
+        The running jobs are completed."""
+        result = []
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM wikisync_job WHERE state='pending'")
+            result.append(cursor.rowcount)
+        return result[0]
+
+    def status(self):
+        """Returns a dict of the number of jobs by state, with the
+        'throughput' of the jobs completed within THROUGHPUT_WINDOW in
+        jobs per second, and the estimated seconds to complete the
+        remaining jobs as 'eta'."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT state, COUNT(*) FROM wikisync_job GROUP BY state
+        """)
+        status = dict.fromkeys(JOB_STATES, 0)
+        status.update(dict(cursor.fetchall()))
+        now = _now()
+        cursor.execute("""
+            SELECT COUNT(*), MIN(updated) FROM wikisync_job
+            WHERE state IN ('done', 'failed') AND updated>%s
+        """, (now - _seconds(THROUGHPUT_WINDOW),))
+        count, since = cursor.fetchone()
+        throughput = 0.0
+        if count:
+            throughput = count * 1000000.0 / max(now - since, 1000000)
+        status["throughput"] = round(throughput, 3)
+        status["eta"] = None
+        if throughput:
+            status["eta"] = int((status["pending"] + status["running"]) / \
+                throughput)
+        return status
+
+    def purge(self, retention=DEFAULT_RETENTION):
+        """Removes the completed jobs older than 'retention' seconds"""
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                DELETE FROM wikisync_job
+                WHERE state IN ('done', 'failed') AND updated<%s
+            """, (_now() - _seconds(retention),))
+
+class JobRunner(object):
+    """Runs the queued jobs with BatchSync, checkpointing the state of each
+    job as soon as its page is synchronized, so that an interrupted run is
+    resumed without repeating the completed transfers.
+
+    The lease of the claimed jobs is renewed by the checkpoints, a slow
+    batch is not claimed again by another runner. Setting the 'wakeup'
+    event ends the wait for the retries of the failed attempts, e.g. when
+    jobs are queued.
+    """
+
+    def __init__(self, env, client, concurrency=DEFAULT_CONCURRENCY,
+        log=None):
+        """
+        @param env: the trac environment.
+        @param client: an instance of wikisync.util.WebClient.
+        @param concurrency: maximum number of concurrent remote requests.
+        @param log: optional logger, defaults to env.log.
+        """
+        self.env = env
+        self.log = log or env.log
+        self.queue = JobQueue(env)
+        self.batch = BatchSync(env, client, concurrency, self.log)
+        self.wakeup = threading.Event()
+
+    def run(self, deadline=None, callback=None, retry=True):
+        """Runs jobs until the queue is empty, or the 'deadline' time is
+        reached, returns the number of jobs processed.
+
+        @param callback: optional callable, invoked with each
+            wikisync.batch.BatchResult.
+        @param retry: True to wait for the retries of the failed attempts,
+            after RETRY_DELAY, False to leave them to the next run.
+        """
+        self.queue.purge()
+        processed = 0
+        while not deadline or time.time() < deadline:
+            jobs = self.queue.claim(CLAIM_SIZE)
+            if not jobs:
+                due = retry and self.queue.next_retry()
+                if not due or (deadline and due >= deadline):
+                    break
+                self.wakeup.wait(max(0, due - time.time()))
+                self.wakeup.clear()
+                continue
+            running = dict([(job.id, job) for job in jobs])
+            renewed = [time.time()]
+            key = lambda job: (job.author, job.ipnr)
+            for (author, ipnr), group in groupby(sorted(jobs, key=key), key):
+                group = dict([(job.name, job) for job in group])
+                def checkpoint(result):
+                    job = running.pop(group[result.name].id)
+                    if result.ok:
+                        self.queue.complete(job)
+                    else:
+                        self.queue.fail(job, result.error)
+                    if running and \
+                        time.time() - renewed[0] > DEFAULT_LEASE / 3:
+                        self.queue.renew(running.values())
+                        renewed[0] = time.time()
+                    if callback:
+                        callback(result)
+                self.batch.run([(job.name, job.action)
+                    for job in sorted(group.values())],
+                    author, ipnr, checkpoint)
+                processed += len(group)
+        return processed
+
+# background runners, as a (thread, JobRunner) tuple by environment path
+_RUNNERS = {}
+_RUNNERS_LOCK = threading.Lock()
+
+def start_runner(env, client_factory, concurrency=DEFAULT_CONCURRENCY,
+    log=None):
+    """Runs the queued jobs in a background thread, unless a runner is
+    already active for the environment, which is woken up to run the jobs
+    queued since. Returns True if a runner is started.
+
+    @param client_factory: callable returning the WebClient of the runner,
+        the client is closed when the runner completes.
+    """
+    with _RUNNERS_LOCK:
+        active = _RUNNERS.get(env.path)
+        if active and active[0].isAlive():
+            active[1].wakeup.set()
+            return False
+        client = client_factory()
+        log = log or env.log
+        runner = JobRunner(env, client, concurrency, log)
+        def run():
+            try:
+                runner.run()
+            except Exception, e:
+                log.exception(e)
+            finally:
+                client.close()
+                with _RUNNERS_LOCK:
+                    if _RUNNERS.get(env.path, (None,))[0] is thread:
+                        del _RUNNERS[env.path]
+        thread = threading.Thread(target=run, name="wikisync-jobs")
+        thread.setDaemon(True)
+        _RUNNERS[env.path] = (thread, runner)
+        thread.start()
+        return True
+
+class AutoPush(object):
+    """Pushes the locally edited pages once they have not been edited for
+    'delay' seconds, successive edits of a page result in a single push.
+
+    The edits are collected in memory by schedule(), the pushes of the due
+    pages are queued as jobs, and run by a JobRunner from a background
+    thread, away from the requests saving the wikis. The thread stops when
+    no page remains to push.
+    """
+
+    def __init__(self, env, client_factory, delay=DEFAULT_AUTOPUSH_DELAY,
+        concurrency=DEFAULT_CONCURRENCY, log=None):
+        """
+        @param env: the trac environment.
+        @param client_factory: callable returning the WebClient of a run,
+            the client is closed when the run completes.
+        @param delay: seconds without edits before a page is pushed.
+        @param concurrency: maximum number of concurrent remote requests.
+        @param log: optional logger, defaults to env.log.
+        """
+        self.env = env
+        self.client_factory = client_factory
+        self.delay = delay
+        self.concurrency = concurrency
+        self.log = log or env.log
+        self.queue = JobQueue(env)
+        self._due = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, name, now=None):
+        """Pushes the page after 'delay' seconds, unless it is edited again
+        in the meantime"""
+        with self._cond:
+            self._due[name] = (now or time.time()) + self.delay
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                    name="wikisync-autopush")
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+
+    def pending(self):
+        """Returns the names of the pages waiting to be pushed"""
+        with self._cond:
+            return sorted(self._due)
+
+    def flush(self, now=None):
+        """Queues the pushes of the pages due by 'now', returns the number
+        of jobs queued. Pages being pushed are pushed again later."""
+        now = now or time.time()
+        with self._cond:
+            due = sorted([name for name, t in self._due.items() if t <= now])
+            for name in due:
+                del self._due[name]
+        if not due:
+            return 0
+        running = set([job.name for job in self.queue.list(("running",))])
+        for name in due:
+            if name in running:
+                with self._cond:
+                    self._due.setdefault(name, now + self.delay)
+        dao = WikiSyncDao(self.env)
+        items = [dao.find(name) for name in due if name not in running]
+        return self.queue.enqueue([(item.name, "push") for item in items
+            if item and item.status in AUTOPUSH_STATUSES])
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._due:
+                    self._thread = None
+                    return
+                wait = min(self._due.values()) - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+            try:
+                if self.flush():
+                    client = self.client_factory()
+                    try:
+                        JobRunner(self.env, client, self.concurrency,
+                            self.log).run()
+                    finally:
+                        client.close()
+            except Exception, e:
+                self.log.exception(e)
+
+# automatic pushes, by environment path
+_AUTOPUSH = {}
+_AUTOPUSH_LOCK = threading.Lock()
+
+def get_autopush(env, client_factory, delay=DEFAULT_AUTOPUSH_DELAY,
+    concurrency=DEFAULT_CONCURRENCY, log=None):
+    """Returns the AutoPush of the environment, shared by the process"""
+    with _AUTOPUSH_LOCK:
+        autopush = _AUTOPUSH.get(env.path)
+        if autopush is None:
+            autopush = _AUTOPUSH[env.path] = AutoPush(env, client_factory,
+                delay, concurrency, log)
+        autopush.delay = delay
+        autopush.concurrency = concurrency
+        return autopush
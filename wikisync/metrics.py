@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import threading, time
+from bisect import bisect_left
+from functools import wraps
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    30.0)
+
+# seconds of observations included in the histograms
+DEFAULT_WINDOW = 300
+
+# the window is divided in slots, observations expire a slot at a time
+WINDOW_SLOTS = 10
+
+# timed phases of a synchronization, 'http' is the time to the remote
+# response headers, 'parse' includes reading the response body, 'page' is
+# the complete synchronization of a page within a 'batch', 'scan' a refresh
+# of the remote states of all pages
+PHASES = ("http", "parse", "db", "wiki_save", "page", "batch", "scan")
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+class RollingHistogram(object):
+    """Counts observations by bucket over the last 'window' seconds"""
+
+    def __init__(self, window=DEFAULT_WINDOW, buckets=BUCKETS):
+        self.window = window
+        self.buckets = buckets
+        # slot number => bucket counts, the last item is the sum
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, now=None):
+        slot = self._slot(now)
+        with self._lock:
+            self._expire(slot)
+            data = self._slots.get(slot)
+            if data is None:
+                data = self._slots[slot] = [0] * (len(self.buckets) + 1) + \
+                    [0.0]
+            data[bisect_left(self.buckets, value)] += 1
+            data[-1] += value
+
+    def snapshot(self, now=None):
+        """Returns a dict of the 'count', 'sum', the cumulative 'buckets'
+        counts as (upper bound, count) tuples, and the estimated quantiles
+        as 'p50', 'p90' and 'p99' (the upper bound of the bucket)"""
+        slot = self._slot(now)
+        with self._lock:
+            self._expire(slot)
+            totals = [0] * (len(self.buckets) + 2)
+            for data in self._slots.values():
+                for i, value in enumerate(data):
+                    totals[i] += value
+        total = 0
+        buckets = []
+        for bound, count in zip(self.buckets + (float("inf"),), totals):
+            total += count
+            buckets.append((bound, total))
+        snapshot = {"count": total, "sum": round(totals[-1], 6),
+            "buckets": buckets}
+        for q in QUANTILES:
+            value = None
+            for bound, count in buckets:
+                if total and count >= q * total:
+                    value = bound != float("inf") and bound or \
+                        self.buckets[-1]
+                    break
+            snapshot["p%d" % (q * 100)] = value
+        return snapshot
+
+    def _slot(self, now):
+        return int((now or time.time()) * WINDOW_SLOTS / self.window)
+
+    def _expire(self, slot):
+        for key in self._slots.keys():
+            if key <= slot - WINDOW_SLOTS:
+                del self._slots[key]
+
+class PageTrace(object):
+    """Collects the phase timings and counters of a single page
+    synchronization, which may be recorded by several threads in turn"""
+
+    def __init__(self, name, action):
+        self.name = name
+        self.action = action
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+
+    def as_dict(self, ok=True):
+        return {
+            "name": self.name,
+            "action": self.action,
+            "ok": ok,
+            "elapsed": round(time.time() - self.started, 6),
+            "phases": dict([(k, round(v, 6))
+                for k, v in self.phases.items()]),
+            "counters": dict(self.counters),
+        }
+
+class Metrics(object):
+    """Process wide registry of the synchronization timings and counters.
+
+    Counters are cumulative since the process started, timings are kept
+    in RollingHistogram by phase. The timings and counters are also added
+    to the PageTrace of the current thread, see tracing().
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._histograms = dict([(phase, RollingHistogram(window))
+            for phase in PHASES])
+        self._counters = {}
+        self._local = threading.local()
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = \
+                    RollingHistogram(self.window)
+        histogram.observe(seconds)
+        trace = getattr(self._local, "trace", None)
+        if trace:
+            trace.phases[phase] = trace.phases.get(phase, 0) + seconds
+
+    def count(self, name, value=1, **labels):
+        """Increments a counter, the labels distinguish the series of the
+        counter, e.g. count("pages", action="pull", outcome="ok")"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        trace = getattr(self._local, "trace", None)
+        if trace and not labels:
+            trace.counters[name] = trace.counters.get(name, 0) + value
+
+    def timed(self, phase):
+        """Returns a context manager timing its block as 'phase'. Nested
+        blocks of the same phase are only timed once."""
+        return _Timer(self, phase)
+
+    def tracing(self, trace):
+        """Returns a context manager recording the timings and counters of
+        its block to the PageTrace as well"""
+        return _Tracing(self, trace)
+
+    def snapshot(self):
+        """Returns the counters and the histogram snapshots as a dict"""
+        with self._lock:
+            counters = self._counters.items()
+            histograms = self._histograms.items()
+        result = {
+            "uptime": round(time.time() - self.started, 3),
+            "window": self.window,
+            "counters": {},
+            "phases": {},
+        }
+        for (name, labels), value in sorted(counters):
+            if labels:
+                key = "%s{%s}" % (name, ",".join(["%s=%s" % label
+                    for label in labels]))
+            else:
+                key = name
+            result["counters"][key] = value
+        for phase, histogram in histograms:
+            snapshot = histogram.snapshot()
+            snapshot["buckets"] = [(b == float("inf") and "+Inf" or b, c)
+                for b, c in snapshot["buckets"]]
+            result["phases"][phase] = snapshot
+        return result
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        lines = []
+        last = None
+        for (name, labels), value in counters:
+            metric = "wikisync_%s_total" % name
+            if metric != last:
+                lines.append("# TYPE %s counter" % metric)
+                last = metric
+            lines.append("%s%s %s" % (metric, _labels(labels), value))
+        lines.append("# HELP wikisync_phase_seconds Duration of the "
+            "synchronization phases over the last %s seconds" % self.window)
+        lines.append("# TYPE wikisync_phase_seconds histogram")
+        for phase, histogram in histograms:
+            snapshot = histogram.snapshot()
+            for bound, count in snapshot["buckets"]:
+                lines.append("wikisync_phase_seconds_bucket%s %s" % \
+                    (_labels((("phase", phase), ("le",
+                        bound == float("inf") and "+Inf" or repr(bound)))),
+                    count))
+            lines.append("wikisync_phase_seconds_sum%s %s" % \
+                (_labels((("phase", phase),)), snapshot["sum"]))
+            lines.append("wikisync_phase_seconds_count%s %s" % \
+                (_labels((("phase", phase),)), snapshot["count"]))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._counters.clear()
+            self._histograms = dict([(phase, RollingHistogram(self.window))
+                for phase in PHASES])
+
+class _Timer(object):
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+        self.started = None
+
+    def __enter__(self):
+        local = self.metrics._local
+        active = getattr(local, "active", None)
+        if active is None:
+            active = local.active = set()
+        if self.phase not in active:
+            active.add(self.phase)
+            self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.started is not None:
+            self.metrics._local.active.discard(self.phase)
+            self.metrics.observe(self.phase, time.time() - self.started)
+        return False
+
+class _Tracing(object):
+
+    def __init__(self, metrics, trace):
+        self.metrics = metrics
+        self.trace = trace
+        self.previous = None
+
+    def __enter__(self):
+        local = self.metrics._local
+        self.previous = getattr(local, "trace", None)
+        local.trace = self.trace
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        self.metrics._local.trace = self.previous
+        return False
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (k, unicode(v).replace("\\",
+        "\\\\").replace('"', '\\"')) for k, v in labels])
+
+METRICS = Metrics()
+
+def instrumented(phase, counter=None):
+    """Decorates a function, timing its calls as 'phase', and counting the
+    calls as 'counter' if set, e.g. 'db_calls' for the database access
+    methods, which may run several queries per call. Calls made within a
+    call of the same phase are neither timed nor counted."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with METRICS.timed(phase) as timer:
+                if counter and timer.started is not None:
+                    # nested calls are counted once
+                    METRICS.count(counter)
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
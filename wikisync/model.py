@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import time
 from wikisync.util import safe_int
+from wikisync.metrics import instrumented
 from collections import namedtuple
 
 WIKISYNC_TABLE_FIELDS = (
@@ -10,13 +11,27 @@ WIKISYNC_TABLE_FIELDS = (
     "sync_time",
     "sync_remote_version",
     "sync_local_version",
-    "remote_version"
+    "remote_version",
+    "sync_local_digest",
+    "sync_remote_digest",
+    "remote_digest"
 )
 
 WIKISYNC_EXTERNAL_FIELDS = (
     "local_version",
     "status"
 )
+
+WIKISYNC_STATUSES = (
+    "unknown",
+    "ignored",
+    "missing",
+    "new",
+    "conflict",
+    "outdated",
+    "modified",
+    "synced"
+)
     
 class WikiSync(namedtuple("WikiSync", 
     WIKISYNC_TABLE_FIELDS + WIKISYNC_EXTERNAL_FIELDS)):
@@ -75,8 +90,12 @@ class WikiSync(namedtuple("WikiSync",
             "name required"
         return True
     
-    def synchronized(self):
-        """Returns an instance marked as status='synced'"""
+    def synchronized(self, digest=None):
+        """Returns an instance marked as status='synced'
+        
+        @param digest: the digest of the synchronized text, see 
+            wikisync.util.text_digest().
+        """
         assert safe_int(self.remote_version), \
             "Invalid remote_version '%s'" % self.remote_version
         assert safe_int(self.local_version), \
@@ -84,6 +103,9 @@ class WikiSync(namedtuple("WikiSync",
         return self.replace(
             sync_remote_version=self.remote_version,
             sync_local_version=self.local_version,
+            sync_local_digest=digest,
+            sync_remote_digest=digest,
+            remote_digest=digest,
             sync_time = time.time(),
         )
 
@@ -96,10 +118,70 @@ WIKISYNC_FACTORY = WikiSync(
     sync_remote_version=None,
     sync_local_version=None,
     remote_version=None,
+    sync_local_digest=None,
+    sync_remote_digest=None,
+    remote_digest=None,
     local_version=None,
     status="unknown"
 )
 
+# the local_version column is maintained by the wiki change listener and
+# set on insert only, see WikiSyncDao.set_local_version()
+_COLUMNS = WIKISYNC_TABLE_FIELDS + WIKISYNC_EXTERNAL_FIELDS
+
+_SELECT_SQL = "SELECT %s FROM wikisync" % ",".join(_COLUMNS)
+
+_INSERT_SQL = "INSERT INTO wikisync(%s) VALUES (%s)" % \
+    (",".join(_COLUMNS), ",".join(["%s"] * len(_COLUMNS)))
+
+# the status is calculated by a subsequent statement, see _UPDATE_STATUS_SQL
+_UPDATE_SQL = "UPDATE wikisync SET %s WHERE name=%%s" % \
+    ",".join(["%s=%%s" % k for k in WIKISYNC_TABLE_FIELDS])
+
+_DELETE_SQL = "DELETE FROM wikisync WHERE name=%s"
+
+_SCAN_TIME_KEY = "wikisync.scan_time"
+
+_FULL_SCAN_TIME_KEY = "wikisync.full_scan_time"
+
+# SQL expression of WikiSync.status, as calculated by WikiSync.replace()
+_STATUS_SQL = """CASE
+    WHEN COALESCE(wikisync.ignore, 0) != 0 THEN 'ignored'
+    WHEN COALESCE(wikisync.sync_time, 0) = 0 THEN 'unknown'
+    WHEN %(rv)s != 0 AND %(lv)s = 0 THEN 'missing'
+    WHEN %(lv)s != 0 AND %(rv)s = 0 THEN 'new'
+    WHEN %(rv)s > %(srv)s AND %(lv)s > %(slv)s THEN 'conflict'
+    WHEN %(rv)s > %(srv)s THEN 'outdated'
+    WHEN %(lv)s > %(slv)s THEN 'modified'
+    WHEN %(rv)s = %(srv)s AND %(lv)s = %(slv)s THEN 'synced'
+    ELSE 'conflict'
+END""" % {
+    "rv": "COALESCE(wikisync.remote_version, 0)",
+    "lv": "COALESCE(wikisync.local_version, 0)",
+    "srv": "COALESCE(wikisync.sync_remote_version, 0)",
+    "slv": "COALESCE(wikisync.sync_local_version, 0)",
+}
+
+# calculates the status from the stored local_version, which may have been
+# changed by the wiki change listener since the WikiSync was read
+_UPDATE_STATUS_SQL = "UPDATE wikisync SET status=%s WHERE name=%%s" % \
+    _STATUS_SQL
+
+# latest version of the local wiki of a wikisync row
+_LOCAL_VERSION_SQL = """(
+    SELECT MAX(w.version) FROM wiki w WHERE w.name = wikisync.name
+)"""
+
+_LISTING_ORDERS = WIKISYNC_TABLE_FIELDS + WIKISYNC_EXTERNAL_FIELDS
+
+def _insert_values(item):
+    return [getattr(item, f) for f in _COLUMNS]
+
+def _update_values(item):
+    values = [getattr(item, f) for f in WIKISYNC_TABLE_FIELDS]
+    values.append(item.name)
+    return values
+
 class WikiSyncDao(object):
     """Persistence interface for WikiSync objects."""
     
@@ -109,14 +191,8 @@ class WikiSyncDao(object):
     def all(self):
         """Returns all available WikiSync objects."""
         db = self.env.get_read_db()
-        fields = ["ws.%s" % f for f in WIKISYNC_TABLE_FIELDS]
-        sql = """
-            SELECT %s, MAX(w.version) FROM wikisync ws
-            LEFT JOIN wiki w ON w.name = ws.name
-            GROUP BY ws.name
-        """ % ",".join(fields)
         cursor = db.cursor()
-        cursor.execute(sql)
+        cursor.execute(_SELECT_SQL)
         while True:
             row = cursor.fetchone()
             if row:
@@ -124,68 +200,370 @@ class WikiSyncDao(object):
             else:
                 raise StopIteration()
     
+    @instrumented("db", "db_calls")
+    def query(self, status=None, prefix=None, order="name", desc=False,
+        limit=None, offset=0):
+        """Returns an array of WikiSync objects, filtered, sorted and 
+        paginated by the database.
+        
+        @param status: an array of status, only WikiSync with one of the 
+            status are returned.
+        @param prefix: only WikiSync with names starting with 'prefix' are
+            returned, case insensitive depending on the database.
+        @param order: the field to sort by, either a WikiSync field or 
+            'local_version' or 'status'. Ties are sorted by name.
+        @param desc: sorts in descending order.
+        @param limit: maximum number of WikiSync returned.
+        @param offset: number of WikiSync skipped.
+        """
+        assert order in _LISTING_ORDERS, "Unsupported order '%s'" % order
+        db = self.env.get_read_db()
+        where, args = self._listing_filter(db, status, prefix)
+        sql = "%s l%s ORDER BY l.%s%s" % (_SELECT_SQL, where, order, 
+            desc and " DESC" or "")
+        if order != "name":
+            sql += ", l.name"
+        if limit:
+            sql += " LIMIT %s OFFSET %s"
+            args += [int(limit), int(offset or 0)]
+        cursor = db.cursor()
+        cursor.execute(sql, args)
+        return [WIKISYNC_FACTORY.replace(*row) for row in cursor]
+
+    @instrumented("db", "db_calls")
+    def count(self, status=None, prefix=None):
+        """Returns the number of WikiSync matching the filters, 
+        see query()."""
+        db = self.env.get_read_db()
+        where, args = self._listing_filter(db, status, prefix)
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM wikisync l%s" % where, args)
+        return cursor.fetchone()[0]
+
+    @instrumented("db", "db_calls")
+    def summary(self):
+        """Returns a dict of the number of WikiSync by status, counted 
+        from the status index."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT status, COUNT(*) FROM wikisync GROUP BY status
+        """)
+        counts = dict.fromkeys(WIKISYNC_STATUSES, 0)
+        for status, count in cursor:
+            counts[status or "unknown"] = count
+        return counts
+
+    def _listing_filter(self, db, status, prefix):
+        clauses = []
+        args = []
+        if status is not None:
+            if isinstance(status, basestring):
+                status = [status]
+            if not status:
+                # no status would match
+                return " WHERE 1=0", args
+            clauses.append("l.status IN (%s)" % \
+                ",".join(["%s"] * len(status)))
+            args.extend(status)
+        if prefix:
+            clauses.append("l.name %s" % db.like())
+            args.append(db.like_escape(prefix) + "%")
+        return clauses and " WHERE " + " AND ".join(clauses) or "", args
+    
+    @instrumented("db", "db_calls")
     def sync_wiki_data(self):
-        """Makes the WikiSync data in sync with the local database."""
+        """Makes the WikiSync data in sync with the local database.
+        
+        Creates the missing WikiSync of local wiki, and repairs the
+        'local_version' of WikiSync that has drifted from the wiki table,
+        e.g. wiki modified without notifying the change listeners.
+        """
         db = self.env.get_read_db()
         sql = """
-            SELECT DISTINCT w.name FROM wiki w
+            SELECT w.name, MAX(w.version) FROM wiki w
             WHERE NOT EXISTS(
                 SELECT ws.name FROM wikisync ws
                 WHERE ws.name = w.name
             )
+            GROUP BY w.name
         """
         cursor = db.cursor()
         cursor.execute(sql)
-        for row in cursor.fetchall():
-            self.create(WIKISYNC_FACTORY.replace(name=row[0]))
+        self.bulk_apply(inserts=[
+            WIKISYNC_FACTORY.replace(name=name, local_version=version)
+            for name, version in cursor.fetchall()
+        ])
+        repaired = self.repair_local_versions()
+        if repaired:
+            self.env.log.info("Repaired the local version of %s wikisync" % \
+                repaired)
+
+    @instrumented("db", "db_calls")
+    def set_local_version(self, name, version):
+        """Records the latest version of a local wiki, returns False if
+        the WikiSync does not exist.
+        
+        @param version: the latest version, None if the wiki is deleted.
+        """
+        result = []
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE wikisync SET local_version=%s WHERE name=%s
+            """, (version, name))
+            result.append(cursor.rowcount)
+            cursor.execute(_UPDATE_STATUS_SQL, (name,))
+        return result[0] > 0
+
+    @instrumented("db", "db_calls")
+    def repair_local_versions(self):
+        """Updates the 'local_version' that differs from the wiki table in
+        a single statement, returns the number of WikiSync repaired.
+        The 'status' are repaired accordingly."""
+        result = []
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE wikisync SET local_version=%s
+                WHERE COALESCE(local_version, 0) != COALESCE(%s, 0)
+            """ % (_LOCAL_VERSION_SQL, _LOCAL_VERSION_SQL))
+            result.append(cursor.rowcount)
+        self.repair_status()
+        return result[0]
 
-    def sync_remote_data(self, dataset, ignore_filter=None):
+    @instrumented("db", "db_calls")
+    def repair_status(self):
+        """Updates the 'status' that differs from the calculated status in
+        a single statement, returns the number of WikiSync repaired."""
+        result = []
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE wikisync SET status=%s
+                WHERE COALESCE(status, '') != %s
+            """ % (_STATUS_SQL, _STATUS_SQL))
+            result.append(cursor.rowcount)
+        return result[0]
+
+    @instrumented("db", "db_calls")
+    def sync_remote_data(self, dataset, ignore_filter=None, partial=False,
+        removed=()):
         """Makes the WikiSync data in sync with the remote wiki states.
         
+        The current WikiSync states are loaded in a single query and 
+        reconciled in memory, the resulting inserts, updates and deletes
+        are then applied in bulk within a single transaction.
+        
         @param dataset: an array of dict containing all remote wiki information.
             Primary WikiSync properties should be provided, 
             e.g. 'name' and 'remote_version'.
         @param ignore_filter: an instance of wikisync.util.RegExpFilter, used to
             determine the initial 'ignore' state of new WikiSync.
+        @param partial: when True, the dataset only contains the remote wiki
+            that has changed, WikiSync missing from the dataset are left 
+            untouched.
+        @param removed: names of the WikiSync missing remotely, along with a
+            partial dataset.
+        """
+        sync_time = time.time()
+        current = dict([(item.name, item) for item in self.all()])
+        created = set()
+        changed = {}
+        for data in dataset:
+            name = data.get("name", None)
+            item = changed.get(name, None) or current.get(name, None)
+            if not item:
+                item = self.factory(sync_time=sync_time, **data)
+                if ignore_filter and ignore_filter.matches(name):
+                    item = item.replace(ignore=1)
+                item.validate()
+                created.add(name)
+            else:
+                if not item.sync_time:
+                    if ignore_filter and ignore_filter.matches(item.name):
+                        item = item.replace(ignore=1)
+                if "remote_digest" not in data and safe_int(
+                    data.get("remote_version")) != safe_int(item.remote_version):
+                    # the digest of the new remote version is unknown
+                    data = dict(data, remote_digest=None)
+                item = item.replace(sync_time=sync_time, **data)
+            changed[name] = item
+        deleted = []
+        if changed and not partial:
+            removed = set(current.keys()) - set(changed.keys())
+        for name in removed:
+            item = current.get(name)
+            if item:
+                if not item.local_version:
+                    deleted.append(item)
+                else:
+                    changed[name] = item.replace(
+                        remote_version=None,
+                        sync_remote_version=None,
+                        remote_digest=None,
+                        sync_time=sync_time
+                    )
+        self.bulk_apply(
+            inserts=[changed[name] for name in created],
+            updates=[item for name, item in changed.items() \
+                if name not in created],
+            deletes=deleted
+        )
+
+    @instrumented("db", "db_calls")
+    def apply_remote_changes(self, dataset, ignore_filter=None):
+        """Applies remote wiki changes as they happen, e.g. reported by the
+        notifications of the remote server, see wikisync.notify. Returns an
+        array of the changed WikiSync.
+        
+        Unlike sync_remote_data(), only the WikiSync of the dataset are
+        loaded. Changes to a version older than the known remote version,
+        and deletions of an older version, are ignored, notifications may
+        be delivered out of order.
+        
+        @param dataset: an array of dict of the 'name' and 'remote_version'
+            of the changed remote wikis, and optionally the
+            'remote_digest'. A deleted remote wiki has a 'remote_version'
+            of 0, and the last version it had as 'deleted_version'.
+        @param ignore_filter: an instance of wikisync.util.RegExpFilter, used to
+            determine the initial 'ignore' state of new WikiSync.
         """
         sync_time = time.time()
+        items = {}
+        created = set()
+        changed = set()
+        for data in dataset:
+            name = data.get("name")
+            if name not in items:
+                items[name] = self.find(name)
+            item = items[name]
+            version = safe_int(data.get("remote_version"))
+            if not item:
+                if not version:
+                    continue
+                item = self.factory(name=name, sync_time=sync_time)
+                if ignore_filter and ignore_filter.matches(name):
+                    item = item.replace(ignore=1)
+                item.validate()
+                created.add(name)
+            elif version and version <= safe_int(item.remote_version):
+                continue
+            elif not version and safe_int(data.get("deleted_version")) < \
+                safe_int(item.remote_version):
+                # deleted before the known version was saved
+                continue
+            if version:
+                item = item.replace(
+                    remote_version=version,
+                    remote_digest=data.get("remote_digest"),
+                    sync_time=sync_time
+                )
+            else:
+                item = item.replace(
+                    remote_version=None,
+                    sync_remote_version=None,
+                    remote_digest=None,
+                    sync_time=sync_time
+                )
+            items[name] = item
+            changed.add(name)
+        inserts, updates, deletes = [], [], []
+        for name in changed:
+            item = items[name]
+            if not item.remote_version and not item.local_version:
+                # removed on both ends
+                if name not in created:
+                    deletes.append(item)
+            elif name in created:
+                inserts.append(item)
+            else:
+                updates.append(item)
+        self.bulk_apply(inserts, updates, deletes)
+        return inserts + updates
+
+    @instrumented("db", "db_calls")
+    def get_remote_entries(self):
+        """Returns a sorted array of the (name, remote_version,
+        remote_digest) of the WikiSync existing remotely, see
+        wikisync.tree.compare_tree()."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT name, remote_version, remote_digest FROM wikisync
+            WHERE COALESCE(remote_version, 0) != 0
+        """)
+        return sorted([(name, safe_int(version), digest)
+            for name, version, digest in cursor])
+
+    @instrumented("db", "db_calls")
+    def bulk_apply(self, inserts=(), updates=(), deletes=()):
+        """Persists multiple WikiSync objects in a single transaction.
+        
+        @param inserts: WikiSync objects to be created.
+        @param updates: WikiSync objects to be updated.
+        @param deletes: WikiSync objects to be deleted.
+        """
+        if not inserts and not updates and not deletes:
+            return
         @self.env.with_transaction()
         def execute(db):
-            processed = set()
-            for data in dataset:
-                name = data.get("name", None)
-                item = self.find(name)
-                if not item:
-                    if ignore_filter and ignore_filter.matches(name):
-                        data["ignore"] = 1
-                    self.create(self.factory(sync_time=sync_time, **data))
-                else:
-                    if not item.sync_time:
-                        if ignore_filter and ignore_filter.matches(item.name):
-                            item = item.replace(ignore=1)
-                    item = item.replace(sync_time=sync_time, **data)
-                    self.update(item)
-                processed.add(name)
-            if processed:
-                cursor = db.cursor()
-                cursor.execute("SELECT name FROM wikisync")
-                current = set([row[0] for row in cursor.fetchall()])
-                for name in (current - processed):
-                    item = self.find(name)
-                    if not item.local_version:
-                        self.delete(item)
-                    else:
-                        item = item.replace(
-                            remote_version=None,
-                            sync_remote_version=None,
-                            sync_time=sync_time
-                        )
-                        self.update(item)
+            cursor = db.cursor()
+            try:
+                if deletes:
+                    cursor.executemany(_DELETE_SQL,
+                        [(item.name,) for item in deletes])
+                if updates:
+                    cursor.executemany(_UPDATE_SQL,
+                        [_update_values(item) for item in updates])
+                    cursor.executemany(_UPDATE_STATUS_SQL,
+                        [(item.name,) for item in updates])
+                if inserts:
+                    cursor.executemany(_INSERT_SQL,
+                        [_insert_values(item) for item in inserts])
+            except Exception, e:
+                raise ValueError("Bulk update failed: %s" % e)
+
+    @instrumented("db", "db_calls")
+    def get_scan_time(self, full=False):
+        """Returns the time of the last successful remote scan, or None.
+        
+        @param full: returns the time of the last full scan instead.
+        """
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name=%s",
+            (full and _FULL_SCAN_TIME_KEY or _SCAN_TIME_KEY,))
+        row = cursor.fetchone()
+        return row and float(row[0]) or None
+
+    @instrumented("db", "db_calls")
+    def set_scan_time(self, scan_time, full=False):
+        """Records the time of a successful remote scan.
+        
+        @param full: a full scan also sets the last incremental scan time.
+        """
+        keys = full and (_SCAN_TIME_KEY, _FULL_SCAN_TIME_KEY) \
+            or (_SCAN_TIME_KEY,)
+        @self.env.with_transaction()
+        def execute(db):
+            cursor = db.cursor()
+            for key in keys:
+                cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+                    (scan_time, key))
+                if cursor.rowcount < 1:
+                    cursor.execute(
+                        "INSERT INTO system(name, value) VALUES(%s, %s)",
+                        (key, scan_time))
 
     def factory(self, **kwargs):
         """Returns a WikiSync object with default properties"""
         return WIKISYNC_FACTORY.replace(**kwargs)
         
+    @instrumented("db", "db_calls")
     def find(self, name):
         """Returns a WikiSync object with the corresponding 'name'.
         
@@ -194,17 +572,11 @@ class WikiSyncDao(object):
             "String expected, but found '%s'" % name
         db = self.env.get_read_db()
         cursor = db.cursor()
-        fields = ["ws.%s" % f for f in WIKISYNC_TABLE_FIELDS]
-        sql = """
-            SELECT %s, MAX(w.version) FROM wikisync ws
-            LEFT JOIN wiki w ON w.name = ws.name
-            WHERE ws.name=%%s
-            GROUP BY w.name
-        """ % ",".join(fields)
-        cursor.execute(sql, (name,))
+        cursor.execute(_SELECT_SQL + " WHERE name=%s", (name,))
         row = cursor.fetchone()
         return row and WIKISYNC_FACTORY.replace(*row) or None
     
+    @instrumented("db", "db_calls")
     def findMany(self, *names):
         """Returns an array of WikiSync objects that matches '*names'."""
         items = []
@@ -214,51 +586,47 @@ class WikiSyncDao(object):
                 items.append(item)
         return items
 
+    @instrumented("db", "db_calls")
     def delete(self, item):
         item.validate()
-        sql = "DELETE FROM wikisync WHERE name=%s"
         @self.env.with_transaction()
         def execute(db):
             cursor = db.cursor()
             try:
-                cursor.execute(sql, (item.name,))
+                cursor.execute(_DELETE_SQL, (item.name,))
             except Exception, e:
                 raise ValueError("Delete failed: %s" % e)
             if not cursor.rowcount:
                 raise ValueError("Data does not exist: %s" % item)
         return item
 
+    @instrumented("db", "db_calls")
     def create(self, item):
         item.validate()
-        values = [getattr(item, f) for f in WIKISYNC_TABLE_FIELDS]
-        sql = "INSERT INTO wikisync(%s) VALUES (%s)" % \
-            (",".join(WIKISYNC_TABLE_FIELDS), 
-                ",".join(["%s"] * len(WIKISYNC_TABLE_FIELDS)))
+        values = _insert_values(item)
         @self.env.with_transaction()
         def execute(db):
             cursor = db.cursor()
             try:
-                cursor.execute(sql, values)
+                cursor.execute(_INSERT_SQL, values)
             except Exception, e:
                 raise ValueError("Insert failed: %s" % e)
         return item
     
+    @instrumented("db", "db_calls")
     def update(self, item):
         item.validate()
-        values = [getattr(item, f) for f in WIKISYNC_TABLE_FIELDS]
-        values.append(item.name)
-        sql = """
-            UPDATE wikisync SET %s WHERE name=%%s
-        """ % ",".join(["%s=%%s" % k for k in WIKISYNC_TABLE_FIELDS])
+        values = _update_values(item)
         @self.env.with_transaction()
         def execute(db):
             cursor = db.cursor()
             try:
-                cursor.execute(sql, values)
+                cursor.execute(_UPDATE_SQL, values)
             except Exception, e:
                 raise ValueError("Updated failed: %s" % e)
             if not cursor.rowcount:
                 raise ValueError("Data does not exist: %s" % item)
+            cursor.execute(_UPDATE_STATUS_SQL, (item.name,))
         return item
     
         
\ No newline at end of file
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import hmac, threading, time
+from hashlib import sha256
+from wikisync.util import safe_str, safe_int, jsonify
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# request header of the signature of the notification body, see sign()
+SIGNATURE_HEADER = "X-WikiSync-Signature"
+
+# notifications sent longer ago, in seconds, are rejected as replays
+MAX_AGE = 300
+
+# the expiry time of the signatures accepted within MAX_AGE, by signature,
+# see parse_notification()
+_SEEN = {}
+
+_SEEN_LOCK = threading.Lock()
+
+def sign(body, secret):
+    """Returns the signature of a notification body: the hex HMAC-SHA256 of
+    the body keyed by the shared secret, prefixed by 'sha256='"""
+    return "sha256=%s" % hmac.new(safe_str(secret), body, sha256).hexdigest()
+
+def notification(events, now=None):
+    """Returns the json body of a notification of remote wiki changes.
+
+    @param events: an array of dict of the 'name' and the new 'version' of
+        the changed wikis, and optionally the 'digest' of the text, see
+        wikisync.util.text_digest(). A deleted wiki is reported with
+        'deleted' set to True, and the last 'version' it had.
+    """
+    return safe_str(jsonify({"time": now or time.time(), "events": events}))
+
+def parse_notification(body, signature, secret, now=None):
+    """Returns the remote wiki changes of a signed notification body as an
+    array of dict of the 'name', 'remote_version' and 'remote_digest', and
+    the 'deleted_version' of the deleted wikis, see
+    WikiSyncDao.apply_remote_changes(). Raises a ValueError if the
+    signature does not match, the notification has expired, or was already
+    received by this process.
+
+    @param body: the json body, see notification().
+    @param signature: the signature sent along the body, see sign().
+    @param secret: the secret shared with the notifier.
+    """
+    if not signature or not _equals(sign(body, secret), safe_str(signature)):
+        raise ValueError("Invalid signature")
+    data = json.loads(body)
+    if not isinstance(data, dict) or not isinstance(data.get("events"), list):
+        raise ValueError("Missing events")
+    try:
+        sent = float(data.get("time"))
+    except (TypeError, ValueError):
+        raise ValueError("Missing time")
+    now = now or time.time()
+    if abs(now - sent) > MAX_AGE:
+        raise ValueError("Expired notification")
+    changes = []
+    for event in data["events"]:
+        name = isinstance(event, dict) and event.get("name")
+        version = isinstance(event, dict) and safe_int(event.get("version"))
+        if not isinstance(name, basestring) or not name or version <= 0:
+            raise ValueError("Invalid event %s" % event)
+        if event.get("deleted") is True:
+            changes.append({
+                "name": name,
+                "remote_version": 0,
+                "remote_digest": None,
+                "deleted_version": version,
+            })
+        else:
+            changes.append({
+                "name": name,
+                "remote_version": version,
+                "remote_digest": event.get("digest"),
+            })
+    # the replays older than MAX_AGE are rejected as expired
+    signature = safe_str(signature)
+    with _SEEN_LOCK:
+        for seen, expiry in _SEEN.items():
+            if expiry < now:
+                del _SEEN[seen]
+        if signature in _SEEN:
+            raise ValueError("Replayed notification")
+        _SEEN[signature] = sent + MAX_AGE
+    return changes
+
+def reset_signatures():
+    """Forgets the signatures of the received notifications, see
+    parse_notification()"""
+    with _SEEN_LOCK:
+        _SEEN.clear()
+
+def _equals(a, b):
+    """Compares two strings in a time independent of their content"""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
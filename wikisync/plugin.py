@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
 import re, time
 from itertools import groupby
-from wikisync.model import WikiSyncDao
+from wikisync.model import WikiSyncDao, WIKISYNC_STATUSES, \
+    WIKISYNC_TABLE_FIELDS, WIKISYNC_EXTERNAL_FIELDS
+from wikisync.connection import POOL, DEFAULT_MAX_CONNECTIONS, \
+    DEFAULT_IDLE_TIMEOUT
+from wikisync.cache import get_cache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from wikisync.jobs import JobQueue, start_runner, get_autopush, \
+    DEFAULT_AUTOPUSH_DELAY
+from wikisync.metrics import METRICS
+from wikisync.rpc import get_transport, DEFAULT_BATCH_SIZE
+from wikisync.delta import read_delta, save_delta
+from wikisync.notify import parse_notification, SIGNATURE_HEADER
+from wikisync.tree import local_entries, tree_node, TREE_VERSION, \
+    MAX_PREFIXES
+from wikisync.batch import BatchSync, BATCH_ACTIONS, DEFAULT_CONCURRENCY, \
+    DEFAULT_INCREMENTAL_DAYS, refresh_remote
 from wikisync.util import str_mask, str_unmask, safe_str, safe_unicode, \
-    jsonify, WebClient, RegExpFilter
+    safe_int, jsonify, WebClient, get_regexp_filter
 from genshi.builder import tag
 from genshi.core import Markup
 from genshi.filters import Transformer
 from trac.core import *
 from trac.util import get_reporter_id
 from trac.env import IEnvironmentSetupParticipant
+from trac.perm import PermissionError
 from trac.web import IRequestHandler
 from trac.wiki.api import IWikiChangeListener
 from trac.web.chrome import INavigationContributor, ITemplateProvider, \
@@ -28,10 +43,17 @@ __all__ = [
 
 CONFIG_SECTION = "wikisync"
 
-DB_VERSION = 1
+DB_VERSION = 7
 
 DEFAULT_SIGNATURE = "(Updated by wikisync)"
 
+DEFAULT_PAGE_SIZE = 200
+
+MAX_PAGE_SIZE = 1000
+
+# status requiring a synchronization, summarized in the context menu
+PENDING_STATUSES = ("conflict", "modified", "new", "outdated", "missing")
+
 DEFAULT_IGNORELIST = """CamelCase
 PageTemplates
 RecentChanges
@@ -70,6 +92,55 @@ class WikiSyncMixin(object):
         """).fetchone()
         return row and int(row[0]) or 0
     
+    def _get_concurrency(self):
+        return self.env.config.getint(CONFIG_SECTION, "concurrency", 
+            DEFAULT_CONCURRENCY)
+
+    def _get_web_client(self):
+        baseurl = self._get_config("url")
+        assert baseurl, ("Cannot perform synchronization "
+                        "without url configuration.")
+        username = self._get_config("username")
+        password = self._get_config("password")
+        if password:
+            try:
+                password = str_unmask(password)
+            except ValueError:
+                # assume its in clear text
+                pass
+        POOL.configure(
+            self.env.config.getint(CONFIG_SECTION, "max_connections",
+                DEFAULT_MAX_CONNECTIONS),
+            self.env.config.getint(CONFIG_SECTION, "idle_timeout",
+                DEFAULT_IDLE_TIMEOUT)
+        )
+        cache = None
+        cache_size = self.env.config.getint(CONFIG_SECTION, "cache_size",
+            DEFAULT_CACHE_SIZE / 1048576)
+        if cache_size > 0:
+            try:
+                cache = get_cache(
+                    self._get_config("cache_dir") or DEFAULT_CACHE_DIR,
+                    cache_size * 1048576
+                )
+            except (IOError, OSError), e:
+                self.log.warning("Response cache disabled: %s" % e)
+        wc = WebClient(baseurl, username, password, debug=False,
+            cache=cache, log=self.log)
+        return get_transport(wc, 
+            self.env.config.get(CONFIG_SECTION, "transport", "auto"),
+            self.env.config.getint(CONFIG_SECTION, "rpc_batch_size", 
+                DEFAULT_BATCH_SIZE))
+
+    def _refresh(self, wc, full=False):
+        """Updates the local and remote states of all WikiSync"""
+        WikiSyncDao(self.env).sync_wiki_data()
+        ignore_filter = get_regexp_filter(self._get_config("ignorelist"))
+        return refresh_remote(self.env, wc, ignore_filter,
+            self.env.config.getint(CONFIG_SECTION, 
+                "incremental_days", DEFAULT_INCREMENTAL_DAYS),
+            full=full, log=self.log)
+
     def _render_assets(self, req):
         add_stylesheet(req, "wikisync/wikisync.css")
         add_script(req, "wikisync/underscore.js")
@@ -123,36 +194,60 @@ class WikiSyncEnvironment(Component, WikiSyncMixin):
     # IWikiChangeListener
     def wiki_page_added(self, page):
         dao = WikiSyncDao(self.env)
-        item = dao.find(page.name)
-        if not item:
-            ignore_filter = RegExpFilter(
-                self._get_config("ignorelist")
-            )
+        if not dao.set_local_version(page.name, page.version):
+            ignore_filter = get_regexp_filter(self._get_config("ignorelist"))
             item = dao.factory(
                 name=page.name,
-                ignore=ignore_filter.matches(page.name)
+                ignore=ignore_filter.matches(page.name),
+                local_version=page.version
             )
             dao.create(item)
             self.log.debug("Created wikisync '%s'" % item.name)
+        self._autopush(page.name, page.comment)
 
     def wiki_page_changed(self, page, version, t, comment, author, ipnr):
-        pass
+        WikiSyncDao(self.env).set_local_version(page.name, page.version)
+        self._autopush(page.name, comment)
 
-    def wiki_page_deleted(self, page):
-        dao = WikiSyncDao(self.env)
-        item = dao.find(page.name)
-        if not item:
+    def _autopush(self, name, comment):
+        """Schedules the push of an edited wiki when 'autopush' is enabled,
+        see wikisync.jobs.AutoPush"""
+        if not self.env.config.getbool(CONFIG_SECTION, "autopush", False) \
+            or not self._get_config("url"):
             return
-        if not item.remote_version:
-            dao.delete(item)
-            self.log.debug("Removed wikisync '%s'" % item.name)
+        if comment and DEFAULT_SIGNATURE in comment:
+            # saved by a synchronization
+            return
+        item = WikiSyncDao(self.env).find(name)
+        if not item or item.ignore:
+            return
+        get_autopush(self.env, self._get_web_client,
+            self.env.config.getfloat(CONFIG_SECTION, "autopush_delay",
+                DEFAULT_AUTOPUSH_DELAY),
+            self._get_concurrency(), self.log).schedule(name)
+
+    def wiki_page_deleted(self, page):
+        self._remove_local(page.name)
 
     def wiki_page_version_deleted(self, page):
-        self.wiki_page_version_deleted(page)
+        # page holds the latest remaining version
+        WikiSyncDao(self.env).set_local_version(page.name, page.version)
         
     def wiki_page_renamed(self, page, old_name): 
         # Treat as new page
+        self._remove_local(old_name)
         self.wiki_page_added(page)
+
+    def _remove_local(self, name):
+        dao = WikiSyncDao(self.env)
+        item = dao.find(name)
+        if not item:
+            return
+        if not item.remote_version:
+            dao.delete(item)
+            self.log.debug("Removed wikisync '%s'" % item.name)
+        else:
+            dao.set_local_version(name, None)
         
 class WikiSyncAdminPanel(Component, WikiSyncMixin):
     """Disabling this option will require manual editing of the trac.init."""
@@ -238,6 +333,9 @@ class WikiSyncPagePlugin(Component, WikiSyncMixin):
                 item = dao.find(pagename)
                 if not item:
                     item = dao.factory(name=pagename)
+                summary = dao.summary()
+                pending = ", ".join(["%s %s" % (summary[status], status)
+                    for status in PENDING_STATUSES if summary[status]])
                 params = {
                     "model": item,
                     "remote_url": remote_url,
@@ -253,7 +351,8 @@ class WikiSyncPagePlugin(Component, WikiSyncMixin):
                             Markup("&darr;"),
                             href="#", 
                             class_=item.status,
-                            id_="wikisync-panel-toggle"
+                            id_="wikisync-panel-toggle",
+                            title=pending and "Pending: %s" % pending or None
                         ),
                         class_="wikisync"
                     )
@@ -282,7 +381,9 @@ class WikiSyncPlugin(Component, WikiSyncMixin):
     
     # IRequestHandler methods
     def match_request(self, req):
-        return req.path_info == "/wikisync"
+        return req.path_info in ("/wikisync", "/wikisync/list",
+            "/wikisync/summary", "/wikisync/jobs", "/wikisync/metrics",
+            "/wikisync/tree", "/wikisync/delta", "/wikisync/notify")
     
     # ITemplateProvider
     def get_templates_dirs(self):
@@ -292,26 +393,203 @@ class WikiSyncPlugin(Component, WikiSyncMixin):
         return [("wikisync", resource_filename(__name__, "htdocs"))]
         
     def process_request(self, req):
+        if req.path_info == "/wikisync/tree":
+            # read by the remote instances, see wikisync.tree.compare_tree()
+            return self._process_tree(req)
+        elif req.path_info == "/wikisync/delta":
+            # see wikisync.delta.pull_delta() and push_delta()
+            return self._process_delta(req)
+        elif req.path_info == "/wikisync/notify":
+            # authenticated by the signature, see wikisync.notify
+            return self._process_notify(req)
         req.perm.require("WIKI_ADMIN")
-        if req.args.get("action"):
+        if req.path_info == "/wikisync/list":
+            return self._process_list(req)
+        elif req.path_info == "/wikisync/summary":
+            return self._process_summary(req)
+        elif req.path_info == "/wikisync/jobs":
+            return self._process_jobs(req)
+        elif req.path_info == "/wikisync/metrics":
+            return self._process_metrics(req)
+        elif req.args.get("action"):
             return self._process_action(req)
         else:
             return self._process_main(req)
     
     def _process_main(self, req):
-        dao = WikiSyncDao(self.env)
         self._render_assets(req)
         return "wikisync.html", {
-            "collection": [o for o in dao.all()],
             "local_url": req.href.wiki(),
             "remote_url": self._get_config("url"),
             "action_url": req.href.wikisync(),
+            "list_url": req.href.wikisync("list"),
+            "summary_url": req.href.wikisync("summary"),
+            "jobs_url": req.href.wikisync("jobs"),
+            "page_size": self._get_page_size(),
+            "summary": WikiSyncDao(self.env).summary(),
         }, None
 
+    def _process_summary(self, req):
+        """Returns the number of WikiSync by status as json"""
+        req.send(safe_str(jsonify(WikiSyncDao(self.env).summary())),
+            "text/json", 200)
+
+    def _process_list(self, req):
+        """Returns a page of WikiSync as json, filtered by the 'status' and
+        'prefix' parameters."""
+        dao = WikiSyncDao(self.env)
+        status = req.args.get("status")
+        if isinstance(status, basestring):
+            status = [status]
+        if status is not None:
+            status = [s for s in status if s in WIKISYNC_STATUSES]
+        prefix = req.args.get("prefix") or None
+        order = req.args.get("order", "name")
+        if order not in WIKISYNC_TABLE_FIELDS + WIKISYNC_EXTERNAL_FIELDS:
+            order = "name"
+        page_size = self._get_page_size()
+        limit = min(max(safe_int(req.args.get("limit")) or page_size, 1),
+            MAX_PAGE_SIZE)
+        offset = max(safe_int(req.args.get("offset")), 0)
+        payload = {
+            "total": dao.count(status, prefix),
+            "offset": offset,
+            "limit": limit,
+            "items": dao.query(status, prefix, order, 
+                req.args.get("desc") == "1", limit, offset),
+        }
+        req.send(safe_str(jsonify(payload)), "text/json", 200)
+
+    def _process_metrics(self, req):
+        """Returns the synchronization metrics of the process as json, or
+        in the Prometheus text format with 'format=prometheus'"""
+        req.perm.require("TRAC_ADMIN")
+        if req.args.get("format") == "prometheus":
+            req.send(safe_str(METRICS.prometheus()),
+                "text/plain; version=0.0.4", 200)
+        else:
+            req.send(safe_str(jsonify(METRICS.snapshot())), "text/json", 200)
+
+    def _process_tree(self, req):
+        """Returns the nodes of the hash tree of the local wikis viewable by
+        the authenticated user as json, for each of the 'prefix' 
+        parameters"""
+        req.perm.require("WIKI_VIEW")
+        if req.authname == "anonymous":
+            # the first request computes the digests of all the wikis
+            raise PermissionError("WIKI_VIEW")
+        prefixes = req.args.get("prefix", "")
+        if isinstance(prefixes, basestring):
+            prefixes = [prefixes]
+        entries = [entry for entry in local_entries(self.env)
+            if "WIKI_VIEW" in req.perm("wiki", entry[0])]
+        memo = {}
+        payload = {
+            "version": TREE_VERSION,
+            "nodes": dict([(prefix, tree_node(entries, prefix, memo))
+                for prefix in prefixes[:MAX_PREFIXES]]),
+        }
+        req.send(safe_str(jsonify(payload)), "text/json", 200)
+
+    def _process_delta(self, req):
+        """Returns a wiki text as json, as a delta of the 'base' version
+        if its digest matches 'base_digest'. Posting a json delta saves the
+        wiki, see wikisync.delta.save_delta()."""
+        if req.method == "POST":
+            status, payload = save_delta(self.env, req)
+        else:
+            status, payload = 200, read_delta(self.env, req.perm,
+                req.args.get("name"), safe_int(req.args.get("version")),
+                safe_int(req.args.get("base")), req.args.get("base_digest"))
+        req.send(safe_str(jsonify(payload)), "text/json", status)
+
+    def _process_notify(self, req):
+        """Applies the remote wiki changes posted as a notification signed
+        with the 'notify_secret', see wikisync.notify"""
+        secret = self._get_config("notify_secret")
+        if not secret:
+            status, payload = 404, {"error": "Notifications are disabled"}
+        elif req.method != "POST":
+            status, payload = 405, {"error": "POST required"}
+        else:
+            try:
+                changes = parse_notification(req.read(),
+                    req.get_header(SIGNATURE_HEADER), secret)
+            except ValueError, e:
+                self.log.warning("Rejected notification from %s: %s" % \
+                    (req.remote_addr, e))
+                status, payload = 403, {"error": str(e)}
+            else:
+                ignore_filter = get_regexp_filter(
+                    self._get_config("ignorelist"))
+                changed = WikiSyncDao(self.env).apply_remote_changes(changes,
+                    ignore_filter)
+                self.log.debug("Notified of %s remote changes, %s applied" % \
+                    (len(changes), len(changed)))
+                status, payload = 200, {"changed": len(changed)}
+        METRICS.count("notifications", outcome=status == 200 and "ok" or
+            "rejected")
+        req.send(safe_str(jsonify(payload)), "text/json", status)
+
+    def _process_jobs(self, req):
+        """Queues the pages posted with the 'name' and 'action' parameters,
+        or removes the pending jobs with the 'cancel' action, and returns
+        the progress of the queued jobs as json. The jobs are run by a
+        background runner, which is also started to resume the jobs left
+        by a restarted process.
+        
+        The progress includes the 'since' time of the response, and with a
+        'since' parameter, the 'jobs' completed since as an array of dict
+        of the 'name', 'action', 'error', and the WikiSync 'item' of the
+        page, along with the error of a failed page, see _process_action().
+        """
+        queue = JobQueue(self.env)
+        since = safe_int(req.args.get("since"))
+        completed = []
+        if since:
+            dao = WikiSyncDao(self.env)
+            for job in queue.changes(since):
+                since = max(since, job.updated)
+                if job.state not in ("done", "failed"):
+                    continue
+                item = dao.find(job.name)
+                if item and job.state == "failed":
+                    item = list(item) + [job.error]
+                completed.append({
+                    "name": job.name,
+                    "action": job.action,
+                    "error": job.state == "failed" and job.error or None,
+                    "item": item,
+                })
+        else:
+            # microseconds as the job times, read before queuing new jobs
+            since = int(time.time() * 1000000)
+        if req.method == "POST":
+            action = req.args.get("action")
+            if action == "cancel":
+                queue.cancel()
+            elif action in BATCH_ACTIONS:
+                names = req.args.get("name", [])
+                if isinstance(names, basestring):
+                    names = [names]
+                queue.enqueue([(name, action) for name in names if name],
+                    get_reporter_id(req), req.remote_addr)
+            else:
+                raise TracError("Unsupported action '%s'" % action)
+        status = queue.status()
+        if status["pending"] or status["running"]:
+            start_runner(self.env, self._get_web_client,
+                self._get_concurrency(), self.log)
+        status["since"] = since
+        if completed:
+            status["jobs"] = completed
+        req.send(safe_str(jsonify(status)), "text/json", 200)
+
     def _process_action(self, req):
         dao = WikiSyncDao(self.env)
         action = req.args.get("action")
         assert len(action), "'action' required"
+        METRICS.count("actions", action=action)
         names = req.args.get("name", [])
         if isinstance(names, basestring):
             if names:
@@ -319,109 +597,50 @@ class WikiSyncPlugin(Component, WikiSyncMixin):
         else:
             names = [name for name in names if name]
         error = None
+        errors = {}
         wc = None
         try:
             wc = self._get_web_client()
-            if action == "refresh":
-                if names:
-                    for name in names:
-                        info = wc.get_remote_version(name)
-                        item = dao.find(name)
-                        if not item:
-                            wiki = WikiPage(self.env, name)
-                            if wiki.exists:
-                                item = dao.factory(
-                                    name=name,
-                                    local_version=wiki.version,
-                                    sync_time=time.time()
-                                )
-                                item = dao.create(item)
-                                self.log.debug("Created '%s' wikisync" % name)
-                        if info:
-                            info = info[0]
-                            info["sync_time"] = time.time()
-                            if item:
-                                item = dao.update(item.replace(**info))
-                            else:
-                                item = dao.create(dao.factory(**info))
-                            self.log.debug("Updated '%s' wikisync info %s" % \
-                                (name, info))
-                        elif item:
-                            item = dao.update(
-                                item.replace(sync_time=time.time())
-                            )
-                else:
-                    # update local and remote data
-                    dao.sync_wiki_data()
-                    ignore_filter = RegExpFilter(
-                        self._get_config("ignorelist")
-                    )
-                    results = wc.get_remote_list()
-                    dao.sync_remote_data(results, ignore_filter)
-            elif action in ("pull", "push", "resolve"):
-                items = []
+            if action == "refresh" and not names:
+                self._refresh(wc, full=req.args.get("full") == "1")
+            elif action in BATCH_ACTIONS:
+                batch = BatchSync(self.env, wc, self._get_concurrency(), 
+                    self.log)
+                for result in batch.run([(name, action) for name in names], 
+                    get_reporter_id(req), req.remote_addr):
+                    if not result.ok:
+                        errors[result.name] = result.error
+                if names and len(errors) == len(names):
+                    error = errors[names[0]]
+            elif action == "resolve":
                 for name in names:
                     item = dao.find(name)
                     if not item:
                         raise ValueError("Missing wiki '%s'" % name)
-                    if action == "pull":
-                        author = get_reporter_id(req)
-                        addr = req.remote_addr
-                        wiki = WikiPage(self.env, item.name)
-                        wiki.text = wc.pull(item.name,
-                            item.remote_version)
-                        if not len(wiki.text) and not wiki.version:
-                            # BUGFIX: account for empy remote wiki Page,
-                            # which throws a Page not modified exception when
-                            # saving for the first time (default wiki.text = '')
-                            wiki.text = " "
-                        try:
-                            wiki.save(author, DEFAULT_SIGNATURE, addr)
-                        except TracError, e:
-                            if wiki.text != wiki.old_text:
-                                raise e
-                            else:
-                                self.log.debug("Content has not changed, "
-                                               "skipping '%s'" % item.name)
+                    status = req.args.get("status")
+                    if status == "ignore":
+                        item = item.replace(ignore=1)
+                    elif status == "unignore":
+                        item = item.replace(ignore=None)
+                    elif status == "ignore_attachment":
+                        item = item.replace(ignore_attachment=1)
+                    elif status == "unignore_attachment":
+                        item = item.replace(ignore_attachment=None)
+                    elif status == "modified":
                         item = item.replace(
-                            local_version=wiki.version
-                        ).synchronized()
-                        dao.update(item)
-                        self.log.debug("Pulled wiki '%s'" % item.name)
-                    elif action == "push":
-                        wiki = WikiPage(self.env, item.name)
-                        assert wiki.version > 0, "Cannot find wiki '%s'" % item.name
+                            sync_remote_version=item.remote_version
+                        )
+                    elif status == "outdated":
                         item = item.replace(
-                            **wc.push(
-                                item.name, 
-                                wiki.text,
-                                wiki.comment
-                            )
-                        ).synchronized()
-                        dao.update(item)
-                        self.log.debug("Pushed wiki '%s'" % item.name)
-                    elif action == "resolve":
-                        status = req.args.get("status")
-                        if status == "ignore":
-                            item = item.replace(ignore=1)
-                        elif status == "unignore":
-                            item = item.replace(ignore=None)
-                        elif status == "modified":
-                            item = item.replace(
-                                sync_remote_version=item.remote_version
-                            )
-                        elif status == "outdated":
-                            item = item.replace(
-                                sync_local_version=item.local_version
-                            )
-                        else:
-                            raise RuntimeError(
-                                "Unsupported resolution: '%s'" % status
-                            )
-                        dao.update(item)
-                        self.log.debug("Resolved wiki '%s' as %s" % \
-                            (item.name, status))
-                        
+                            sync_local_version=item.local_version
+                        )
+                    else:
+                        raise RuntimeError(
+                            "Unsupported resolution: '%s'" % status
+                        )
+                    dao.update(item)
+                    self.log.debug("Resolved wiki '%s' as %s" % \
+                        (item.name, status))
             else:
                 raise ValueError("Unsupported action '%s'" % action)
         except Exception, e:
@@ -430,32 +649,34 @@ class WikiSyncPlugin(Component, WikiSyncMixin):
         finally:
             if wc:
                 wc.close()
+                self.log.debug("Connection pool and cache: %s" % wc.stats())
         if req.get_header("X-Requested-With") == "XMLHttpRequest" or \
             req.get_header("HTTP_X_REQUESTED_WITH") == "XMLHttpRequest":
             if error:
                 payload = safe_str(error);
                 req.send(payload, "text/plain", 500)
             else:
-                payload = safe_str(jsonify(dao.findMany(*names)))
+                # failed pages carries the error message after the
+                # WikiSync fields
+                payload = safe_str(jsonify([
+                    item.name in errors and \
+                        list(item) + [safe_unicode(errors[item.name])] or \
+                        item
+                    for item in dao.findMany(*names)
+                ]))
                 req.send(payload, "text/json", 200)
         else:
             if error:
                 add_warning(req, "An error has occurred: %s" % error)
+            elif errors:
+                for name, e in errors.items():
+                    add_warning(req, "Unable to synchronize '%s': %s" % \
+                        (name, e))
             if names:
                 req.redirect(req.href.wiki(names[0]))
             else:
                 req.redirect(req.href.wikisync())
 
-    def _get_web_client(self):
-        baseurl = self._get_config("url")
-        assert baseurl, ("Cannot perform synchronization "
-                        "without url configuration.")
-        username = self._get_config("username")
-        password = self._get_config("password")
-        if password:
-            try:
-                password = str_unmask(password)
-            except ValueError:
-                # assume its in clear text
-                pass
-        return WebClient(baseurl, username, password, debug=False)
\ No newline at end of file
+    def _get_page_size(self):
+        return self.env.config.getint(CONFIG_SECTION, "page_size", 
+            DEFAULT_PAGE_SIZE)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+import threading, time, urllib2, xmlrpclib
+from StringIO import StringIO
+from xml.parsers.expat import ExpatError
+from wikisync.delta import pull_delta, push_delta
+from wikisync.metrics import METRICS
+from wikisync.util import safe_str, safe_unicode
+
+# number of calls bundled in a single system.multicall request
+DEFAULT_BATCH_SIZE = 200
+
+# supported values of the 'transport' option
+TRANSPORTS = ("auto", "html", "xmlrpc")
+
+# fault code of the missing resources, as reported by TracXMLRPC
+_NOT_FOUND = 404
+
+# whether the remote servers provide XML-RPC, by url, see get_transport()
+_SUPPORTED = {}
+
+_SUPPORTED_LOCK = threading.Lock()
+
+class RpcClient(object):
+    """Transfers the wikis through the XML-RPC interface of the TracXMLRPC
+    plugin, as a replacement of the HTML scraping of WebClient.
+
+    The requests are sent with the WebClient, sharing its authenticated
+    session and persistent connections. The remote versions, the texts and
+    the pushes of many wikis are bundled with 'system.multicall', see
+    get_remote_versions(), pull_many() and push_many(). Attachments are
+    still transferred by the WebClient, TracXMLRPC loads them in memory.
+    """
+
+    def __init__(self, wc, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        @param wc: an instance of wikisync.util.WebClient.
+        @param batch_size: maximum number of calls in a multicall request.
+        """
+        self.wc = wc
+        self.batch_size = max(1, batch_size)
+        self.baseurl = wc.baseurl
+        self.log = wc.log
+
+    def call(self, method, *params):
+        """Calls a remote method, returns its result, raises an
+        xmlrpclib.Fault if the call fails"""
+        body = safe_str(xmlrpclib.dumps(params, method, allow_none=True,
+            encoding="utf-8"))
+        # the session cookie authenticates the calls, the 'login/rpc' path
+        # would request the http authentication again
+        f = self.wc.open("rpc", StringIO(body), "POST", {
+            "Content-Type": "text/xml",
+            "Content-Length": str(len(body)),
+        })
+        try:
+            with METRICS.timed("parse"):
+                parser, unmarshaller = xmlrpclib.getparser()
+                while True:
+                    data = f.read(64 * 1024)
+                    if not data:
+                        break
+                    parser.feed(data)
+                parser.close()
+                return unmarshaller.close()[0]
+        finally:
+            self.wc._close(f)
+
+    def multicall(self, calls):
+        """Calls the remote methods in requests of at most 'batch_size'
+        calls, returns an array of the results in the same order, where a
+        failed call is represented by its xmlrpclib.Fault.
+
+        @param calls: an array of (method, params) tuple.
+        """
+        results = []
+        for i in xrange(0, len(calls), self.batch_size):
+            chunk = calls[i:i + self.batch_size]
+            if len(chunk) == 1:
+                try:
+                    results.append(self.call(chunk[0][0], *chunk[0][1]))
+                except xmlrpclib.Fault, e:
+                    results.append(e)
+                continue
+            for result in self.call("system.multicall", [
+                {"methodName": method, "params": list(params)}
+                for method, params in chunk]):
+                if isinstance(result, dict):
+                    results.append(xmlrpclib.Fault(result.get("faultCode"),
+                        result.get("faultString")))
+                else:
+                    results.append(result[0])
+        return results
+
+    def test(self):
+        self.wc.test()
+        return self.call("system.getAPIVersion")
+
+    def authenticate(self):
+        self.wc.authenticate()
+
+    def clone(self):
+        return RpcClient(self.wc.clone(), self.batch_size)
+
+    def close(self):
+        self.wc.close()
+
+    def stats(self):
+        return self.wc.stats()
+
+    def get_remote_list(self):
+        return self._recent_changes(0)
+
+    def get_remote_updates(self, date, days=10):
+        """Returns the wikis changed within 'days' before 'date', see
+        WebClient.get_remote_updates()"""
+        return self._recent_changes(date - days * 86400)
+
+    def get_remote_version(self, name):
+        version = self.get_remote_versions([name])[name]
+        return version and [{"name": name, "remote_version": version}] or []
+
+    def get_remote_versions(self, names):
+        """Returns a dict of the remote version of the wikis by name, the
+        wikis missing remotely are mapped to None"""
+        names = list(names)
+        versions = {}
+        for name, result in zip(names, self.multicall([
+            ("wiki.getPageInfo", (name,)) for name in names])):
+            if isinstance(result, xmlrpclib.Fault):
+                if result.faultCode != _NOT_FOUND:
+                    raise result
+                result = None
+            versions[name] = result and int(result["version"]) or None
+        return versions
+
+    def pull(self, name, version=None, base=None):
+        if base:
+            text = pull_delta(self.wc, name, version, base)
+            if text is not None:
+                return text
+        return _raise(self.pull_many([(name, version)])[0])
+
+    def pull_many(self, pages):
+        """Returns an array of the wiki texts, or of the exception raised
+        for the wiki, in the same order as the pages.
+
+        @param pages: an array of (name, version) tuple, a version of None
+            reads the latest version.
+        """
+        return [isinstance(r, Exception) and r or safe_unicode(r)
+            for r in self.multicall([
+                ("wiki.getPage", version and (name, version) or (name,))
+                for name, version in pages])]
+
+    def push(self, name, text, comments=None, version=None, base=None):
+        if base:
+            info = push_delta(self.wc, name, text, comments, version, base)
+            if info:
+                return info
+        return _raise(self.push_many([(name, text, comments)])[0])
+
+    def push_many(self, pages):
+        """Saves the wiki texts, returns an array of dict of the 'name' and
+        the new 'remote_version', or of the exception raised for the wiki,
+        in the same order as the pages.
+
+        @param pages: an array of (name, text, comments) tuple.
+        """
+        calls = []
+        for name, text, comments in pages:
+            calls.append(("wiki.putPage", (name, safe_unicode(text),
+                {"comment": self.wc._format_comment(comments)})))
+            # the new version is read within the same request
+            calls.append(("wiki.getPageInfo", (name,)))
+        results = self.multicall(calls)
+        infos = []
+        for i, (name, text, comments) in enumerate(pages):
+            saved, info = results[i * 2:i * 2 + 2]
+            if isinstance(saved, Exception):
+                infos.append(saved)
+            elif not saved or isinstance(info, Exception):
+                infos.append(RuntimeError("Unable to save wiki '%s': %s" % \
+                    (name, isinstance(info, Exception) and info or saved)))
+            else:
+                infos.append({"name": name,
+                    "remote_version": int(info["version"])})
+        return infos
+
+    def get_remote_tree(self, prefixes):
+        return self.wc.get_remote_tree(prefixes)
+
+    def get_remote_attachments(self, name):
+        return self.wc.get_remote_attachments(name)
+
+    def download_attachment(self, name, filename, target):
+        return self.wc.download_attachment(name, filename, target)
+
+    def upload_attachment(self, name, filename, path, description=None):
+        return self.wc.upload_attachment(name, filename, path, description)
+
+    def _recent_changes(self, since):
+        since = xmlrpclib.DateTime(time.gmtime(max(0, since)))
+        return [{"name": safe_unicode(info["name"]),
+            "remote_version": int(info["version"])}
+            for info in self.call("wiki.getRecentChanges", since)]
+
+def get_transport(wc, transport="auto", batch_size=DEFAULT_BATCH_SIZE):
+    """Returns the client transferring the wikis with the remote server,
+    an RpcClient or the WebClient itself.
+
+    @param wc: an instance of wikisync.util.WebClient.
+    @param transport: 'xmlrpc', 'html', or 'auto' to use XML-RPC when the
+        remote server provides it. The detection is performed once per
+        server and process.
+    """
+    if transport == "html":
+        return wc
+    rpc = RpcClient(wc, batch_size)
+    if transport == "xmlrpc":
+        return rpc
+    with _SUPPORTED_LOCK:
+        supported = _SUPPORTED.get(wc.baseurl)
+        if supported is None:
+            try:
+                version = rpc.call("system.getAPIVersion")
+                supported = True
+                if wc.log:
+                    wc.log.debug("Using XML-RPC API version %s of %s" % \
+                        (version, wc.baseurl))
+            except urllib2.HTTPError, e:
+                if e.fp is not None:
+                    e.close()
+                if e.code not in (404, 405):
+                    # e.g. a 503, the detection is retried by the next call
+                    if wc.log:
+                        wc.log.warning("Unable to detect XML-RPC on %s, "
+                            "using the html pages: %s" % (wc.baseurl, e))
+                    return wc
+                # missing XML-RPC
+                supported = False
+            except (xmlrpclib.Error, ExpatError), e:
+                # disabled XML-RPC, or a page other than the XML-RPC handler
+                supported = False
+            if not supported and wc.log:
+                wc.log.debug("XML-RPC unavailable on %s: %s" % \
+                    (wc.baseurl, e))
+            _SUPPORTED[wc.baseurl] = supported
+    return supported and rpc or wc
+
+def reset_transports():
+    """Forgets the detected transports of the remote servers, see
+    get_transport()"""
+    with _SUPPORTED_LOCK:
+        _SUPPORTED.clear()
+
+def _raise(result):
+    if isinstance(result, Exception):
+        raise result
+    return result
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+def do_upgrade(env, ver, cursor):
+    for column in ("sync_local_digest", "sync_remote_digest"):
+        cursor.execute("ALTER TABLE wikisync ADD COLUMN %s text" % column)
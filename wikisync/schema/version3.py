@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+def do_upgrade(env, ver, cursor):
+    cursor.execute("ALTER TABLE wikisync ADD COLUMN local_version int")
+    cursor.execute("""
+        UPDATE wikisync SET local_version=(
+            SELECT MAX(w.version) FROM wiki w WHERE w.name = wikisync.name
+        )
+    """)
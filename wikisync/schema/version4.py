@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+# frozen copy of the status expression, see wikisync.model._STATUS_SQL
+_STATUS_SQL = """CASE
+    WHEN COALESCE(ignore, 0) != 0 THEN 'ignored'
+    WHEN COALESCE(sync_time, 0) = 0 THEN 'unknown'
+    WHEN %(rv)s != 0 AND %(lv)s = 0 THEN 'missing'
+    WHEN %(lv)s != 0 AND %(rv)s = 0 THEN 'new'
+    WHEN %(rv)s > %(srv)s AND %(lv)s > %(slv)s THEN 'conflict'
+    WHEN %(rv)s > %(srv)s THEN 'outdated'
+    WHEN %(lv)s > %(slv)s THEN 'modified'
+    WHEN %(rv)s = %(srv)s AND %(lv)s = %(slv)s THEN 'synced'
+    ELSE 'conflict'
+END""" % {
+    "rv": "COALESCE(remote_version, 0)",
+    "lv": "COALESCE(local_version, 0)",
+    "srv": "COALESCE(sync_remote_version, 0)",
+    "slv": "COALESCE(sync_local_version, 0)",
+}
+
+def do_upgrade(env, ver, cursor):
+    cursor.execute("ALTER TABLE wikisync ADD COLUMN status text")
+    cursor.execute("UPDATE wikisync SET status=%s" % _STATUS_SQL)
+    cursor.execute("CREATE INDEX wikisync_status_idx ON wikisync(status)")
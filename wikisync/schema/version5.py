@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from trac.db import Table, Column, Index, DatabaseManager
+
+def do_upgrade(env, ver, cursor):
+    job_table = Table("wikisync_job", key=("id"))[
+        Column("id", auto_increment=True),
+        Column("name"),
+        Column("action"),
+        Column("state"),
+        Column("attempts", type="int"),
+        Column("error"),
+        Column("author"),
+        Column("ipnr"),
+        Column("created", type="int64"),
+        Column("updated", type="int64"),
+        Index(["state"]),
+        Index(["name"]),
+    ]
+    db_backend, _ = DatabaseManager(env).get_connector()
+    for stmt in db_backend.to_sql(job_table):
+        cursor.execute(stmt)
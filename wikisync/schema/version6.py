@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from trac.db import Table, Column, DatabaseManager
+
+def do_upgrade(env, ver, cursor):
+    attachment_table = Table("wikisync_attachment", 
+        key=("name", "filename"))[
+        Column("name"),
+        Column("filename"),
+        Column("size", type="int64"),
+        Column("digest"),
+        Column("local_time", type="int64"),
+        Column("remote_time"),
+        Column("sync_time", type="int64"),
+    ]
+    db_backend, _ = DatabaseManager(env).get_connector()
+    for stmt in db_backend.to_sql(attachment_table):
+        cursor.execute(stmt)
@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+
+def do_upgrade(env, ver, cursor):
+    cursor.execute("ALTER TABLE wikisync ADD COLUMN remote_digest text")
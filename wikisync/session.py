@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import os, tempfile, threading, cookielib
+from hashlib import md5
+
+class Session(object):
+    """Authenticated session of a remote server, shared in memory by all
+    the WebClient of the process using the same server and credentials.
+
+    The cookies are loaded from the cookie file once, and only written back
+    when they have changed. Each login increments the 'generation', which
+    allows the threads rejected by an expired session to login only once,
+    see login().
+    """
+
+    def __init__(self, cookie_file, require_login=False):
+        """
+        @param cookie_file: path of the persisted cookies.
+        @param require_login: True if the remote server requires a login.
+        """
+        self.cookie_file = cookie_file
+        self.cookie_jar = cookielib.LWPCookieJar(cookie_file)
+        self.generation = 0
+        # the edit form fields of the session, see WebClient.push()
+        self.edit_fields = {}
+        self._lock = threading.Lock()
+        self._saved = None
+        if os.path.isfile(cookie_file):
+            try:
+                self.cookie_jar.load(ignore_discard=True)
+                self._saved = self._signature()
+            except (IOError, cookielib.LoadError):
+                pass
+        # a persisted session is assumed to be valid until rejected
+        self.authenticated = not require_login or self._saved is not None
+
+    def login(self, login, generation=None):
+        """Calls login() unless another thread has logged in since the
+        'generation' was read. Returns True if login() was called.
+
+        @param login: callable performing the login request.
+        @param generation: the generation of the session that was rejected,
+            None to login if not authenticated yet.
+        """
+        with self._lock:
+            if generation is None:
+                if self.authenticated:
+                    return False
+            elif generation != self.generation:
+                return False
+            self.authenticated = False
+            login()
+            self.generation += 1
+            self.authenticated = True
+            self._save()
+            return True
+
+    def save(self):
+        """Writes the cookies to the cookie file if they have changed since
+        loaded or last saved"""
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        signature = self._signature()
+        if signature != self._saved:
+            self.cookie_jar.save(ignore_discard=True)
+            self._saved = signature
+
+    def _signature(self):
+        return sorted([(c.domain, c.path, c.name, c.value, c.expires)
+            for c in self.cookie_jar])
+
+class SessionManager(object):
+    """Keeps the Session of the remote servers by server url and
+    credentials, process wide."""
+
+    def __init__(self, directory=None):
+        """
+        @param directory: directory of the cookie files, defaults to the
+            system temporary directory.
+        """
+        self.directory = directory or tempfile.gettempdir()
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get(self, baseurl, username=None, password=None):
+        """Returns the Session of the server and credentials"""
+        key = session_key(baseurl, username, password)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = Session(
+                    os.path.join(self.directory, key),
+                    bool(username and password))
+            return session
+
+    def discard(self, baseurl, username=None, password=None):
+        """Forgets the session of the server and credentials, the cookie
+        file is removed"""
+        key = session_key(baseurl, username, password)
+        with self._lock:
+            self._sessions.pop(key, None)
+            cookie_file = os.path.join(self.directory, key)
+            if os.path.isfile(cookie_file):
+                os.remove(cookie_file)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+def session_key(baseurl, username=None, password=None):
+    """Returns a hash of the server url and credentials"""
+    m = md5()
+    m.update(baseurl)
+    m.update(username or "username")
+    m.update(password or "password")
+    return m.hexdigest()
+
+SESSIONS = SessionManager()
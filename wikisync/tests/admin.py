@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import unittest, sys
+from StringIO import StringIO
+from wikisync import jobs
+from wikisync.admin import WikiSyncAdminCommand
+from wikisync.jobs import JobQueue
+from wikisync.plugin import WikiSyncEnvironment
+from wikisync.model import WikiSyncDao
+from wikisync.tests.batch import StubClient
+from wikisync.util import json
+from trac.admin.api import AdminCommandError
+from trac.test import EnvironmentStub
+from trac.wiki.model import WikiPage
+
+class WikiSyncAdminCommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.dao = WikiSyncDao(self.env)
+        self.client = StubClient(dict([
+            ("RemotePage%s" % i, (2, "Remote text %s" % i))
+            for i in range(6)
+        ]), delay=0)
+        self.command = WikiSyncAdminCommand(self.env)
+        self.command._get_web_client = lambda: self.client
+        for name in ("LocalPage", "OtherPage"):
+            page = WikiPage(self.env, name)
+            page.text = "Local text"
+            page.save("admin", "", "127.0.0.1")
+
+    def _run(self, *args):
+        """Runs the command, returns the printed json objects"""
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            getattr(self.command, "_do_%s" % args[0])("--json", *args[1:])
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), stdout
+        return [json.loads(line) for line in output.splitlines()]
+
+    def test_sync(self):
+        events = self._run("sync")
+        self.assertEqual(events[0], {"event": "scan", "scan": "full"})
+        self.assertEqual(events[-1]["synced"], 8)
+        actions = dict([(e["name"], e["action"]) for e in events[1:-1]])
+        self.assertEqual(actions["RemotePage0"], "pull")
+        self.assertEqual(actions["LocalPage"], "push")
+        self.assertEqual(self.dao.summary()["synced"], 8)
+        self.assertEqual(WikiPage(self.env, "RemotePage0").text,
+            "Remote text 0")
+        self.assertEqual(self.client.pages["LocalPage"], (1, "Local text"))
+        # nothing left to synchronize
+        self.assertEqual(self._run("sync")[-1]["synced"], 0)
+
+    def test_filters(self):
+        self._run("refresh")
+        events = self._run("pull", "RemotePage[12]", "*5")
+        self.assertEqual([e.get("name") for e in events[:-1]],
+            ["RemotePage1", "RemotePage2", "RemotePage5"])
+        events = self._run("push", "--status=new", "Other*")
+        self.assertEqual(events[0]["name"], "OtherPage")
+        self.assertEqual(self.client.pushes, ["OtherPage"])
+        self.assertEqual(self.dao.find("LocalPage").status, "new")
+
+    def test_conflict(self):
+        self._run("sync")
+        page = WikiPage(self.env, "LocalPage")
+        page.text = "Changed text"
+        page.save("admin", "", "127.0.0.1")
+        self.client.pages["LocalPage"] = (2, "Remote text")
+        self.client.timeline = [{"name": "LocalPage", "remote_version": 2}]
+        self.assertEqual(self._run("sync")[-1]["synced"], 0)
+        self.assertEqual(self.dao.find("LocalPage").status, "conflict")
+        self._run("sync", "--resolve=outdated")
+        self.assertEqual(WikiPage(self.env, "LocalPage").text, "Remote text")
+
+    def test_time_limit(self):
+        claim_size, jobs.CLAIM_SIZE = jobs.CLAIM_SIZE, 2
+        self.client.delay = 0.4
+        try:
+            self._run("refresh")
+            events = self._run("pull", "--concurrency=1", "--time-limit=1")
+        finally:
+            jobs.CLAIM_SIZE = claim_size
+        self.assertEqual(events[-1]["synced"], 4)
+        self.assertEqual(events[-1]["skipped"], 2)
+        self.assertEqual(events[-2], {"event": "skipped",
+            "name": "RemotePage5", "action": "pull"})
+
+    def test_resume(self):
+        self._run("refresh")
+        JobQueue(self.env).enqueue([("RemotePage0", "pull"),
+            ("LocalPage", "push")])
+        self.assertEqual(self._run("queue")[0]["pending"], 2)
+        self.assertEqual(self._run("resume")[-1]["synced"], 2)
+        self.assertEqual(self.client.pushes, ["LocalPage"])
+        self.assertEqual(self._run("queue")[0]["done"], 2)
+        self.assertRaises(AdminCommandError, self._run, "resume", "Page*")
+
+    def test_failed(self):
+        self._run("refresh")
+        del self.client.pages["RemotePage0"]
+        self.assertRaises(AdminCommandError, self._run, "pull")
+        self.assertEqual(self.dao.summary()["synced"], 5)
+
+    def test_invalid(self):
+        for args in (("pull", "--status=bogus"), ("pull", "--resolve=new"),
+            ("push", "--full"), ("sync", "--status=conflict"),
+            ("sync", "--status=synced"), ("refresh", "--concurrency=0"),
+            ("refresh", "--unknown")):
+            self.assertRaises(AdminCommandError, self._run, *args)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(WikiSyncAdminCommandTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
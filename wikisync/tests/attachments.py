@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import unittest, os, shutil, tempfile
+from StringIO import StringIO
+from wikisync.attachments import AttachmentSync, AttachmentDao
+from wikisync.batch import BatchSync
+from wikisync.connection import ConnectionPool
+from wikisync.model import WikiSyncDao
+from wikisync.plugin import WikiSyncEnvironment
+from wikisync.tests.batch import StubClient
+from wikisync.tests.server import AttachmentHandler
+from wikisync.util import WebClient
+from trac.attachment import Attachment
+from trac.test import EnvironmentStub
+from trac.wiki.model import WikiPage
+
+class AttachmentClient(StubClient):
+    """Keeps the remote pages in memory, the attachments are transferred
+    with a WebClient"""
+
+    def __init__(self, pages, wc):
+        StubClient.__init__(self, pages, delay=0)
+        self.wc = wc
+
+    def get_remote_attachments(self, name):
+        return self.wc.get_remote_attachments(name)
+
+    def download_attachment(self, name, filename, target):
+        return self.wc.download_attachment(name, filename, target)
+
+    def upload_attachment(self, name, filename, path, description=None):
+        return self.wc.upload_attachment(name, filename, path, description)
+
+class AttachmentSyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        self.env.path = tempfile.mkdtemp(prefix="wikisync-env-")
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.root = tempfile.mkdtemp(prefix="wikisync-remote-")
+        self.server = AttachmentHandler.create_server(self.root).start()
+        self.pool = ConnectionPool()
+        self.wc = WebClient(self.server.url, pool=self.pool)
+        self.sync = AttachmentSync(self.env)
+        page = WikiPage(self.env, "WikiStart")
+        page.text = "Local text"
+        page.save("admin", "", "127.0.0.1")
+
+    def tearDown(self):
+        self.wc.close()
+        self.pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.env.path)
+
+    def _attach(self, filename, data):
+        for attachment in Attachment.select(self.env, "wiki", "WikiStart"):
+            if attachment.filename == filename:
+                attachment.delete()
+        attachment = Attachment(self.env, "wiki", "WikiStart")
+        attachment.author = "admin"
+        attachment.insert(filename, StringIO(data), len(data))
+        return attachment
+
+    def _local(self, filename):
+        attachment = Attachment(self.env, "wiki", "WikiStart", filename)
+        with open(attachment.path, "rb") as f:
+            return attachment, f.read()
+
+    def _remote(self, filename):
+        with open(self.server.attachments[("WikiStart", filename)][0],
+            "rb") as f:
+            return f.read()
+
+    def _run(self, action):
+        state = self.sync.prepare("WikiStart")
+        plan = getattr(self.sync, action)(self.wc, state)
+        self.sync.apply(state, plan, "admin", "127.0.0.1")
+        return plan
+
+    def test_push(self):
+        self._attach("spec.pdf", "x" * 200000)
+        self._attach("logo.png", "png")
+        self.assertEqual(len(self._run("push")), 2)
+        self.assertEqual(self._remote("spec.pdf"), "x" * 200000)
+        self.assertEqual(sorted(self.server.uploads), [
+            ("WikiStart", "logo.png"), ("WikiStart", "spec.pdf")])
+        # unchanged attachments are not uploaded again
+        self.assertEqual(self._run("push"), [])
+        self._attach("logo.png", "gif")
+        self.assertEqual([t.filename for t in self._run("push")],
+            ["logo.png"])
+        self.assertEqual(self._remote("logo.png"), "gif")
+        self.assertEqual(len(self.server.uploads), 3)
+        records = AttachmentDao(self.env).find_all("WikiStart")
+        self.assertEqual(records["spec.pdf"].size, 200000)
+
+    def test_pull(self):
+        self._attach("logo.png", "png")
+        self._run("push")
+        self._attach("spec.pdf", "x" * 200000)
+        self._run("push")
+        for filename in ("logo.png", "spec.pdf"):
+            Attachment(self.env, "wiki", "WikiStart", filename).delete()
+        plan = self._run("pull")
+        self.assertEqual(sorted([t.filename for t in plan]),
+            ["logo.png", "spec.pdf"])
+        attachment, data = self._local("spec.pdf")
+        self.assertEqual((attachment.size, data), (200000, "x" * 200000))
+        self.assertEqual(attachment.author, "admin")
+        # unchanged attachments are not downloaded again
+        self.assertEqual(self._run("pull"), [])
+        self.assertEqual(len(self.server.downloads), 2)
+        # the temporary files are removed once applied
+        self.assertFalse([t for t in plan if os.path.exists(t.path)])
+
+    def test_deduplicate(self):
+        self._attach("spec.pdf", "x" * 1000)
+        self._run("push")
+        # the local attachment is re-attached with the same content
+        local = self._attach("spec.pdf", "x" * 1000)
+        self.assertEqual(self._run("push")[0].path, None)
+        self.assertEqual(len(self.server.uploads), 1)
+        # identical content on both sides, without a synchronized state
+        AttachmentDao(self.env).delete("WikiStart", ["spec.pdf"])
+        plan = self._run("pull")
+        self.assertEqual(len(self.server.downloads), 1)
+        self.assertEqual(plan[0].path, None)
+        attachment, data = self._local("spec.pdf")
+        self.assertEqual(attachment.date, local.date)
+
+    def test_replace_failed(self):
+        self._attach("spec.pdf", "remote")
+        self._run("push")
+        self._attach("spec.pdf", "local")
+        AttachmentDao(self.env).delete("WikiStart", ["spec.pdf"])
+        insert = Attachment.insert
+        def failing(attachment, filename, fileobj, size, t=None, db=None):
+            insert(attachment, filename, StringIO("rem"), size, t, db)
+            raise IOError("No space left on device")
+        Attachment.insert = failing
+        try:
+            self.assertRaises(IOError, self._run, "pull")
+        finally:
+            Attachment.insert = insert
+        # the local attachment is kept
+        attachment, data = self._local("spec.pdf")
+        self.assertEqual((attachment.size, data), (5, "local"))
+        self.assertEqual(os.listdir(os.path.dirname(attachment.path)),
+            ["spec.pdf"])
+        self._run("pull")
+        self.assertEqual(self._local("spec.pdf")[1], "remote")
+
+    def test_batch(self):
+        dao = WikiSyncDao(self.env)
+        client = AttachmentClient({}, self.wc)
+        batch = BatchSync(self.env, client, concurrency=1)
+        batch.run([("WikiStart", "push")])
+        self.assertEqual(client.pushes, ["WikiStart"])
+        # the text has not changed, only the new attachment is pushed
+        self._attach("spec.pdf", "x" * 1000)
+        result = batch.run([("WikiStart", "push")])[0]
+        self.assertEqual(result.item.status, "synced")
+        self.assertEqual(client.pushes, ["WikiStart"])
+        self.assertEqual(self.server.uploads, [("WikiStart", "spec.pdf")])
+        # ignored attachments are not transferred
+        self._attach("logo.png", "png")
+        dao.update(dao.find("WikiStart").replace(ignore_attachment=1))
+        batch.run([("WikiStart", "push")])
+        self.assertEqual(len(self.server.uploads), 1)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AttachmentSyncTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
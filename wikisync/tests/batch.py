@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+import unittest, threading, time
+from wikisync.plugin import WikiSyncEnvironment, WikiSyncPlugin
+from wikisync.model import WikiSyncDao
+from wikisync.batch import BatchSync, refresh_remote, PROBE_BATCH_SIZE
+from wikisync.connection import ConnectionPool
+from wikisync.tests.server import TracHandler
+from wikisync.util import WebClient
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.wiki.model import WikiPage
+
+class StubClient(object):
+    """Stands in for WebClient, keeping the remote pages in memory"""
+
+    def __init__(self, pages, delay=0.01):
+        self.pages = pages
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.clones = 0
+        self.scans = []
+        self.timeline = []
+        self.pushes = []
+        self.probes = []
+        self.index_error = None
+        self.index_size = None
+        self.clone_error = None
+
+    def authenticate(self):
+        pass
+
+    def clone(self):
+        with self.lock:
+            self.clones += 1
+        if self.clone_error:
+            raise self.clone_error
+        return self
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+    def _request(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+
+    def get_remote_version(self, name):
+        self._request()
+        if name not in self.pages:
+            return []
+        return [{"name": name, "remote_version": self.pages[name][0]}]
+
+    def pull(self, name, version=None, base=None):
+        self._request()
+        if name not in self.pages:
+            raise RuntimeError("HTTP Error 404: Not Found")
+        return self.pages[name][1]
+
+    def push(self, name, text, comments=None, version=None, base=None):
+        self._request()
+        self.pushes.append(name)
+        version = name in self.pages and self.pages[name][0] + 1 or 1
+        self.pages[name] = (version, text)
+        return {"name": name, "remote_version": version}
+
+    def get_remote_versions(self, names):
+        self._request()
+        self.probes.append(list(names))
+        if self.index_error:
+            raise self.index_error
+        # the versions beyond the 'index_size' first pages are unknown
+        return dict([(name, name in self.pages and self.pages[name][0] or None)
+            for name in names[:self.index_size]])
+
+    def get_remote_attachments(self, name):
+        return []
+
+    def get_remote_list(self):
+        self.scans.append("full")
+        return [{"name": k, "remote_version": v[0]}
+            for k, v in self.pages.items()]
+
+    def get_remote_updates(self, date, days=10):
+        self.scans.append(("incremental", days))
+        if self.timeline is None:
+            raise RuntimeError("HTTP Error 403: Forbidden")
+        return self.timeline
+
+class BatchSyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.dao = WikiSyncDao(self.env)
+        self.client = StubClient(dict([
+            ("RemotePage%s" % i, (2, "Remote text %s" % i))
+            for i in range(10)
+        ]))
+        for i in range(10):
+            self.dao.create(self.dao.factory(
+                name="RemotePage%s" % i,
+                remote_version=2,
+                sync_time=time.time()
+            ))
+
+    def test_pull(self):
+        names = ["RemotePage%s" % i for i in range(10)]
+        batch = BatchSync(self.env, self.client, concurrency=3)
+        results = batch.run([(name, "pull") for name in names], "admin")
+        self.assertEqual([r.name for r in results], names)
+        self.assertTrue(all([r.ok for r in results]))
+        self.assertTrue(self.client.max_active <= 3)
+        self.assertEqual(self.client.clones, 3)
+        for name in names:
+            self.assertEqual(self.dao.find(name).status, "synced")
+            self.assertTrue(WikiPage(self.env, name).text.startswith("Remote"))
+
+    def test_push(self):
+        page = WikiPage(self.env, "LocalPage")
+        page.text = "Local text"
+        page.save("admin", "", "127.0.0.1")
+        batch = BatchSync(self.env, self.client)
+        results = batch.run([("LocalPage", "push")])
+        self.assertTrue(results[0].ok)
+        self.assertEqual(results[0].item.status, "synced")
+        self.assertEqual(self.client.pages["LocalPage"], (1, "Local text"))
+
+    def test_push_unchanged(self):
+        page = WikiPage(self.env, "LocalPage")
+        page.text = "Local\r\ntext"
+        page.save("admin", "", "127.0.0.1")
+        batch = BatchSync(self.env, self.client)
+        batch.run([("LocalPage", "push")])
+        # saving the same text again under a new version
+        page.text = "Local\ntext"
+        page.save("admin", "", "127.0.0.1")
+        self.dao.sync_wiki_data()
+        self.assertEqual(self.dao.find("LocalPage").status, "modified")
+        results = batch.run([("LocalPage", "push")])
+        self.assertTrue(results[0].ok)
+        self.assertEqual(results[0].item.status, "synced")
+        self.assertEqual(results[0].item.sync_local_version, 2)
+        self.assertEqual(self.client.pushes, ["LocalPage"])
+
+    def test_pull_unchanged(self):
+        page = WikiPage(self.env, "RemotePage0")
+        page.text = "Remote text 0"
+        page.save("admin", "", "127.0.0.1")
+        batch = BatchSync(self.env, self.client)
+        results = batch.run([("RemotePage0", "pull")], "admin")
+        self.assertEqual(results[0].item.status, "synced")
+        self.assertEqual(WikiPage(self.env, "RemotePage0").version, 1)
+        self.assertEqual(results[0].item.sync_local_digest,
+            results[0].item.sync_remote_digest)
+
+    def test_refresh(self):
+        self.client.pages["RemotePage0"] = (5, "Changed")
+        batch = BatchSync(self.env, self.client)
+        results = batch.run([("RemotePage0", "refresh")])
+        self.assertEqual(results[0].item.remote_version, 5)
+        self.assertEqual(self.dao.find("RemotePage0").remote_version, 5)
+
+    def test_refresh_probe(self):
+        names = ["RemotePage%s" % i for i in range(PROBE_BATCH_SIZE)]
+        for name in names[10:]:
+            self.client.pages[name] = (2, "Remote text")
+            self.dao.create(self.dao.factory(name=name, remote_version=2,
+                sync_time=time.time()))
+        self.client.pages["RemotePage0"] = (5, "Changed")
+        del self.client.pages["RemotePage1"]
+        batch = BatchSync(self.env, self.client)
+        results = batch.run([(name, "refresh") for name in names])
+        self.assertEqual([r.item.remote_version for r in results[:3]], 
+            [5, 2, 2])
+        self.assertEqual(self.client.probes, [names])
+        self.assertEqual(self.dao.find("RemotePage0").remote_version, 5)
+        # small batches are refreshed one by one
+        batch.run([(name, "refresh") for name in names[:3]])
+        self.assertEqual(len(self.client.probes), 1)
+        # the versions not found in the first part of the index are
+        # refreshed one by one
+        self.client.index_size = 2
+        self.client.pages["RemotePage2"] = (6, "Changed")
+        results = batch.run([(name, "refresh") for name in names])
+        self.assertEqual(results[2].item.remote_version, 6)
+        # the index cannot be read, the pages are refreshed one by one
+        self.client.index_error = RuntimeError("HTTP Error 403: Forbidden")
+        self.client.pages["RemotePage2"] = (7, "Changed")
+        results = batch.run([(name, "refresh") for name in names])
+        self.assertTrue(all([r.ok for r in results]))
+        self.assertEqual(results[2].item.remote_version, 7)
+        self.assertEqual(len(self.client.probes), 3)
+
+    def test_errors(self):
+        self.dao.create(self.dao.factory(name="Gone", remote_version=1,
+            sync_time=time.time()))
+        collected = []
+        batch = BatchSync(self.env, self.client)
+        results = batch.run([
+            ("Gone", "pull"),
+            ("Unknown", "pull"),
+            ("RemotePage1", "pull"),
+            ("RemotePage2", "delete"),
+        ], callback=collected.append)
+        self.assertEqual([r.ok for r in results], [False, False, True, False])
+        self.assertEqual(len(collected), 4)
+        self.assertEqual(self.dao.find("Gone").status, "missing")
+        # the workers cannot log in
+        self.client.clone_error = RuntimeError("HTTP Error 403: Forbidden")
+        results = BatchSync(self.env, self.client).run([("RemotePage%s" % i,
+            "pull") for i in range(5)])
+        self.assertEqual([r.ok for r in results], [False] * 5)
+        self.assertEqual(str(results[0].error), "HTTP Error 403: Forbidden")
+
+    def test_empty_action(self):
+        self.env.config.set("wikisync", "url", "http://remote")
+        self.env.config.set("wikisync", "transport", "html")
+        responses = []
+        req = Mock(path_info="/wikisync", method="POST", perm=MockPerm(),
+            args={"action": "pull"}, authname="admin", remote_addr="127.0.0.1",
+            get_header=lambda name: name == "X-Requested-With" and
+                "XMLHttpRequest" or None,
+            send=lambda content, ctype, status: responses.append(
+                (content, status)))
+        WikiSyncPlugin(self.env).process_request(req)
+        self.assertEqual(responses, [("[]", 200)])
+
+class RefreshRemoteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.dao = WikiSyncDao(self.env)
+        self.client = StubClient({"PageA": (1, "A"), "PageB": (2, "B")})
+
+    def test_incremental(self):
+        self.assertEqual(refresh_remote(self.env, self.client), "full")
+        self.assertEqual(self.dao.find("PageB").remote_version, 2)
+        self.client.timeline = [{"name": "PageB", "remote_version": 3}]
+        self.assertEqual(refresh_remote(self.env, self.client), "incremental")
+        self.assertEqual(self.client.scans, ["full", ("incremental", 3)])
+        self.assertEqual(self.dao.find("PageA").remote_version, 1)
+        self.assertEqual(self.dao.find("PageB").remote_version, 3)
+        self.assertEqual(refresh_remote(self.env, self.client, full=True), 
+            "full")
+
+    def test_untrusted_window(self):
+        refresh_remote(self.env, self.client)
+        self.dao.set_scan_time(time.time() - 8 * 86400, full=True)
+        self.assertEqual(refresh_remote(self.env, self.client), "full")
+        self.client.timeline = None
+        self.assertEqual(refresh_remote(self.env, self.client), "full")
+        self.assertEqual(self.client.scans[-2:], 
+            [("incremental", 3), "full"])
+
+class RemoteSyncTestCase(unittest.TestCase):
+    """Synchronizes with a fake trac server, as bench/sync_e2e.py does"""
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.dao = WikiSyncDao(self.env)
+        self.server = TracHandler.create_server(pages=5, auth="digest",
+            password="secret").start()
+        self.pool = ConnectionPool()
+        self.wc = WebClient(self.server.url, "admin", "secret",
+            pool=self.pool)
+
+    def tearDown(self):
+        self.wc.close()
+        self.pool.clear()
+        self.server.stop()
+
+    def _run(self, action):
+        tasks = [(item.name, action) for item in self.dao.query()]
+        results = BatchSync(self.env, self.wc).run(tasks)
+        self.assertEqual([r.error for r in results if not r.ok], [])
+        return results
+
+    def test_sync(self):
+        self.assertEqual(refresh_remote(self.env, self.wc), "full")
+        self.assertEqual(len(self._run("pull")), 5)
+        self.assertEqual(WikiPage(self.env, "BenchPage00002").text,
+            self.server.pages["BenchPage00002"][0][1])
+        page = WikiPage(self.env, "BenchPage00002")
+        page.text = "Edited locally"
+        page.save("admin", "", "127.0.0.1")
+        self.assertEqual([r.item.remote_version 
+            for r in self._run("push") if r.name == "BenchPage00002"], [2])
+        self.assertEqual(self.server.pages["BenchPage00002"][-1][1],
+            "Edited locally")
+        self.server.pages["BenchPage00003"].append((time.time(), "Changed"))
+        self.assertEqual(refresh_remote(self.env, self.wc), "incremental")
+        self.assertEqual(self.dao.find("BenchPage00003").status, "outdated")
+        self.assertEqual(len(self.server.sessions), 1)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(BatchSyncTestCase, "test"))
+    suite.addTest(unittest.makeSuite(RefreshRemoteTestCase, "test"))
+    suite.addTest(unittest.makeSuite(RemoteSyncTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import unittest, tempfile, shutil, urllib2
+from wikisync.cache import ResponseCache, CacheHandler
+from wikisync.connection import ConnectionPool, KeepAliveHandler
+from wikisync.tests.server import TestServer, RequestHandler
+from wikisync.util import WebClient
+
+class ValidatingHandler(RequestHandler):
+    """Serves pages with an ETag, or a Last-Modified header for paths
+    starting with '/dated', replying '304' to matching validators."""
+
+    def do_GET(self):
+        server = self.server.test_server
+        body = server.pages.get(self.path.split("?")[0], "x" * 1000)
+        if self.path.startswith("/nostore"):
+            self.send(body, headers={"ETag": '"1"',
+                "Cache-Control": "no-store"})
+        elif self.path.startswith("/dated"):
+            modified = "Sat, 01 Jan 2011 00:00:00 GMT"
+            if self.headers.getheader("If-Modified-Since") == modified:
+                self.send("", 304)
+            else:
+                self.send(body, headers={"Last-Modified": modified})
+        else:
+            etag = '"%s"' % hash(body)
+            if self.headers.getheader("If-None-Match") == etag:
+                self.send("", 304, headers={"ETag": etag})
+            else:
+                self.send(body, headers={"ETag": etag})
+
+class CacheHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TestServer(ValidatingHandler).start()
+        self.server.pages = {}
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.directory, max_size=2500)
+        self.pool = ConnectionPool()
+        self.opener = self._opener("user")
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def _opener(self, namespace):
+        return urllib2.build_opener(KeepAliveHandler(self.pool),
+            CacheHandler(self.cache, namespace))
+
+    def _get(self, path, opener=None):
+        f = (opener or self.opener).open(self.server.url + path)
+        try:
+            return f.code, f.read()
+        finally:
+            f.close()
+
+    def test_etag(self):
+        self.assertEqual(self._get("/page"), (200, "x" * 1000))
+        self.assertEqual(self._get("/page"), (200, "x" * 1000))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["size"], 1000)
+        self.server.pages["/page"] = "changed"
+        self.assertEqual(self._get("/page"), (200, "changed"))
+        self.assertEqual(self.cache.stats()["size"], 7)
+        # the connection is reused after '304' responses
+        self.assertEqual(self.server.connections, 1)
+
+    def test_last_modified(self):
+        self._get("/dated")
+        self.assertEqual(self._get("/dated"), (200, "x" * 1000))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_no_store(self):
+        self._get("/nostore")
+        self._get("/nostore")
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["entries"]), (0, 0))
+
+    def test_partial_read(self):
+        f = self.opener.open(self.server.url + "/page")
+        f.read(10)
+        f.close()
+        self.assertEqual(self.cache.stats()["entries"], 1)
+        self.assertEqual(self._get("/page"), (200, "x" * 1000))
+
+    def test_namespace(self):
+        self._get("/page")
+        self._get("/page", self._opener("other"))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["entries"]), (0, 2))
+
+    def test_lru_eviction(self):
+        self._get("/page1")
+        self._get("/page2")
+        self._get("/page1")
+        self._get("/page3")
+        stats = self.cache.stats()
+        self.assertEqual((stats["entries"], stats["evicted"]), (2, 1))
+        self._get("/page1")
+        self.assertEqual(self.cache.stats()["hits"], 2)
+        self._get("/page2")
+        self.assertEqual(self.cache.stats()["hits"], 2)
+
+    def test_reload(self):
+        self._get("/page")
+        cache = ResponseCache(self.directory, max_size=2500)
+        self.assertEqual(cache.stats()["entries"], 1)
+        self.cache = cache
+        self._get("/page", self._opener("user"))
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_web_client(self):
+        wc = WebClient(self.server.url, pool=self.pool, cache=self.cache)
+        self.server.pages["/wiki/Page"] = "text"
+        self.assertEqual(wc.pull("Page"), "text")
+        self.assertEqual(wc.clone().pull("Page"), "text")
+        self.assertEqual(wc.stats()["cache_hits"], 1)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CacheHandlerTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import unittest, threading, time, urllib2, zlib, gzip
+from StringIO import StringIO
+from wikisync.connection import ConnectionPool, KeepAliveHandler, \
+    DECODE_CHUNK_SIZE
+from wikisync.tests.server import TestServer, RequestHandler
+from wikisync.util import WebClient
+
+class PageHandler(RequestHandler):
+
+    def do_GET(self):
+        if self.path.startswith("/close"):
+            self.send("closing", headers={"Connection": "close"})
+            self.close_connection = 1
+        elif self.path.startswith("/slow"):
+            time.sleep(0.1)
+            self.send("slow")
+        else:
+            self.send("x" * 1000)
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TestServer(PageHandler).start()
+        self.pool = ConnectionPool(max_connections=2, idle_timeout=60)
+        self.opener = urllib2.build_opener(KeepAliveHandler(self.pool))
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+
+    def _get(self, path):
+        f = self.opener.open(self.server.url + path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_reuse(self):
+        for i in range(5):
+            self.assertEqual(len(self._get("/page%s" % i)), 1000)
+        stats = self.pool.stats()
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["reused"], 4)
+        self.assertEqual(stats["idle"], 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_partial_read(self):
+        f = self.opener.open(self.server.url + "/page")
+        f.read(10)
+        f.close()
+        self._get("/page")
+        self.assertEqual(self.pool.stats()["reused"], 1)
+
+    def test_connection_close(self):
+        self._get("/close")
+        self._get("/page")
+        stats = self.pool.stats()
+        self.assertEqual(stats["created"], 2)
+        self.assertEqual(stats["discarded"], 1)
+
+    def test_stale_connection(self):
+        self._get("/page")
+        # drop the server side of the idle connection
+        for conn, last_used in self.pool._idle.values()[0]:
+            conn.sock.shutdown(2)
+        self.assertEqual(len(self._get("/page")), 1000)
+        self.assertEqual(self.pool.stats()["created"], 2)
+
+    def test_idle_eviction(self):
+        self._get("/page")
+        self.pool.idle_timeout = 0
+        time.sleep(0.01)
+        self.pool.evict()
+        stats = self.pool.stats()
+        self.assertEqual((stats["idle"], stats["evicted"]), (0, 1))
+
+    def test_max_connections(self):
+        threads = [threading.Thread(target=self._get, args=("/slow",))
+            for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = self.pool.stats()
+        self.assertEqual(stats["created"], 2)
+        self.assertEqual(stats["reused"], 4)
+        self.assertEqual(stats["active"], 0)
+
+    def test_web_client(self):
+        for i in range(3):
+            wc = WebClient(self.server.url, pool=self.pool)
+            wc.pull("Page%s" % i)
+            wc.close()
+        self.assertEqual(wc.stats()["created"], 1)
+        self.assertEqual(self.server.connections, 1)
+
+def compress(data, encoding):
+    if encoding == "gzip":
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode="wb")
+        f.write(data)
+        f.close()
+        return buf.getvalue()
+    elif encoding == "deflate":
+        return zlib.compress(data)
+    # raw deflate stream, without the zlib header
+    return zlib.compress(data)[2:-4]
+
+class CompressingHandler(RequestHandler):
+
+    def do_GET(self):
+        body = "".join(["line %s of the page\n" % i for i in range(50000)])
+        encoding = self.path[1:]
+        accepted = self.headers.getheader("Accept-Encoding") or ""
+        self.server.test_server.accepted = accepted
+        if encoding and "deflate" in accepted:
+            self.send(compress(body, encoding), headers={
+                "Content-Encoding": encoding == "raw" and "deflate" \
+                    or encoding})
+        else:
+            self.send(body)
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TestServer(CompressingHandler).start()
+        self.pool = ConnectionPool()
+        self.opener = urllib2.build_opener(KeepAliveHandler(self.pool))
+        self.expected = "".join(["line %s of the page\n" % i
+            for i in range(50000)])
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+
+    def _get(self, path, opener=None):
+        f = (opener or self.opener).open(self.server.url + path)
+        try:
+            return f, f.read()
+        finally:
+            f.close()
+
+    def test_encodings(self):
+        for encoding in ("gzip", "deflate", "raw"):
+            f, data = self._get("/%s" % encoding)
+            self.assertEqual(data, self.expected)
+            self.assertEqual(f.info().getheader("Content-Encoding"), None)
+            self.assertEqual(f.transfer.decoded, len(self.expected))
+            self.assertTrue(f.transfer.received < len(self.expected) / 5)
+        self.assertEqual(self.server.accepted, "gzip, deflate")
+        stats = self.pool.stats()
+        self.assertEqual(stats["decoded"], 3 * len(self.expected))
+        self.assertEqual(stats["reused"], 2)
+
+    def test_identity(self):
+        f, data = self._get("/")
+        self.assertEqual(data, self.expected)
+        self.assertEqual((f.transfer.received, f.transfer.decoded),
+            (len(self.expected), len(self.expected)))
+
+    def test_streaming(self):
+        f = self.opener.open(self.server.url + "/gzip")
+        self.assertEqual(f.read(100), self.expected[:100])
+        # only the compressed chunks required are read from the socket
+        self.assertTrue(f.transfer.received <= DECODE_CHUNK_SIZE)
+        self.assertTrue(f.transfer.decoded < len(self.expected))
+        self.assertEqual(f.readline(), self.expected[100:].split("\n")[0] +
+            "\n")
+        f.close()
+
+    def test_disabled(self):
+        opener = urllib2.build_opener(KeepAliveHandler(self.pool,
+            accept_encoding=False))
+        f, data = self._get("/gzip", opener)
+        self.assertEqual(data, self.expected)
+        self.assertEqual(self.server.accepted, "identity")
+
+    def test_web_client(self):
+        wc = WebClient(self.server.url, pool=self.pool)
+        self.assertEqual(wc.open("gzip").read(), self.expected)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase, "test"))
+    suite.addTest(unittest.makeSuite(CompressionTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -1,6 +1,6 @@
-INSERT INTO wikisync VALUES('Test1',NULL,NULL,NULL,NULL,NULL,NULL);
-INSERT INTO wikisync VALUES('WikiRestructuredText',NULL,NULL,NULL,NULL,NULL,NULL);
-INSERT INTO wikisync VALUES('WikiStart',NULL,NULL,NULL,NULL,NULL,1);
+INSERT INTO wikisync(name,ignore,ignore_attachment,sync_time,sync_remote_version,sync_local_version,remote_version,local_version,status) VALUES('Test1',NULL,NULL,NULL,NULL,NULL,NULL,NULL,'unknown');
+INSERT INTO wikisync(name,ignore,ignore_attachment,sync_time,sync_remote_version,sync_local_version,remote_version,local_version,status) VALUES('WikiRestructuredText',NULL,NULL,NULL,NULL,NULL,NULL,1,'unknown');
+INSERT INTO wikisync(name,ignore,ignore_attachment,sync_time,sync_remote_version,sync_local_version,remote_version,local_version,status) VALUES('WikiStart',NULL,NULL,NULL,NULL,NULL,1,3,'unknown');
 
 INSERT INTO wiki VALUES('CamelCase',1,1330486464187932,'trac','127.0.0.1','CamelCase',NULL,NULL);
 INSERT INTO wiki VALUES('InterMapTxt',1,1330486464189413,'trac','127.0.0.1','InterMapTxt',NULL,NULL);
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+import unittest, time, urllib2
+from StringIO import StringIO
+from wikisync.plugin import WikiSyncEnvironment
+from wikisync.model import WikiSyncDao
+from wikisync.batch import BatchSync
+from wikisync.delta import make_delta, apply_delta, read_delta, save_delta, \
+    pull_delta, push_delta
+from wikisync.metrics import METRICS
+from wikisync.util import WebClient, safe_str, text_digest, jsonify
+from trac.perm import PermissionError
+from trac.core import Component, implements
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.wiki.api import IWikiPageManipulator
+from trac.wiki.model import WikiPage
+
+def make_text(lines=500, changed=None):
+    return u"".join([u"Line %s of the spec é中\n" % \
+        (i == changed and "changed" or i) for i in range(lines)])
+
+def make_env():
+    env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+    WikiSyncEnvironment(env).upgrade_environment(env.get_db_cnx())
+    return env
+
+def save(env, name, text):
+    page = WikiPage(env, name)
+    page.text = text
+    page.save("admin", "", "127.0.0.1")
+    return page.version
+
+def make_req(body, ctype="application/json", perm=None):
+    return Mock(read=lambda: body, perm=perm or MockPerm(), authname="peer",
+        remote_addr="127.0.0.1", args={}, get_header=lambda name:
+            name == "Content-Type" and ctype or None)
+
+class DenyPerm(MockPerm):
+    """Grants all the permissions but the denied ones"""
+
+    def __init__(self, *denied):
+        self.denied = denied
+
+    def has_permission(self, action, realm_or_resource=None, id=False,
+                       version=False):
+        return action not in self.denied
+    __contains__ = has_permission
+
+    def require(self, action, realm_or_resource=None, id=False, version=False):
+        if action in self.denied:
+            raise PermissionError(action)
+
+class SpamFilter(Component):
+    """Rejects the wikis containing spam"""
+
+    implements(IWikiPageManipulator)
+
+    def prepare_wiki_page(self, req, page, fields):
+        pass
+
+    def validate_wiki_page(self, req, page):
+        if "spam" in page.text:
+            return [(None, "Spam")]
+        return []
+
+class PeerClient(object):
+    """Stands in for WebClient, serving the requests with the WikiSync
+    functions of a remote environment"""
+
+    pull = WebClient.__dict__["pull"]
+    push = WebClient.__dict__["push"]
+    _format_comment = WebClient.__dict__["_format_comment"]
+
+    def __init__(self, env, baseurl="http://peer", supported=True):
+        self.env = env
+        self.baseurl = baseurl
+        self.supported = supported
+        self.log = None
+        self.requests = []
+
+    def authenticate(self):
+        pass
+
+    def clone(self):
+        return self
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+    def get_remote_attachments(self, name):
+        return []
+
+    def open(self, path, data=None, method="GET", headers=None):
+        self.requests.append((method, path))
+        status, body = 404, ""
+        if path == "wikisync/delta" and self.supported:
+            if method == "POST":
+                status, body = save_delta(self.env, make_req(data.read(),
+                    headers.get("Content-Type")))
+            else:
+                status, body = 200, read_delta(self.env, MockPerm(),
+                    data["name"],
+                    data.get("version"), data.get("base"),
+                    data.get("base_digest"))
+            body = jsonify(body)
+        elif path.startswith("wiki/") and method == "GET":
+            status, body = 200, WikiPage(self.env, path[5:],
+                data.get("version")).text
+        if status != 200:
+            raise urllib2.HTTPError(path, status, "Error", {},
+                StringIO(body))
+        return StringIO(safe_str(body))
+
+    def _close(self, f):
+        f.close()
+
+class DeltaTestCase(unittest.TestCase):
+
+    def test_roundtrip(self):
+        for base, text in [
+            (make_text(), make_text(changed=250)),
+            (make_text(), make_text(400)),
+            (make_text(10), u"Line 0\r\nLine 1 é"),
+            (u"", make_text(10)),
+            (make_text(10), u""),
+        ]:
+            delta = make_delta(base, text)
+            self.assertEqual(apply_delta(base, delta), text)
+        delta = make_delta(make_text(), make_text(changed=250))
+        self.assertTrue(len(jsonify(delta)) < 200)
+        self.assertRaises(ValueError, apply_delta, make_text(10), delta)
+        # e.g. posted by a peer, not made by make_delta()
+        for op in ({"a": 1}, None, 1.5, True, [1]):
+            self.assertRaises(ValueError, apply_delta, u"", [op])
+
+class PeerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.remote = make_env()
+        self.base = make_text()
+        save(self.remote, "SpecPage", self.base)
+        save(self.remote, "SpecPage", make_text(changed=250))
+        self.wc = PeerClient(self.remote)
+
+    def _counter(self, name):
+        return METRICS.snapshot()["counters"].get(name, 0)
+
+    def test_read(self):
+        result = read_delta(self.remote, MockPerm(), "SpecPage", None, 1,
+            text_digest(self.base))
+        self.assertEqual(result["version"], 2)
+        self.assertTrue("delta" in result and not "text" in result)
+        result = read_delta(self.remote, MockPerm(), "SpecPage", None, 1,
+            "other")
+        self.assertEqual(result["text"], make_text(changed=250))
+        self.assertEqual(read_delta(self.remote, MockPerm(),
+            "Missing")["version"], 0)
+        self.assertRaises(PermissionError, read_delta, self.remote,
+            DenyPerm("WIKI_VIEW"), "SpecPage")
+
+    def test_pull(self):
+        saved = self._counter("delta_bytes_saved{transfer=pull}")
+        self.assertEqual(pull_delta(self.wc, "SpecPage", None,
+            (1, self.base)), make_text(changed=250))
+        self.assertTrue(self._counter("delta_bytes_saved{transfer=pull}") -
+            saved > len(safe_str(self.base)) * 0.9)
+        # the whole text is sent when the base differs
+        transfers = self._counter("delta_transfers{transfer=pull}")
+        self.assertEqual(pull_delta(self.wc, "SpecPage", 2,
+            (1, make_text(20))), make_text(changed=250))
+        self.assertEqual(self._counter("delta_transfers{transfer=pull}"),
+            transfers)
+        self.assertEqual(pull_delta(self.wc, "Missing", None,
+            (1, self.base)), None)
+
+    def test_push(self):
+        text = make_text(changed=10)
+        self.assertEqual(push_delta(self.wc, "SpecPage", text, "Edited", 2,
+            (1, self.base)), {"name": "SpecPage", "remote_version": 3})
+        self.assertEqual(WikiPage(self.remote, "SpecPage").text, text)
+        # the remote wiki has changed since, left to the edit form
+        self.assertEqual(push_delta(self.wc, "SpecPage", text, None, 2,
+            (1, self.base)), None)
+        # the remote base differs
+        self.assertEqual(push_delta(self.wc, "SpecPage", text, None, 3,
+            (1, make_text(20))), None)
+
+    def test_save(self):
+        def body(text, version=2):
+            return safe_str(jsonify({"name": "SpecPage", "version": version,
+                "base": 1, "base_digest": text_digest(self.base),
+                "delta": make_delta(self.base, text),
+                "digest": text_digest(text)}))
+        text = make_text(changed=10)
+        # posted by a cross site form
+        self.assertEqual(save_delta(self.remote, make_req(body(text),
+            "text/plain"))[0], 415)
+        self.assertRaises(PermissionError, save_delta, self.remote,
+            make_req(body(text), perm=DenyPerm("WIKI_MODIFY")))
+        self.assertEqual(save_delta(self.remote, make_req(body(text +
+            u"spam")))[0], 400)
+        self.assertEqual(save_delta(self.remote, make_req(safe_str(jsonify({
+            "name": "SpecPage", "version": 2, "base": 1,
+            "base_digest": text_digest(self.base), "delta": [None],
+            "digest": text_digest(text)}))))[0], 412)
+        page = WikiPage(self.remote, "SpecPage")
+        page.readonly = 1
+        page.save("admin", "", "127.0.0.1")
+        self.assertRaises(PermissionError, save_delta, self.remote,
+            make_req(body(text), perm=DenyPerm("WIKI_ADMIN")))
+        self.assertEqual(save_delta(self.remote, make_req(body(text),
+            "application/json; charset=utf-8")),
+            (200, {"name": "SpecPage", "remote_version": 3}))
+        self.assertEqual(WikiPage(self.remote, "SpecPage").text, text)
+
+    def test_unsupported(self):
+        wc = PeerClient(self.remote, "http://unsupported", supported=False)
+        self.assertEqual(wc.pull("SpecPage", None, (1, self.base)),
+            make_text(changed=250))
+        self.assertEqual(wc.pull("SpecPage", None, (1, self.base)),
+            make_text(changed=250))
+        self.assertEqual(wc.requests, [("GET", "wikisync/delta"),
+            ("GET", "wiki/SpecPage"), ("GET", "wiki/SpecPage")])
+
+class DeltaBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_env()
+        self.remote = make_env()
+        self.dao = WikiSyncDao(self.env)
+        self.wc = PeerClient(self.remote)
+        text = make_text()
+        save(self.remote, "SpecPage", text)
+        save(self.env, "SpecPage", text)
+        save(self.env, "SmallPage", u"Small")
+        save(self.remote, "SmallPage", u"Small")
+        for name, text in (("SpecPage", text), ("SmallPage", u"Small")):
+            # created by the wiki change listener
+            self.dao.update(self.dao.find(name).replace(remote_version=1,
+                sync_time=time.time()).synchronized(text_digest(text)))
+
+    def _run(self, action, *names):
+        del self.wc.requests[:]
+        results = BatchSync(self.env, self.wc).run([(name, action)
+            for name in names])
+        self.assertEqual([r.error for r in results if not r.ok], [])
+        return sorted(self.wc.requests)
+
+    def test_pull_push(self):
+        save(self.remote, "SpecPage", make_text(changed=3))
+        save(self.remote, "SmallPage", u"Changed")
+        for name in ("SpecPage", "SmallPage"):
+            self.dao.update(self.dao.find(name).replace(remote_version=2))
+        self.assertEqual(self._run("pull", "SpecPage", "SmallPage"),
+            [("GET", "wiki/SmallPage"), ("GET", "wikisync/delta")])
+        self.assertEqual(WikiPage(self.env, "SpecPage").text,
+            make_text(changed=3))
+        self.assertEqual(self.dao.find("SpecPage").status, "synced")
+        save(self.env, "SpecPage", make_text(changed=4))
+        self.dao.repair_local_versions()
+        self.assertEqual(self._run("push", "SpecPage"),
+            [("POST", "wikisync/delta")])
+        self.assertEqual(WikiPage(self.remote, "SpecPage").text,
+            make_text(changed=4))
+        self.assertEqual(self.dao.find("SpecPage").remote_version, 3)
+        self.assertEqual(self.dao.find("SpecPage").status, "synced")
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DeltaTestCase, "test"))
+    suite.addTest(unittest.makeSuite(PeerTestCase, "test"))
+    suite.addTest(unittest.makeSuite(DeltaBatchTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+import unittest, time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from wikisync import jobs
+from wikisync.jobs import JobQueue, JobRunner, AutoPush, get_autopush
+from wikisync.plugin import WikiSyncEnvironment, WikiSyncPlugin, \
+    DEFAULT_SIGNATURE
+from wikisync.model import WikiSyncDao
+from wikisync.tests.batch import StubClient
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.wiki.model import WikiPage
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.queue = JobQueue(self.env)
+        self.queue.enqueue([("Page%s" % i, "push") for i in range(5)],
+            "admin", "127.0.0.1")
+
+    def test_enqueue(self):
+        self.assertEqual(self.queue.enqueue([("Page0", "pull"),
+            ("Page5", "pull"), ("Page5", "push")]), 1)
+        self.assertEqual([job.name for job in self.queue.list()],
+            ["Page%s" % i for i in range(6)])
+        self.assertRaises(ValueError, self.queue.enqueue, [("Page6", "x")])
+
+    def test_claim(self):
+        claimed = self.queue.claim(3)
+        self.assertEqual([job.name for job in claimed],
+            ["Page0", "Page1", "Page2"])
+        self.assertEqual(claimed[0].attempts, 1)
+        self.assertEqual(len(self.queue.claim(10)), 2)
+        self.assertEqual(self.queue.claim(10), [])
+        self.queue.complete(claimed[0])
+        self.queue.enqueue([("Page0", "pull")])
+        status = self.queue.status()
+        self.assertEqual((status["pending"], status["running"],
+            status["done"]), (1, 4, 1))
+        self.assertTrue(status["throughput"] > 0)
+
+    def test_lease(self):
+        claimed = self.queue.claim(5)
+        # the runner has crashed, the lease has expired
+        reclaimed = self.queue.claim(5, lease=0)
+        self.assertEqual([job.id for job in reclaimed],
+            [job.id for job in claimed])
+        self.assertEqual(reclaimed[0].attempts, 2)
+
+    def test_renew(self):
+        claimed = self.queue.claim(2)
+        time.sleep(0.01)
+        self.queue.renew(claimed[:1])
+        running = self.queue.list(("running",))
+        self.assertTrue(running[0].updated > claimed[0].updated)
+        self.assertEqual(running[1].updated, claimed[1].updated)
+        # the renewed lease has not expired
+        self.assertEqual([job.name for job in self.queue.claim(5,
+            lease=0.005)], ["Page1", "Page2", "Page3", "Page4"])
+
+    def test_fail(self):
+        retry_delay, jobs.RETRY_DELAY = jobs.RETRY_DELAY, 0
+        try:
+            for i in range(3):
+                job = self.queue.claim(1)[0]
+                self.assertEqual((job.name, job.attempts), ("Page0", i + 1))
+                self.queue.fail(job, RuntimeError("HTTP Error 500"))
+        finally:
+            jobs.RETRY_DELAY = retry_delay
+        failed = self.queue.list(("failed",))
+        self.assertEqual([job.name for job in failed], ["Page0"])
+        self.assertEqual(failed[0].error, "HTTP Error 500")
+
+    def test_retry_delay(self):
+        self.assertEqual(self.queue.next_retry(), None)
+        self.queue.fail(self.queue.claim(1)[0], "timeout")
+        self.assertEqual(self.queue.claim(1)[0].name, "Page1")
+        self.assertTrue(self.queue.next_retry() > time.time() + 25)
+
+    def test_changes(self):
+        since = self.queue.list()[-1].updated
+        self.assertEqual(self.queue.changes(since), [])
+        time.sleep(0.01)
+        claimed = self.queue.claim(2)
+        self.queue.complete(claimed[1])
+        self.assertEqual([job.name for job in self.queue.changes(since)],
+            ["Page0", "Page1"])
+
+    def test_cancel(self):
+        self.queue.claim(1)
+        self.assertEqual(self.queue.cancel(), 4)
+        self.assertEqual([job.name for job in self.queue.list()], ["Page0"])
+
+    def test_endpoint(self):
+        responses = []
+        def request(method, **args):
+            req = Mock(path_info="/wikisync/jobs", method=method, args=args,
+                perm=MockPerm(), authname="admin", remote_addr="127.0.0.1",
+                send=lambda content, ctype, status: responses.append(
+                    json.loads(content)))
+            WikiSyncPlugin(self.env).process_request(req)
+            return responses[-1]
+        dao = WikiSyncDao(self.env)
+        dao.create(dao.factory(name="Page0", remote_version=1))
+        since = self.queue.list()[-1].updated
+        time.sleep(0.01)
+        done, failed = self.queue.claim(2)
+        self.queue.complete(done)
+        self.queue.fail(failed, "HTTP Error 403", max_attempts=1)
+        status = request("POST", action="cancel", since=str(since))
+        self.assertEqual((status["pending"], status["running"]), (0, 0))
+        self.assertEqual([(job["name"], job["action"], job["error"])
+            for job in status["jobs"]], [("Page0", "push", None),
+            ("Page1", "push", "HTTP Error 403")])
+        self.assertEqual(status["jobs"][0]["item"][0], "Page0")
+        self.assertEqual(status["jobs"][1]["item"], None)
+        self.assertFalse("jobs" in request("GET", since=status["since"]))
+
+class JobRunnerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.client = StubClient({}, delay=0)
+        self.names = ["LocalPage%s" % i for i in range(5)]
+        for name in self.names + ["LocalPage5"]:
+            page = WikiPage(self.env, name)
+            page.text = "Local text"
+            page.save("admin", "", "127.0.0.1")
+        self.queue = JobQueue(self.env)
+        self.queue.enqueue([(name, "push") for name in self.names])
+        self.retry_delay, jobs.RETRY_DELAY = jobs.RETRY_DELAY, 0.2
+
+    def tearDown(self):
+        jobs.RETRY_DELAY = self.retry_delay
+
+    def _unavailable(self, name):
+        # the first push of the page fails
+        push = self.client.push
+        def unavailable(page, *args, **kwargs):
+            if page == name and name not in self.client.pushes:
+                self.client.pushes.append(name)
+                raise RuntimeError("HTTP Error 503")
+            return push(page, *args, **kwargs)
+        self.client.push = unavailable
+
+    def test_run(self):
+        runner = JobRunner(self.env, self.client, concurrency=2)
+        self.assertEqual(runner.run(), 5)
+        self.assertEqual(sorted(self.client.pushes), self.names)
+        self.assertEqual(self.queue.status()["done"], 5)
+        self.assertEqual(WikiSyncDao(self.env).summary()["synced"], 5)
+
+    def test_resume(self):
+        def crash(result):
+            raise KeyboardInterrupt()
+        claim_size, jobs.CLAIM_SIZE = jobs.CLAIM_SIZE, 1
+        try:
+            runner = JobRunner(self.env, self.client, concurrency=1)
+            self.assertRaises(KeyboardInterrupt, runner.run, None, crash)
+            self.assertEqual(self.client.pushes, ["LocalPage0"])
+            self.assertEqual(runner.run(), 4)
+        finally:
+            jobs.CLAIM_SIZE = claim_size
+        # the completed transfer is not repeated
+        self.assertEqual(self.client.pushes, self.names)
+
+    def test_retry(self):
+        self._unavailable("LocalPage1")
+        runner = JobRunner(self.env, self.client, concurrency=2)
+        # the failed attempt is retried within the run
+        self.assertEqual(runner.run(), 6)
+        self.assertEqual(self.queue.status()["done"], 5)
+        # unless beyond the deadline
+        self.queue.enqueue([("LocalPage5", "push")])
+        self._unavailable("LocalPage5")
+        self.assertEqual(runner.run(time.time() + 0.1), 1)
+        self.assertEqual(self.queue.list()[0].attempts, 1)
+
+    def test_renew(self):
+        running = []
+        def callback(result):
+            running.append(self.queue.list(("running",)))
+        lease, jobs.DEFAULT_LEASE = jobs.DEFAULT_LEASE, 0
+        try:
+            JobRunner(self.env, self.client, concurrency=1).run(None,
+                callback)
+        finally:
+            jobs.DEFAULT_LEASE = lease
+        # renewed at each checkpoint
+        self.assertTrue(running[0][-1].updated < running[1][-1].updated)
+
+    def test_start(self):
+        self._unavailable("LocalPage1")
+        clients = []
+        def client_factory():
+            clients.append(self.client)
+            return self.client
+        self.assertTrue(jobs.start_runner(self.env, client_factory))
+        thread = jobs._RUNNERS[self.env.path][0]
+        deadline = time.time() + 5
+        while time.time() < deadline and self.queue.status()["done"] < 4:
+            time.sleep(0.02)
+        # waiting for the retry, the queued jobs are run by the same runner
+        self.queue.enqueue([("LocalPage5", "push")])
+        self.assertFalse(jobs.start_runner(self.env, client_factory))
+        while time.time() < deadline and self.queue.status()["done"] < 6:
+            time.sleep(0.02)
+        self.assertEqual(self.queue.status()["done"], 6)
+        self.assertEqual(len(clients), 1)
+        thread.join(5)
+
+class AutoPushTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.client = StubClient({}, delay=0)
+        self.queue = JobQueue(self.env)
+        jobs._AUTOPUSH.clear()
+
+    def tearDown(self):
+        jobs._AUTOPUSH.clear()
+
+    def _save(self, name, text, comment=""):
+        page = WikiPage(self.env, name)
+        page.text = text
+        page.save("admin", comment, "127.0.0.1")
+
+    def _refreshed(self, *names):
+        # missing remotely, as known by a refresh
+        dao = WikiSyncDao(self.env)
+        for name in names:
+            dao.update(dao.find(name).replace(sync_time=time.time()))
+
+    def test_flush(self):
+        for name in ("LocalPage0", "LocalPage1", "UnknownPage"):
+            self._save(name, "Local text")
+        self._refreshed("LocalPage0", "LocalPage1")
+        autopush = AutoPush(self.env, lambda: self.client, delay=60)
+        now = time.time()
+        for i in range(3):
+            autopush.schedule("LocalPage0", now + i)
+        autopush.schedule("LocalPage1", now)
+        # the remote state of a page must be known
+        autopush.schedule("UnknownPage", now)
+        self.assertEqual(autopush.flush(now + 61), 1)
+        self.assertEqual(autopush.pending(), ["LocalPage0"])
+        self.assertEqual(autopush.flush(now + 61), 0)
+        # a page being pushed is pushed again once done
+        self.queue.enqueue([("LocalPage0", "push")])
+        self.queue.claim()
+        self.assertEqual(autopush.flush(now + 62), 0)
+        self.assertEqual(autopush.pending(), ["LocalPage0"])
+
+    def test_edits(self):
+        self.env.config.set("wikisync", "url", "http://remote")
+        self.env.config.set("wikisync", "autopush_delay", "0.2")
+        self.env.config.set("wikisync", "ignorelist", "Ignored*")
+        self._save("LocalPage", "Created")
+        self._refreshed("LocalPage")
+        self.env.config.set("wikisync", "autopush", "true")
+        autopush = get_autopush(self.env, lambda: self.client)
+        for i in range(3):
+            self._save("LocalPage", "Edit %s" % i)
+        self._save("IgnoredPage", "Ignored")
+        self._save("PulledPage", "Pulled", DEFAULT_SIGNATURE)
+        self.assertEqual(autopush.pending(), ["LocalPage"])
+        deadline = time.time() + 5
+        while time.time() < deadline and \
+            WikiSyncDao(self.env).find("LocalPage").status != "synced":
+            time.sleep(0.05)
+        # the successive edits are pushed at once
+        self.assertEqual(self.client.pushes, ["LocalPage"])
+        self.assertEqual(self.client.pages["LocalPage"][1], "Edit 2")
+        self.assertEqual(self.queue.status()["done"], 1)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(JobQueueTestCase, "test"))
+    suite.addTest(unittest.makeSuite(JobRunnerTestCase, "test"))
+    suite.addTest(unittest.makeSuite(AutoPushTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import unittest, time
+from wikisync.metrics import Metrics, RollingHistogram, PageTrace, METRICS
+from wikisync.batch import BatchSync
+from wikisync.plugin import WikiSyncEnvironment
+from wikisync.model import WikiSyncDao
+from wikisync.tests.batch import StubClient
+from wikisync.util import json
+from trac.test import EnvironmentStub
+
+class RollingHistogramTestCase(unittest.TestCase):
+
+    def test_snapshot(self):
+        histogram = RollingHistogram(window=60, buckets=(0.1, 1.0))
+        for value in (0.05, 0.05, 0.5, 2.0):
+            histogram.observe(value, now=1000)
+        snapshot = histogram.snapshot(now=1000)
+        self.assertEqual(snapshot["count"], 4)
+        self.assertEqual(snapshot["sum"], 2.6)
+        self.assertEqual(snapshot["buckets"],
+            [(0.1, 2), (1.0, 3), (float("inf"), 4)])
+        self.assertEqual((snapshot["p50"], snapshot["p90"]), (0.1, 1.0))
+
+    def test_window(self):
+        histogram = RollingHistogram(window=60, buckets=(0.1, 1.0))
+        histogram.observe(0.5, now=1000)
+        histogram.observe(0.5, now=1030)
+        self.assertEqual(histogram.snapshot(now=1055)["count"], 2)
+        self.assertEqual(histogram.snapshot(now=1062)["count"], 1)
+        self.assertEqual(histogram.snapshot(now=1100)["count"], 0)
+        self.assertEqual(histogram.snapshot(now=1100)["p50"], None)
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_timed(self):
+        with self.metrics.timed("db"):
+            # nested blocks of the same phase are timed once
+            with self.metrics.timed("db"):
+                time.sleep(0.01)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot["phases"]["db"]["count"], 1)
+        self.assertTrue(snapshot["phases"]["db"]["sum"] >= 0.01)
+
+    def test_tracing(self):
+        trace = PageTrace("WikiStart", "pull")
+        with self.metrics.tracing(trace):
+            self.metrics.count("requests")
+            self.metrics.count("bytes_received", 100)
+            with self.metrics.timed("http"):
+                pass
+        self.metrics.count("requests")
+        self.assertEqual(trace.counters, {"requests": 1,
+            "bytes_received": 100})
+        self.assertEqual(trace.phases.keys(), ["http"])
+        self.assertEqual(self.metrics.snapshot()["counters"]["requests"], 2)
+
+    def test_prometheus(self):
+        self.metrics.count("pages", action="pull", outcome="ok")
+        self.metrics.observe("http", 0.02)
+        text = self.metrics.prometheus()
+        self.assertTrue("# TYPE wikisync_pages_total counter\n"
+            'wikisync_pages_total{action="pull",outcome="ok"} 1\n' in text)
+        self.assertTrue('wikisync_phase_seconds_bucket{phase="http",'
+            'le="0.025"} 1\n' in text)
+        self.assertTrue('wikisync_phase_seconds_bucket{phase="http",'
+            'le="+Inf"} 1\n' in text)
+        self.assertTrue('wikisync_phase_seconds_count{phase="http"} 1\n'
+            in text)
+
+class BatchMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.env.config.set("wikisync", "log_metrics", "true")
+        self.client = StubClient({"RemotePage": (2, "Remote text")}, delay=0)
+        dao = WikiSyncDao(self.env)
+        dao.create(dao.factory(name="RemotePage", remote_version=2,
+            sync_time=time.time()))
+        METRICS.reset()
+
+    def test_batch(self):
+        lines = []
+        batch = BatchSync(self.env, self.client)
+        batch.log.info = lines.append
+        batch.run([("RemotePage", "pull"), ("Unknown", "pull")])
+        snapshot = METRICS.snapshot()
+        self.assertEqual(snapshot["counters"]["pages{action=pull,outcome=ok}"],
+            1)
+        self.assertEqual(
+            snapshot["counters"]["pages{action=pull,outcome=failed}"], 1)
+        self.assertEqual(snapshot["phases"]["batch"]["count"], 1)
+        self.assertEqual(snapshot["phases"]["page"]["count"], 2)
+        self.assertEqual(snapshot["phases"]["wiki_save"]["count"], 1)
+        self.assertTrue(snapshot["counters"]["db_calls"] > 0)
+        records = [json.loads(line.split(" ", 1)[1]) for line in lines
+            if line.startswith("wikisync.page ")]
+        self.assertEqual([(r["name"], r["ok"]) for r in records],
+            [("Unknown", False), ("RemotePage", True)])
+        self.assertTrue("wiki_save" in records[1]["phases"])
+        self.assertTrue(records[1]["counters"]["db_calls"] > 0)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RollingHistogramTestCase, "test"))
+    suite.addTest(unittest.makeSuite(MetricsTestCase, "test"))
+    suite.addTest(unittest.makeSuite(BatchMetricsTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
-import unittest
+import unittest, re
 from wikisync.plugin import WikiSyncEnvironment
-from wikisync.model import WikiSyncDao
+from wikisync.model import WikiSyncDao, WIKISYNC_STATUSES, \
+    WIKISYNC_TABLE_FIELDS, WIKISYNC_EXTERNAL_FIELDS
+from wikisync.util import RegExpFilter
 from trac.test import EnvironmentStub
+from trac.wiki.model import WikiPage
 from pkg_resources import resource_filename
 
 class WikiSyncModelTestCase(unittest.TestCase):
@@ -26,10 +29,103 @@ class WikiSyncModelTestCase(unittest.TestCase):
         for name in ["CamelCase", "InterMapTxt", "NewPage", "WikiRestructuredTextLinks"]:
             self.assertTrue(self.dao.find(name) is not None)
             
+    def test_sync_remote_data(self):
+        self.dao.sync_remote_data([
+            {"name":"WikiStart", "remote_version":5},
+            {"name":"RemotePage", "remote_version":2},
+            {"name":"RemotePage", "remote_version":3},
+            {"name":"TracGuide", "remote_version":1},
+        ], RegExpFilter("Trac*"))
+        self.assertTrue(self.dao.find("Test1") is None)
+        item = self.dao.find("WikiRestructuredText")
+        self.assertEqual(item.remote_version, None)
+        self.assertTrue(item.sync_time)
+        item = self.dao.find("WikiStart")
+        self.assertEqual((item.remote_version, item.local_version), (5, 3))
+        item = self.dao.find("RemotePage")
+        self.assertEqual(item.remote_version, 3)
+        self.assertEqual(item.status, "missing")
+        self.assertEqual(self.dao.find("TracGuide").status, "ignored")
+        self.assertEqual(len([item for item in self.dao.all()]), 4)
+
+    def test_local_version(self):
+        self.plugin.wiki_page_changed(WikiPage(self.env, "WikiStart"), 
+            3, None, "", "admin", "127.0.0.1")
+        self.assertEqual(self.dao.find("WikiStart").local_version, 3)
+        self.dao.set_local_version("WikiStart", 1)
+        self.dao.set_local_version("Test1", 2)
+        self.assertEqual(self.dao.repair_local_versions(), 2)
+        self.assertEqual(self.dao.find("WikiStart").local_version, 3)
+        self.assertEqual(self.dao.find("Test1").local_version, None)
+
+    def test_status(self):
+        self.dao.sync_remote_data([{"name":"WikiStart", "remote_version":1}])
+        self.assertEqual(self._status("WikiStart"), "conflict")
+        self.dao.update(self.dao.find("WikiStart").synchronized())
+        self.assertEqual(self._status("WikiStart"), "synced")
+        self.dao.set_local_version("WikiStart", 4)
+        self.assertEqual(self._status("WikiStart"), "modified")
+        self.dao.set_local_version("WikiStart", None)
+        self.assertEqual(self._status("WikiStart"), "missing")
+        @self.env.with_transaction()
+        def do_save(db):
+            db.cursor().execute("UPDATE wikisync SET status=NULL")
+        self.assertEqual(self.dao.repair_status(), 2)
+        self.assertEqual(self._status("WikiStart"), "missing")
+        self.assertEqual(self.dao.summary()["missing"], 1)
+
+    def _status(self, name):
+        """Returns the persisted status, checked against the model"""
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute("SELECT status FROM wikisync WHERE name=%s", (name,))
+        status = cursor.fetchone()[0]
+        self.assertEqual(status, self.dao.find(name).status)
+        return status
+
     def test_all(self):
         results = [item for item in self.dao.all()]
         self.assertEqual(len(results), 3)
 
+    def test_query(self):
+        self.dao.sync_wiki_data()
+        # covers the combinations of remote, synced and local versions
+        for i, (rv, srv, slv) in enumerate([
+            (None, None, None), (1, None, None), (1, 1, 1), (2, 1, 1),
+            (1, 1, 3), (2, 1, 3), (1, 2, 3), (1, 1, 4), (None, 1, 1),
+            (None, None, None), (1, 1, 3)]):
+            self.dao.create(self.dao.factory(name="Page%s" % i,
+                remote_version=rv, sync_remote_version=srv,
+                sync_local_version=slv, sync_time=1, ignore=i == 0 or None))
+        @self.env.with_transaction()
+        def do_save(db):
+            cursor = db.cursor()
+            for i in range(11):
+                if i % 4:
+                    cursor.execute("""
+                        INSERT INTO wiki(name, version, time, author, ipnr, 
+                            text) VALUES(%s, 3, 0, 'trac', '127.0.0.1', '')
+                    """, ("Page%s" % i,))
+        self.assertEqual(self.dao.repair_local_versions(), 8)
+        items = list(self.dao.all())
+        self.assertEqual(self.dao.count(), len(items))
+        summary = self.dao.summary()
+        for status in WIKISYNC_STATUSES:
+            expected = sorted([item for item in items 
+                if item.status == status])
+            self.assertEqual(self.dao.query(status=[status]), expected)
+            self.assertEqual(self.dao.count(status=status), len(expected))
+            self.assertEqual(summary[status], len(expected))
+        self.assertEqual(self.dao.count(status=[]), 0)
+        self.assertEqual([item.name for item in self.dao.query(
+            prefix="page", limit=3, offset=8)], ["Page7", "Page8", "Page9"])
+        self.assertEqual(self.dao.count(prefix="Wiki"), 3)
+        self.assertEqual(self.dao.count(prefix="Wiki%"), 0)
+        results = self.dao.query(status=["synced", "conflict"], 
+            order="local_version", desc=True)
+        self.assertEqual([item.local_version for item in results],
+            sorted([item.local_version for item in results], reverse=True))
+        self.assertRaises(AssertionError, self.dao.query, order="1;")
+
     def test_validate(self):
         item = self.dao.factory()
         self.assertRaises(AssertionError, item.validate)
@@ -76,9 +172,74 @@ class WikiSyncModelTestCase(unittest.TestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0], (1, 11))
 
+    def test_model_keys(self):
+        # the javascript model maps the json rows by position
+        script = open(resource_filename("wikisync", "htdocs/wikisync.js"))
+        try:
+            keys = re.search(r"MODEL_KEYS = \[(.*?)\]", script.read(),
+                re.S).group(1)
+        finally:
+            script.close()
+        self.assertEqual(tuple(re.findall(r"'(\w+)'", keys)),
+            WIKISYNC_TABLE_FIELDS + WIKISYNC_EXTERNAL_FIELDS + ("error",))
+
+class WikiChangeListenerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.dao = WikiSyncDao(self.env)
+
+    def _save(self, name, text):
+        page = WikiPage(self.env, name)
+        page.text = text
+        page.save("admin", "", "127.0.0.1")
+        return page
+
+    def test_listener(self):
+        self._save("Page", "one")
+        self.assertEqual(self.dao.find("Page").local_version, 1)
+        self._save("Page", "two")
+        self._save("Page", "three")
+        self.assertEqual(self.dao.find("Page").local_version, 3)
+        WikiPage(self.env, "Page").delete(version=3)
+        self.assertEqual(self.dao.find("Page").local_version, 2)
+        self.dao.update(self.dao.find("Page").replace(remote_version=1))
+        WikiPage(self.env, "Page").delete()
+        item = self.dao.find("Page")
+        self.assertEqual((item.local_version, item.remote_version), 
+            (None, 1))
+        self._save("Page", "again")
+        self.assertEqual(self.dao.find("Page").local_version, 1)
+        self._save("Other", "other")
+        WikiPage(self.env, "Other").delete()
+        self.assertEqual(self.dao.find("Other"), None)
+
+    def test_concurrent_edit(self):
+        self._save("Page", "one")
+        self.dao.update(self.dao.find("Page").replace(remote_version=1,
+            sync_time=1).synchronized())
+        item = self.dao.find("Page")
+        # edited while the item is pulled
+        self._save("Page", "two")
+        self.dao.update(item.synchronized())
+        self.assertEqual(self.dao.find("Page").status, "modified")
+        self.dao.bulk_apply(updates=[item.synchronized()])
+        self.assertEqual(self.dao.find("Page").status, "modified")
+        self.assertEqual(self.dao.summary().get("modified"), 1)
+
+    def test_renamed(self):
+        self._save("OldName", "text")
+        self._save("OldName", "text 2")
+        WikiPage(self.env, "OldName").rename("NewName")
+        self.assertEqual(self.dao.find("OldName"), None)
+        self.assertEqual(self.dao.find("NewName").local_version, 2)
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(WikiSyncModelTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(WikiChangeListenerTestCase, 'test'))
     return suite
 
 if __name__ == "__main__":
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import unittest, time
+from wikisync.plugin import WikiSyncEnvironment, WikiSyncPlugin
+from wikisync.model import WikiSyncDao
+from wikisync.notify import sign, notification, parse_notification, \
+    reset_signatures, SIGNATURE_HEADER
+from wikisync.util import RegExpFilter
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.wiki.model import WikiPage
+
+class NotifyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        reset_signatures()
+
+    def test_parse(self):
+        body = notification([{"name": "WikiStart", "version": 3},
+            {"name": "Removed", "version": 2, "deleted": True}], now=1000)
+        self.assertEqual(parse_notification(body, sign(body, "secret"),
+            "secret", now=1100), [
+            {"name": "WikiStart", "remote_version": 3, "remote_digest": None},
+            {"name": "Removed", "remote_version": 0, "remote_digest": None,
+             "deleted_version": 2}])
+        for signature, secret, now in (
+            (sign(body, "other"), "secret", 1000),
+            (sign(body + " ", "secret"), "secret", 1000),
+            (None, "secret", 1000),
+            # replayed
+            (sign(body, "secret"), "secret", 1200),
+            (sign(body, "secret"), "secret", 2000)):
+            self.assertRaises(ValueError, parse_notification, body,
+                signature, secret, now)
+        for events in ([{"version": 1}], [{"name": "Removed", "version": 0}]):
+            body = notification(events)
+            self.assertRaises(ValueError, parse_notification, body,
+                sign(body, "secret"), "secret")
+
+class RemoteChangesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.dao = WikiSyncDao(self.env)
+        page = WikiPage(self.env, "LocalPage")
+        page.text = "Local"
+        page.save("admin", "", "127.0.0.1")
+        self.dao.update(self.dao.find("LocalPage").replace(remote_version=2,
+            sync_time=time.time()).synchronized())
+
+    def test_apply(self):
+        changed = self.dao.apply_remote_changes([
+            {"name": "LocalPage", "remote_version": 3},
+            {"name": "RemotePage", "remote_version": 1},
+            {"name": "IgnoredPage", "remote_version": 1},
+        ], RegExpFilter(["Ignored.*"]))
+        self.assertEqual(len(changed), 3)
+        self.assertEqual(self.dao.find("LocalPage").status, "outdated")
+        self.assertEqual(self.dao.find("RemotePage").status, "missing")
+        self.assertEqual(self.dao.find("IgnoredPage").status, "ignored")
+        # out of order notifications are ignored
+        self.assertEqual(self.dao.apply_remote_changes([
+            {"name": "LocalPage", "remote_version": 2}]), [])
+        self.assertEqual(self.dao.find("LocalPage").remote_version, 3)
+        # the deletion of an older version is ignored
+        self.assertEqual(self.dao.apply_remote_changes([
+            {"name": "LocalPage", "remote_version": 0,
+             "deleted_version": 2}]), [])
+        self.assertEqual(self.dao.find("LocalPage").status, "outdated")
+        self.dao.apply_remote_changes([
+            {"name": "LocalPage", "remote_version": 0, "deleted_version": 3},
+            {"name": "RemotePage", "remote_version": 0, "deleted_version": 1},
+            {"name": "UnknownPage", "remote_version": 0,
+             "deleted_version": 1}])
+        self.assertEqual(self.dao.find("LocalPage").status, "new")
+        self.assertEqual(self.dao.find("RemotePage"), None)
+        self.assertEqual(self.dao.find("UnknownPage"), None)
+
+    def test_endpoint(self):
+        reset_signatures()
+        responses = []
+        def request(body, signature, method="POST"):
+            req = Mock(path_info="/wikisync/notify", method=method, args={},
+                perm=MockPerm(), remote_addr="127.0.0.1", read=lambda: body,
+                get_header=lambda name: name == SIGNATURE_HEADER and
+                    signature or None,
+                send=lambda content, ctype, status: responses.append(status))
+            WikiSyncPlugin(self.env).process_request(req)
+            return responses[-1]
+        body = notification([{"name": "LocalPage", "version": 4}])
+        # disabled without a shared secret
+        self.assertEqual(request(body, sign(body, "secret")), 404)
+        self.env.config.set("wikisync", "notify_secret", "secret")
+        self.assertEqual(request(body, sign(body, "other")), 403)
+        self.assertEqual(self.dao.find("LocalPage").remote_version, 2)
+        self.assertEqual(request(body, sign(body, "secret"), "GET"), 405)
+        self.assertEqual(request(body, sign(body, "secret")), 200)
+        self.assertEqual(self.dao.find("LocalPage").status, "outdated")
+        self.assertEqual(request(body, sign(body, "secret")), 403)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(NotifyTestCase, "test"))
+    suite.addTest(unittest.makeSuite(RemoteChangesTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
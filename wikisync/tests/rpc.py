@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import unittest, time, urllib2
+from wikisync.batch import BatchSync, refresh_remote
+from wikisync.connection import ConnectionPool
+from wikisync.model import WikiSyncDao
+from wikisync.plugin import WikiSyncEnvironment
+from wikisync.rpc import RpcClient, get_transport, reset_transports
+from wikisync.session import SESSIONS
+from wikisync.tests.server import TracHandler
+from wikisync.util import WebClient
+from trac.test import EnvironmentStub
+from trac.wiki.model import WikiPage
+
+class UnavailableClient(WebClient):
+    """Fails the first request with a 503"""
+
+    unavailable = True
+
+    def open(self, url, *args, **kwargs):
+        if self.unavailable:
+            self.unavailable = False
+            raise urllib2.HTTPError(url, 503, "Service Unavailable", {}, None)
+        return WebClient.open(self, url, *args, **kwargs)
+
+class RpcClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TracHandler.create_server(pages=5, auth="digest",
+            rpc=True).start()
+        # the ports of the test servers are reused
+        reset_transports()
+        SESSIONS.discard(self.server.url, "admin", "admin")
+        self.pool = ConnectionPool()
+        self.wc = WebClient(self.server.url, "admin", "admin", pool=self.pool)
+        self.rpc = RpcClient(self.wc, batch_size=100)
+
+    def tearDown(self):
+        self.rpc.close()
+        self.pool.clear()
+        self.server.stop()
+
+    def test_transport(self):
+        self.assertTrue(isinstance(get_transport(self.wc), RpcClient))
+        self.assertTrue(get_transport(self.wc, "html") is self.wc)
+        server = TracHandler.create_server(pages=1).start()
+        try:
+            wc = WebClient(server.url, pool=self.pool)
+            # missing XML-RPC falls back to the html pages
+            self.assertTrue(get_transport(wc) is wc)
+            self.assertTrue(get_transport(wc) is wc)
+            self.assertEqual(server.requests, 1)
+        finally:
+            server.stop()
+
+    def test_transient(self):
+        wc = UnavailableClient(self.server.url, "admin", "admin",
+            pool=self.pool)
+        self.assertTrue(get_transport(wc) is wc)
+        # the detection is not cached
+        self.assertTrue(isinstance(get_transport(wc), RpcClient))
+
+    def test_remote_list(self):
+        self.assertEqual(len(self.rpc.get_remote_list()), 5)
+        self.server.pages["BenchPage00003"].append((time.time(), "Changed"))
+        # the remote pages are changed every other day
+        self.assertEqual(sorted(self.rpc.get_remote_updates(time.time(), 1)),
+            [{"name": "BenchPage00000", "remote_version": 1},
+             {"name": "BenchPage00003", "remote_version": 2}])
+
+    def test_versions(self):
+        names = ["BenchPage%05d" % i for i in range(250)]
+        self.wc.authenticate()
+        requests = self.server.requests
+        versions = self.rpc.get_remote_versions(names)
+        self.assertEqual(self.server.requests - requests, 3)
+        self.assertEqual(versions["BenchPage00004"], 1)
+        self.assertEqual(versions["BenchPage00005"], None)
+        self.assertEqual(self.rpc.get_remote_version("Missing"), [])
+
+    def test_pull_push(self):
+        text = u"Unicode é中 text"
+        self.assertEqual(self.rpc.push("BenchPage00001", text),
+            {"name": "BenchPage00001", "remote_version": 2})
+        self.assertEqual(self.rpc.pull("BenchPage00001"), text)
+        self.assertEqual(self.rpc.pull("BenchPage00001", 1),
+            self.server.pages["BenchPage00001"][0][1])
+        requests = self.server.requests
+        results = self.rpc.pull_many([("BenchPage00002", None),
+            ("Missing", None)])
+        self.assertEqual(self.server.requests - requests, 1)
+        self.assertEqual(results[0], self.server.pages["BenchPage00002"][0][1])
+        self.assertEqual(results[1].faultCode, 404)
+
+class RpcBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.dao = WikiSyncDao(self.env)
+        self.server = TracHandler.create_server(pages=40, rpc=True).start()
+        self.pool = ConnectionPool()
+        self.rpc = RpcClient(WebClient(self.server.url, pool=self.pool))
+
+    def tearDown(self):
+        self.rpc.close()
+        self.pool.clear()
+        self.server.stop()
+
+    def _run(self, action):
+        tasks = [(item.name, action) for item in self.dao.query()]
+        requests = self.server.requests
+        results = BatchSync(self.env, self.rpc, concurrency=4).run(tasks)
+        self.assertEqual([r.error for r in results if not r.ok], [])
+        return self.server.requests - requests
+
+    def test_batch(self):
+        refresh_remote(self.env, self.rpc)
+        self.assertEqual(len(self.dao.query()), 40)
+        for item in self.dao.query():
+            self.dao.update(item.replace(ignore_attachment=1))
+        # the texts are read by a request per worker
+        self.assertEqual(self._run("pull"), 4)
+        self.assertEqual(WikiPage(self.env, "BenchPage00007").text,
+            self.server.pages["BenchPage00007"][0][1])
+        for name in ("BenchPage00001", "BenchPage00002"):
+            page = WikiPage(self.env, name)
+            page.text = "Edited locally"
+            page.save("admin", "", "127.0.0.1")
+        self.dao.repair_local_versions()
+        # a request per worker
+        self.assertEqual(self._run("push"), 2)
+        self.assertEqual(self.server.pages["BenchPage00002"][-1][1],
+            "Edited locally")
+        self.assertEqual(self.dao.find("BenchPage00002").status, "synced")
+        self.assertEqual(self._run("refresh"), 1)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RpcClientTestCase, "test"))
+    suite.addTest(unittest.makeSuite(RpcBatchTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+import os, re, sys, socket, shutil, threading, time, urllib, cgi, \
+    base64, calendar, xmlrpclib, BaseHTTPServer, SocketServer
+from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
+from hashlib import md5
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+    BaseHTTPServer.HTTPServer):
+    """HTTP server handling each connection in its own thread, counting
+    the number of accepted connections."""
+
+    daemon_threads = True
+
+    def __init__(self, address, handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler_class)
+        self.connections = 0
+
+    def get_request(self):
+        request = BaseHTTPServer.HTTPServer.get_request(self)
+        self.connections += 1
+        return request
+
+    def handle_error(self, request, client_address):
+        # clients closing responses early resets the connection
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                client_address)
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Persistent HTTP/1.1 request handler, subclasses implements
+    do_GET/do_POST and replies with send()."""
+
+    protocol_version = "HTTP/1.1"
+
+    def send(self, body, code=200, content_type="text/html", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        return length and self.rfile.read(length) or ""
+
+    def log_message(self, format, *args):
+        pass
+
+class TestServer(object):
+    """Runs a local HTTP server in a background thread."""
+
+    def __init__(self, handler_class, host="127.0.0.1", port=0):
+        self.httpd = ThreadedHTTPServer((host, port), handler_class)
+        self.httpd.test_server = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return "http://%s:%s" % (host, port)
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+            kwargs={"poll_interval": 0.05})
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+class AttachmentHandler(RequestHandler):
+    """Stands in for the attachment pages of a trac server, the attachments
+    are stored in the 'attachments' dict of the TestServer, as a 
+    (path, time) tuple by (wiki name, filename), and their content in the
+    'root' directory."""
+
+    _LIST_PATH = "/attachment/wiki/"
+
+    _RAW_PATH = "/raw-attachment/wiki/"
+
+    def do_GET(self):
+        server = self.server.test_server
+        path, _, query = self.path.partition("?")
+        path = urllib.unquote(path)
+        if path.startswith(self._RAW_PATH):
+            name, _, filename = path[len(self._RAW_PATH):].rpartition("/")
+            attachment = server.attachments.get((name, filename))
+            if not attachment:
+                return self.send("Not Found", 404)
+            with server.lock:
+                server.downloads.append((name, filename))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", 
+                str(os.path.getsize(attachment[0])))
+            self.end_headers()
+            f = open(attachment[0], "rb")
+            try:
+                shutil.copyfileobj(f, self.wfile)
+            finally:
+                f.close()
+        elif path.startswith(self._LIST_PATH) and path.endswith("/"):
+            name = path[len(self._LIST_PATH):-1]
+            if "action=new" in query:
+                return self.send(ATTACHMENT_FORM)
+            items = sorted([(filename, attachment)
+                for (n, filename), attachment in server.attachments.items()
+                if n == name])
+            if not items:
+                return self.send("Not Found", 404)
+            self.send(ATTACHMENT_LIST % "".join([ATTACHMENT_ITEM % {
+                "name": urllib.quote(name), "filename": urllib.quote(f),
+                "size": os.path.getsize(target), "time": urllib.quote(t)}
+                for f, (target, t) in items]))
+        else:
+            self.send("Not Found", 404)
+
+    def do_POST(self):
+        server = self.server.test_server
+        path = urllib.unquote(self.path.partition("?")[0])
+        if not path.startswith(self._LIST_PATH):
+            return self.send("Not Found", 404)
+        name = path[len(self._LIST_PATH):].rstrip("/")
+        # the uploaded file is spooled to disk by cgi.FieldStorage
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+            environ={"REQUEST_METHOD": "POST"})
+        upload = form["attachment"]
+        if form.getfirst("__FORM_TOKEN") != FORM_TOKEN:
+            return self.send("Invalid form token", 400)
+        with server.lock:
+            server.uploads.append((name, upload.filename))
+            server.revision += 1
+            target = os.path.join(server.root, "%s.%s" % \
+                (server.revision, upload.filename))
+            f = open(target, "wb")
+            try:
+                shutil.copyfileobj(upload.file, f)
+            finally:
+                f.close()
+            previous = server.attachments.get((name, upload.filename))
+            if previous:
+                os.remove(previous[0])
+            server.attachments[(name, upload.filename)] = (target,
+                time.strftime("%Y-%m-%dT%H:%M:%SZ", 
+                    time.gmtime(server.revision)))
+        self.send("Attachment added")
+
+    @classmethod
+    def create_server(cls, root):
+        """Returns a TestServer storing the attachments in 'root'"""
+        server = TestServer(cls)
+        cls._init_attachments(server, root)
+        return server
+
+    @staticmethod
+    def _init_attachments(server, root):
+        server.root = root
+        server.attachments = {}
+        server.uploads = []
+        server.downloads = []
+        server.revision = 0
+        server.lock = threading.Lock()
+
+class TracHandler(AttachmentHandler):
+    """Stands in for the remote trac endpoints used by WebClient: the login
+    with basic or digest authentication, RecentChanges, the timeline, the
+    wiki pages, their text and edit form, and the attachments. The wiki
+    methods of the TracXMLRPC plugin are provided at '/rpc' if enabled.
+
+    The wikis are stored in the 'pages' dict of the TestServer, as an array
+    of (time, text) by version, see create_server(). The wikis of the
+    'denied' set are not viewable by the logged in user. Every response is
+    delayed by the 'latency' of the server, and the body is written at most
+    at 'bandwidth' bytes per second.
+    """
+
+    # the headers and body are written separately, delayed acknowledgements
+    # of the client would otherwise stall every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server.test_server
+        path, _, query = self.path.partition("?")
+        path = urllib.unquote(path)
+        params = dict(cgi.parse_qsl(query))
+        self._count()
+        if path.startswith(self._LIST_PATH) or \
+            path.startswith(self._RAW_PATH):
+            return AttachmentHandler.do_GET(self)
+        if path == "/login":
+            return self._login()
+        if not self._session():
+            return self._denied()
+        if path.startswith("/wiki/") and path[len("/wiki/"):] in \
+            server.denied:
+            return self.send("WIKI_VIEW privileges are required", 403)
+        if path == "/wiki/RecentChanges":
+            self.send(self._recent_changes())
+        elif path == "/timeline":
+            self.send(self._timeline(params))
+        elif path.startswith("/wiki/"):
+            name = path[len("/wiki/"):]
+            with server.lock:
+                versions = list(server.pages.get(name, ()))
+            if params.get("format") == "txt":
+                version = int(params.get("version") or len(versions))
+                if not 0 < version <= len(versions):
+                    return self.send("Not Found", 404)
+                self.send(versions[version - 1][1], 
+                    content_type="text/plain;charset=utf-8")
+            elif params.get("action") == "edit":
+                self.send(TRAC_EDIT_FORM % {"name": urllib.quote(name), 
+                    "token": server.token, "version": len(versions),
+                    "text": cgi.escape(versions and versions[-1][1] or "")})
+            else:
+                self.send(TRAC_WIKI % {"name": urllib.quote(name),
+                    "version": len(versions)})
+        else:
+            self.send("Not Found", 404)
+
+    def do_POST(self):
+        server = self.server.test_server
+        path = urllib.unquote(self.path.partition("?")[0])
+        self._count()
+        if path.startswith(self._LIST_PATH):
+            return AttachmentHandler.do_POST(self)
+        # an unread body would be parsed as the next request of the
+        # persistent connection
+        body = self.read_body()
+        if path == "/rpc" and server.rpc:
+            if not self._session():
+                return self._denied()
+            return self.send(server.rpc._marshaled_dispatch(body),
+                content_type="text/xml")
+        if not path.startswith("/wiki/"):
+            return self.send("Not Found", 404)
+        if not self._session():
+            return self._denied()
+        name = path[len("/wiki/"):]
+        params = dict(cgi.parse_qsl(body))
+        if params.get("__FORM_TOKEN") != server.token or \
+            "trac_form_token=%s" % server.token not in \
+                (self.headers.getheader("Cookie") or ""):
+            return self.send("Missing or invalid form token", 400)
+        with server.lock:
+            versions = server.pages.setdefault(name, [])
+            if int(params.get("version") or 0) != len(versions):
+                conflict = len(versions)
+            else:
+                conflict = None
+                versions.append((time.time(), params.get("text", "")))
+        if conflict is not None:
+            # rendered as a conflict warning in the edit form
+            return self.send(TRAC_EDIT_FORM % {"name": urllib.quote(name), 
+                "token": server.token, "version": conflict,
+                "text": cgi.escape(params.get("text", ""))})
+        # trac redirects to the saved wiki
+        self.send("", 303, headers={"Location": 
+            "%s/wiki/%s" % (server.url, urllib.quote(name))})
+
+    def send(self, body, code=200, content_type="text/html", headers=None):
+        server = self.server.test_server
+        if server.latency:
+            time.sleep(server.latency)
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if "trac_form_token=" not in (self.headers.getheader("Cookie") or ""):
+            self.send_header("Set-Cookie", "trac_form_token=%s; Path=/" % \
+                server.token)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        chunk = server.bandwidth and max(1024, server.bandwidth / 10) or \
+            len(body) or 1
+        for i in xrange(0, len(body), chunk):
+            data = body[i:i + chunk]
+            self.wfile.write(data)
+            if server.bandwidth:
+                time.sleep(float(len(data)) / server.bandwidth)
+
+    def _count(self):
+        server = self.server.test_server
+        with server.lock:
+            server.requests += 1
+
+    def _session(self):
+        server = self.server.test_server
+        if not server.auth:
+            return True
+        m = re.search(r"trac_auth=(\w+)", 
+            self.headers.getheader("Cookie") or "")
+        return bool(m) and m.group(1) in server.sessions
+
+    def _denied(self):
+        # trac treats an unknown session as anonymous, and removes its
+        # cookie
+        headers = {}
+        if "trac_auth=" in (self.headers.getheader("Cookie") or ""):
+            headers["Set-Cookie"] = "trac_auth=; expires=Thu, " \
+                "01-Jan-1970 00:00:00 GMT; Path=/"
+        return self.send("Permission denied", 403, headers=headers)
+
+    def _login(self):
+        server = self.server.test_server
+        if not server.auth:
+            return self.send("Logged in")
+        credentials = self.headers.getheader("Authorization") or ""
+        scheme, _, credentials = credentials.partition(" ")
+        if scheme.lower() == "basic" and server.auth == "basic":
+            valid = base64.b64decode(credentials) == "%s:%s" % \
+                (server.username, server.password)
+        elif scheme.lower() == "digest" and server.auth == "digest":
+            valid = self._check_digest(credentials)
+        else:
+            valid = False
+        if not valid:
+            if server.auth == "digest":
+                challenge = 'Digest realm="%s", nonce="%s", qop="auth"' % \
+                    (TRAC_REALM, md5(str(time.time())).hexdigest())
+            else:
+                challenge = 'Basic realm="%s"' % TRAC_REALM
+            return self.send("Authentication required", 401, 
+                headers={"WWW-Authenticate": challenge})
+        session = md5(str(time.time()) + os.urandom(8)).hexdigest()
+        with server.lock:
+            server.sessions.add(session)
+        self.send("Logged in", headers={"Set-Cookie": 
+            "trac_auth=%s; Path=/" % session})
+
+    def _check_digest(self, credentials):
+        server = self.server.test_server
+        params = dict([(k, v1 or v2) for k, v1, v2 in 
+            re.findall(r'(\w+)=(?:"([^"]*)"|([^\s,]*))', credentials)])
+        if params.get("username") != server.username:
+            return False
+        ha1 = md5("%s:%s:%s" % (server.username, TRAC_REALM, 
+            server.password)).hexdigest()
+        ha2 = md5("%s:%s" % (self.command, params.get("uri"))).hexdigest()
+        if params.get("qop"):
+            expected = md5("%s:%s:%s:%s:%s:%s" % (ha1, params.get("nonce"),
+                params.get("nc"), params.get("cnonce"), params.get("qop"), 
+                ha2)).hexdigest()
+        else:
+            expected = md5("%s:%s:%s" % (ha1, params.get("nonce"), 
+                ha2)).hexdigest()
+        return params.get("response") == expected
+
+    def _recent_changes(self):
+        server = self.server.test_server
+        with server.lock:
+            changes = sorted([(versions[-1][0], name, len(versions))
+                for name, versions in server.pages.items() if versions],
+                reverse=True)
+        return TRAC_RECENT_CHANGES % "".join([TRAC_CHANGE % {
+            "name": urllib.quote(name), "version": version}
+            for t, name, version in changes])
+
+    def _timeline(self, params):
+        server = self.server.test_server
+        # changes until the end of the 'from' day
+        date = params.get("from") or time.strftime("%Y-%m-%d", 
+            time.gmtime())
+        end = calendar.timegm([int(v) for v in date.split("-")] + 
+            [0, 0, 0]) + 86400
+        start = end - int(params.get("daysback") or 30) * 86400 - 86400
+        with server.lock:
+            changes = sorted([(t, name, i + 1)
+                for name, versions in server.pages.items()
+                for i, (t, text) in enumerate(versions)
+                if start <= t < end], reverse=True)
+        return TRAC_TIMELINE % "".join([TRAC_EVENT % {
+            "name": urllib.quote(name), "version": version}
+            for t, name, version in changes])
+
+    @staticmethod
+    def _init_rpc(server):
+        """Returns the dispatcher of the XML-RPC methods"""
+        def get_page_info(name, version=None):
+            with server.lock:
+                versions = server.pages.get(name)
+                if not versions or len(versions) < (version or 1):
+                    raise xmlrpclib.Fault(404, "Wiki page '%s' does not "
+                        "exist" % name)
+                version = version or len(versions)
+                return {"name": name, "version": version, "author": "admin",
+                    "lastModified": xmlrpclib.DateTime(
+                        time.gmtime(versions[version - 1][0]))}
+        def get_page(name, version=None):
+            info = get_page_info(name, version)
+            with server.lock:
+                return server.pages[name][info["version"] - 1][1]
+        def put_page(name, text, attributes):
+            with server.lock:
+                server.pages.setdefault(name, []).append((time.time(), text))
+            return True
+        def get_recent_changes(since):
+            v = since.value
+            since = calendar.timegm((int(v[:4]), int(v[4:6]), int(v[6:8]),
+                int(v[9:11]), int(v[12:14]), int(v[15:17]), 0, 0, 0))
+            with server.lock:
+                names = [name for name, versions in server.pages.items()
+                    if versions and versions[-1][0] >= since]
+            return [get_page_info(name) for name in names]
+        dispatcher = SimpleXMLRPCDispatcher(allow_none=True, 
+            encoding="utf-8")
+        dispatcher.register_function(lambda: [1, 1, 2], 
+            "system.getAPIVersion")
+        dispatcher.register_function(get_page_info, "wiki.getPageInfo")
+        dispatcher.register_function(get_page, "wiki.getPage")
+        dispatcher.register_function(put_page, "wiki.putPage")
+        dispatcher.register_function(get_recent_changes,
+            "wiki.getRecentChanges")
+        dispatcher.register_multicall_functions()
+        return dispatcher
+
+    @classmethod
+    def create_server(cls, pages=0, page_size=1024, auth=None,
+        username="admin", password="admin", latency=0, bandwidth=0,
+        root=None, rpc=False):
+        """Returns a TestServer emulating a remote trac.
+
+        @param pages: number of wikis created, named 'BenchPage00000' and
+            so on, with a single version changed within the last 10 days.
+        @param page_size: size in bytes of the text of the created wikis.
+        @param auth: 'basic' or 'digest' to require the authentication of 
+            'username' and 'password' with the login page, or None.
+        @param latency: seconds before each response is sent.
+        @param bandwidth: maximum bytes per second of the response bodies,
+            0 for unlimited.
+        @param root: directory of the uploaded attachments.
+        @param rpc: True to provide the XML-RPC methods.
+        """
+        server = TestServer(cls)
+        cls._init_attachments(server, root)
+        server.auth = auth
+        server.username = username
+        server.password = password
+        server.latency = latency
+        server.bandwidth = bandwidth
+        server.token = FORM_TOKEN
+        server.sessions = set()
+        server.denied = set()
+        server.requests = 0
+        server.rpc = rpc and cls._init_rpc(server)
+        now = time.time()
+        line = "Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n"
+        text = (line * (page_size / len(line) + 1))[:page_size]
+        server.pages = dict([("BenchPage%05d" % i, 
+            [(now - (i * 86400 * 10.0 / max(pages, 1)), text)])
+            for i in xrange(pages)])
+        return server
+
+FORM_TOKEN = "0123456789abcdef"
+
+ATTACHMENT_FORM = """<html><body>
+<form id="attachment" method="post" enctype="multipart/form-data" action="">
+  <input type="hidden" name="__FORM_TOKEN" value="%s" />
+  <input type="file" name="attachment" />
+  <input type="text" name="description" />
+  <input type="checkbox" name="replace" />
+  <input type="hidden" name="action" value="new" />
+  <input type="submit" value="Add attachment" />
+  <input type="submit" name="cancel" value="Cancel" />
+</form>
+</body></html>""" % FORM_TOKEN
+
+ATTACHMENT_LIST = """<html><body>
+<div id="content" class="attachment">
+<h1><a href="/wiki/WikiStart">WikiStart</a>: attachments</h1>
+<dl class="attachments">%s</dl>
+</div>
+</body></html>"""
+
+ATTACHMENT_ITEM = """
+<dt><a href="/attachment/wiki/%(name)s/%(filename)s" title="View attachment"
+>%(filename)s</a><a href="/raw-attachment/wiki/%(name)s/%(filename)s" 
+class="trac-rawlink" title="Download">&#8203;</a> (<span title="%(size)s 
+bytes">%(size)s bytes</span>) - added by <em>admin</em> <a class="timeline"
+href="/timeline?from=%(time)s&amp;precision=second" title="%(time)s in
+Timeline">5 days</a> ago.</dt>
+"""
+
+TRAC_REALM = "trac"
+
+TRAC_RECENT_CHANGES = """<html><body>
+<div id="content" class="wiki">
+<div class="wikipage searchable"><div id="wikipage">
+<h1>Recent Changes</h1>
+<ul>%s</ul>
+</div></div>
+</div>
+</body></html>"""
+
+TRAC_CHANGE = """
+<li><a href="/wiki/%(name)s">%(name)s</a> <small>(<a 
+href="/wiki/%(name)s?action=diff&amp;version=%(version)s">diff</a>)</small></li>"""
+
+TRAC_TIMELINE = """<html><body>
+<div id="content" class="timeline">
+<h1>Timeline</h1>
+<dl>%s</dl>
+</div>
+</body></html>"""
+
+TRAC_EVENT = """
+<dt class="wiki"><a href="/wiki/%(name)s?version=%(version)s"><em>%(name)s</em>
+edited</a></dt><dd class="wiki">Bench change</dd>"""
+
+TRAC_WIKI = """<html><body>
+<div id="content" class="wiki">
+<div class="trac-modifiedby"><a 
+href="/wiki/%(name)s?action=diff&amp;version=%(version)s">Last 
+modified</a></div>
+<div id="wikipage">...</div>
+</div>
+</body></html>"""
+
+TRAC_EDIT_FORM = """<html><body>
+<form id="edit" action="/wiki/%(name)s" method="post">
+<input type="hidden" name="__FORM_TOKEN" value="%(token)s" />
+<input type="hidden" name="action" value="edit" />
+<input type="hidden" name="version" value="%(version)s" />
+<textarea name="text">%(text)s</textarea>
+<input type="text" name="comment" value="" />
+<input type="text" name="scroll_bar_pos" value="" />
+<input type="submit" name="save" value="Submit changes" />
+<input type="submit" name="preview" value="Preview Page" />
+<input type="submit" name="cancel" value="Cancel" />
+</form>
+</body></html>"""
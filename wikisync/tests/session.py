@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import unittest, os, shutil, tempfile, threading, urllib2
+from wikisync.connection import ConnectionPool
+from wikisync.session import SessionManager
+from wikisync.tests.server import TracHandler
+from wikisync.util import WebClient
+
+class SessionManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="wikisync-sessions-")
+        self.sessions = SessionManager(self.directory)
+        self.server = TracHandler.create_server(pages=3, auth="basic").start()
+        self.pool = ConnectionPool()
+        self.saves = []
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def _client(self):
+        return WebClient(self.server.url, "admin", "admin", pool=self.pool,
+            sessions=self.sessions)
+
+    def _count_saves(self, session):
+        save = session.cookie_jar.save
+        def counting_save(*args, **kwargs):
+            self.saves.append(session)
+            return save(*args, **kwargs)
+        session.cookie_jar.save = counting_save
+
+    def test_shared(self):
+        session = self.sessions.get(self.server.url, "admin", "admin")
+        self._count_saves(session)
+        for i in range(3):
+            wc = self._client()
+            self.assertEqual(len(wc.get_remote_list()), 3)
+            wc.close()
+        self.assertEqual(len(self.server.sessions), 1)
+        # written once by the login, unchanged since
+        self.assertEqual(len(self.saves), 1)
+        self.assertTrue(os.path.isfile(session.cookie_file))
+        self.assertTrue(self.sessions.get(self.server.url, "admin",
+            "admin") is session)
+        self.assertFalse(self.sessions.get(self.server.url, "admin",
+            "other") is session)
+
+    def test_persisted(self):
+        wc = self._client()
+        wc.get_remote_list()
+        wc.close()
+        # a new process loads the cookies of the session
+        self.sessions = SessionManager(self.directory)
+        wc = self._client()
+        wc.get_remote_list()
+        wc.close()
+        self.assertEqual(len(self.server.sessions), 1)
+        self.sessions.discard(self.server.url, "admin", "admin")
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_expired(self):
+        self._client().get_remote_list()
+        self.server.sessions.clear()
+        requests = self.server.requests
+        errors = []
+        def run():
+            try:
+                wc = self._client()
+                self.assertEqual(len(wc.get_remote_list()), 3)
+                wc.close()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        # a single login for all the rejected threads
+        self.assertEqual(len(self.server.sessions), 1)
+        self.assertTrue(self.server.requests - requests <= 8 * 2 + 2)
+
+    def test_denied(self):
+        wc = self._client()
+        wc.get_remote_list()
+        self.server.denied.add("PrivatePage")
+        requests = self.server.requests
+        try:
+            wc.open("wiki/PrivatePage")
+            self.fail("HTTPError expected")
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 403)
+            e.close()
+        wc.close()
+        # denied to the logged in user, the session is still valid
+        self.assertEqual(self.server.requests - requests, 1)
+        self.assertEqual(len(self.server.sessions), 1)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SessionManagerTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
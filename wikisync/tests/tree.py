@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import unittest, urllib2
+from wikisync.plugin import WikiSyncEnvironment, WikiSyncPlugin
+from wikisync.model import WikiSyncDao
+from wikisync.batch import refresh_remote
+from wikisync.tree import tree_node, compare_tree, local_entries, \
+    tree_supported, TREE_VERSION, LEAF_SIZE
+from wikisync.util import text_digest
+from trac.perm import PermissionError
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.wiki.model import WikiPage
+
+def make_entries(count, version=1):
+    return sorted([(u"Page%s/Sub%s" % (i % 37, i), version, "d%s" % i)
+        for i in range(count)])
+
+class TreeClient(object):
+    """Stands in for WebClient, serving the tree of the remote entries"""
+
+    def __init__(self, entries, baseurl="http://remote"):
+        self.entries = sorted(entries)
+        self.baseurl = baseurl
+        self.requests = 0
+        self.error = None
+
+    def get_remote_tree(self, prefixes):
+        self.requests += 1
+        if self.error:
+            raise self.error
+        return {"version": TREE_VERSION, "nodes": dict([
+            (prefix, tree_node(self.entries, prefix)) for prefix in prefixes])}
+
+    def get_remote_list(self):
+        return [{"name": name, "remote_version": version}
+            for name, version, digest in self.entries]
+
+class TreeTestCase(unittest.TestCase):
+
+    def test_node(self):
+        entries = make_entries(LEAF_SIZE)
+        node = tree_node(entries, u"")
+        self.assertEqual(node["count"], LEAF_SIZE)
+        self.assertEqual(len(node["pages"]), LEAF_SIZE)
+        self.assertFalse("children" in node)
+        entries = make_entries(1000)
+        node = tree_node(entries, u"")
+        self.assertEqual(node["count"], 1000)
+        self.assertEqual(sum([c[2] for c in node["children"]]), 1000)
+        # the nodes of the prefixes common to all their pages are skipped
+        self.assertEqual(node["children"][0][0], u"Page0/Sub")
+        self.assertEqual(tree_node(entries, u"Page")["hash"], node["hash"])
+        self.assertEqual(tree_node(list(entries), u"")["hash"], node["hash"])
+        self.assertNotEqual(tree_node(entries[1:], u"")["hash"], node["hash"])
+
+    def test_identical(self):
+        entries = make_entries(5000)
+        client = TreeClient(entries)
+        self.assertEqual(compare_tree(client, entries), ([], []))
+        self.assertEqual(client.requests, 1)
+
+    def test_changes(self):
+        local = make_entries(5000)
+        remote = list(local)
+        remote[10] = (remote[10][0], 2, "changed")
+        remote[20] = (remote[20][0], remote[20][1], "changed")
+        remote.append((u"Page3/Added", 1, "added"))
+        removed = remote.pop(4000)
+        client = TreeClient(remote)
+        changed, missing = compare_tree(client, local)
+        self.assertEqual(sorted([c["name"] for c in changed]),
+            sorted([remote[10][0], remote[20][0], u"Page3/Added"]))
+        self.assertEqual(missing, [removed[0]])
+        # a request per level of the differing subtrees
+        self.assertTrue(client.requests <= 4)
+
+    def test_empty(self):
+        client = TreeClient(make_entries(200))
+        changed, removed = compare_tree(client, [])
+        self.assertEqual(len(changed), 200)
+        self.assertEqual(compare_tree(TreeClient([]), make_entries(200))[1],
+            [e[0] for e in make_entries(200)])
+
+class TreeRefreshTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=["trac.*", "wikisync.*"])
+        WikiSyncEnvironment(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.dao = WikiSyncDao(self.env)
+
+    def test_local_entries(self):
+        for name in ("PageA", "PageB"):
+            page = WikiPage(self.env, name)
+            page.text = "Text of %s" % name
+            page.save("admin", "", "127.0.0.1")
+        entries = [e for e in local_entries(self.env)
+            if e[0] in ("PageA", "PageB")]
+        self.assertEqual(entries, [("PageA", 1, text_digest("Text of PageA")),
+            ("PageB", 1, text_digest("Text of PageB"))])
+        page = WikiPage(self.env, "PageA")
+        page.text = "Changed"
+        page.save("admin", "", "127.0.0.1")
+        self.assertTrue(("PageA", 2, text_digest("Changed")) in
+            local_entries(self.env))
+
+    def test_refresh(self):
+        client = TreeClient(make_entries(300), "http://refresh")
+        self.assertEqual(refresh_remote(self.env, client), "tree")
+        self.assertEqual(self.dao.get_remote_entries(), client.entries)
+        client.entries[5] = (client.entries[5][0], 2, "changed")
+        removed = client.entries.pop(7)
+        requests = client.requests
+        self.assertEqual(refresh_remote(self.env, client), "tree")
+        self.assertEqual(self.dao.get_remote_entries(), client.entries)
+        self.assertEqual(self.dao.find(client.entries[5][0]).remote_digest,
+            "changed")
+        self.assertEqual(self.dao.find(removed[0]), None)
+        requests = client.requests
+        refresh_remote(self.env, client)
+        self.assertEqual(client.requests - requests, 1)
+
+    def test_endpoint(self):
+        for name in ("PageA", "PrivatePage"):
+            page = WikiPage(self.env, name)
+            page.text = "Text of %s" % name
+            page.save("admin", "", "127.0.0.1")
+        class Perm(MockPerm):
+            # denies the views of PrivatePage
+            def __call__(self, realm_or_resource, id=False, version=False):
+                if id == "PrivatePage":
+                    return frozenset()
+                return self
+        responses = []
+        def request(authname):
+            req = Mock(path_info="/wikisync/tree", method="GET", args={},
+                perm=Perm(), authname=authname,
+                send=lambda content, ctype, status: responses.append(content))
+            WikiSyncPlugin(self.env).process_request(req)
+            return responses[-1]
+        self.assertRaises(PermissionError, request, "anonymous")
+        names = [e[0] for e in local_entries(self.env)]
+        self.assertTrue("PrivatePage" in names)
+        self.assertTrue("PrivatePage" not in request("peer"))
+        self.assertTrue("PageA" in request("peer"))
+
+    def test_unsupported(self):
+        client = TreeClient(make_entries(10), "http://unsupported")
+        client.error = urllib2.HTTPError(client.baseurl, 404, "Not Found",
+            {}, None)
+        self.assertEqual(refresh_remote(self.env, client), "full")
+        self.assertEqual(len(self.dao.get_remote_entries()), 10)
+        self.assertFalse(tree_supported(client))
+        refresh_remote(self.env, client, full=True)
+        self.assertEqual(client.requests, 1)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TreeTestCase, "test"))
+    suite.addTest(unittest.makeSuite(TreeRefreshTestCase, "test"))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
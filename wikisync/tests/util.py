@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
-import unittest, os
+import unittest, os, re, cgi, tempfile
 from wikisync.util import str_mask, str_unmask, \
-    parse_recent_changes, parse_timeline, parse_wiki, parse_form_params
+    parse_recent_changes, parse_timeline, parse_wiki, parse_form_params, \
+    parse_attachments, iter_recent_changes, iter_wiki, iter_version_links, \
+    RegExpFilter, get_regexp_filter, MultipartStream, WebClient
+from wikisync.connection import ConnectionPool
+from wikisync.plugin import DEFAULT_IGNORELIST
+from wikisync.tests.server import TestServer, RequestHandler
+from StringIO import StringIO
 from pkg_resources import resource_filename
 
 class HTMLParserTestCase(unittest.TestCase):
@@ -32,6 +38,33 @@ class HTMLParserTestCase(unittest.TestCase):
         for k, v in expected.items():
             self.assertEquals(results[k], v)
         
+    def test_parse_attachments(self):
+        source = """<dl class="attachments">
+          <dt><a href="/trac/attachment/wiki/Wiki%20Start/a%20b.pdf"
+            title="View attachment">a b.pdf</a><a
+            href="/trac/raw-attachment/wiki/Wiki%20Start/a%20b.pdf"
+            class="trac-rawlink" title="Download">&#8203;</a>
+            (<span title="1,234,567 bytes">1.2 MB</span>) - added by
+            <em>admin</em> <a class="timeline"
+            href="/trac/timeline?from=2011-01-02T03%3A04%3A05Z&amp;precision=second"
+            title="See timeline">2 days</a> ago.</dt>
+          <dd>Specification</dd>
+          <dt><a href="/trac/raw-attachment/wiki/Wiki%20Start/b.png"
+            class="trac-rawlink">&#8203;</a> (<span title="12 bytes">12
+            bytes</span>) - added by <em>admin</em>
+            <span title="01/02/11 03:04:05">2 days</span> ago.</dt>
+          <dt><a href="/trac/raw-attachment/wiki/Wiki%20Start/Sub/c.png"
+            class="trac-rawlink">&#8203;</a>
+            (<span title="1 bytes">1 bytes</span>)</dt>
+        </dl>"""
+        results = parse_attachments(source,
+            "/trac/raw-attachment/wiki/Wiki Start")
+        self.assertEqual(sorted([(r["filename"], r["size"], r["time"])
+            for r in results]), [
+                (u"a b.pdf", 1234567, u"2011-01-02T03:04:05Z"),
+                (u"b.png", 12, u"01/02/11 03:04:05"),
+            ])
+
     def test_parse_recent_changes_edgewall(self):
         source = self._read_html("RecentChanges.edgewall.html")
         results = parse_recent_changes(source, path_prefix="/wiki")
@@ -52,6 +85,13 @@ class HTMLParserTestCase(unittest.TestCase):
         results = parse_timeline(source, path_prefix="/trac/wiki")
         self.assertEqual(len(results), 57)
 
+    def test_parse_timeline_versioned_only(self):
+        # excludes pages mentioned within the change comments
+        source = self._read_html("Timeline.edgewall.html")
+        results = parse_timeline(source, path_prefix="/wiki",
+            versioned_only=True)
+        self.assertEqual(len(results), 29)
+
     def test_parse_wiki_edgewall(self):
         source = self._read_html("WikiStart.edgewall.html")
         results = parse_wiki(source, path_prefix="/wiki")
@@ -66,6 +106,223 @@ class HTMLParserTestCase(unittest.TestCase):
         self.assertEqual(results[0]["remote_version"], 2)
         self.assertEqual(results[0]["name"], "WikiStart")
         
+class StreamingHTMLParserTestCase(unittest.TestCase):
+    
+    def _open_html(self, name):
+        file = resource_filename(__name__, name)
+        with open(file, "rb") as f:
+            return CountingReader(f.read())
+
+    def test_iter_recent_changes(self):
+        source = self._open_html("RecentChanges.edgewall.html")
+        records = list(iter_recent_changes(source, path_prefix="/wiki"))
+        names = set([r["name"] for r in records])
+        self.assertEqual(len(names), 696)
+        self.assertTrue(len(records) >= len(names))
+        source.seek(0)
+        merged = dict([(r["name"], r["remote_version"])
+            for r in parse_recent_changes(source, path_prefix="/wiki")])
+        for r in records:
+            self.assertTrue(r["remote_version"] <= merged[r["name"]])
+
+    def test_stops_reading(self):
+        source = self._open_html("WikiStart.edgewall.html")
+        records = list(iter_wiki(source, path_prefix="/wiki"))
+        self.assertEqual(records[-1]["remote_version"], 147)
+        # the 'trac-modifiedby' element is closed before the end of file
+        self.assertTrue(source.bytes_read < source.len)
+
+    def test_markup(self):
+        source = """<html><body>
+            <!-- <a href="/wiki/Comment?version=9"> -->
+            <div id="wikipage" title="a &gt; b"><p>
+              <script>var s = '<a href="/wiki/Script">';</script>
+              <a href="/wiki/Page%20One?action=diff&amp;version=3">diff</a>
+              <br/><img src="x.png"><div class="empty" />
+              <a href='/wiki/Page%20One'>Page One</a> 1 < 2
+              <a href=/wiki/Page2?version=2>Page2</a>
+            </p></div>
+            <a href="/wiki/Outside">Outside</a>
+        </body></html>"""
+        for bufsize in (7, 16 * 1024):
+            records = list(iter_version_links(source,
+                lambda attrs: attrs.get("id") == "wikipage",
+                "/wiki", bufsize=bufsize))
+            self.assertEqual([(r["name"], r["remote_version"]) 
+                for r in records],
+                [(u"Page One", 3), (u"Page One", 1), (u"Page2", 2)])
+
+class CountingReader(StringIO):
+    """Keeps track of the number of bytes read, returning at most 1KB
+    per read"""
+    
+    bytes_read = 0
+    
+    def read(self, n=-1):
+        data = StringIO.read(self, n < 0 and 1024 or min(n, 1024))
+        self.bytes_read += len(data)
+        return data
+
+class MultipartStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write("".join([chr(i % 256) for i in range(100000)]))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read(self):
+        body = MultipartStream({"description": "Spec"},
+            [("attachment", "spec.pdf", self.path)], bufsize=1000)
+        chunks = []
+        while True:
+            chunk = body.read(777)
+            if not chunk:
+                break
+            self.assertTrue(len(chunk) <= 777)
+            chunks.append(chunk)
+        data = "".join(chunks)
+        self.assertEqual(len(data), len(body))
+        body.seek(0)
+        self.assertEqual(body.read(), data)
+        environ = {"REQUEST_METHOD": "POST", "CONTENT_TYPE": 
+            body.content_type, "CONTENT_LENGTH": str(len(body))}
+        form = cgi.FieldStorage(fp=StringIO(data), environ=environ)
+        self.assertEqual(form.getfirst("description"), "Spec")
+        self.assertEqual(form["attachment"].filename, "spec.pdf")
+        with open(self.path, "rb") as f:
+            self.assertEqual(form["attachment"].value, f.read())
+
+class IndexHandler(RequestHandler):
+
+    def do_GET(self):
+        if self.path == "/trac/wiki/RecentChanges":
+            # a large index, the matching links are found early
+            with open(resource_filename(__name__,
+                "RecentChanges.default.html"), "rb") as f:
+                self.send(f.read() + "<!-- %s -->" % ("x" * 500000))
+        else:
+            self.send("Not Found", 404)
+
+class RemoteVersionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TestServer(IndexHandler).start()
+        self.pool = ConnectionPool()
+        self.wc = WebClient(self.server.url + "/trac", pool=self.pool,
+            compress=False)
+
+    def tearDown(self):
+        self.wc.close()
+        self.pool.clear()
+        self.server.stop()
+
+    def test_get_remote_versions(self):
+        versions = self.wc.get_remote_versions(["WikiStart", "TitleIndex"])
+        self.assertEqual(versions, {"WikiStart": 2, "TitleIndex": 1})
+        self.assertTrue(self.pool.stats()["received"] < 100000)
+
+    def test_missing(self):
+        versions = self.wc.get_remote_versions(["WikiStart", "Missing"])
+        self.assertEqual(versions, {"WikiStart": 2, "Missing": None})
+
+    def test_truncated(self):
+        # the versions not found within the first bytes of the index are
+        # unknown, as opposed to missing
+        versions = self.wc.get_remote_versions(["WikiStart", "TitleIndex",
+            "Missing"], max_bytes=8000)
+        self.assertEqual(versions, {"WikiStart": 2, "TitleIndex": 1})
+
+class EditHandler(RequestHandler):
+    """Stands in for the wiki pages of a trac server, the pages are stored
+    as (version, text) in the 'pages' dict of the TestServer"""
+
+    _FORM = """<html><body><form id="edit" action="/wiki/%(name)s" 
+    method="post"><input type="hidden" name="__FORM_TOKEN" 
+    value="%(token)s" /><input type="hidden" name="action" value="edit" />
+    <input type="hidden" name="version" value="%(version)s" />
+    <textarea name="text">%(text)s</textarea>
+    <input type="text" name="comment" value="" />
+    <input type="submit" name="save" value="Submit changes" />
+    <input type="submit" name="cancel" value="Cancel" /></form>
+    </body></html>"""
+
+    _PAGE = """<html><body><div class="trac-modifiedby"><a 
+    href="/wiki/%(name)s?action=diff&amp;version=%(version)s">Last 
+    modified</a></div></body></html>"""
+
+    def do_GET(self):
+        server = self.server.test_server
+        server.requests.append(("GET", self.path))
+        name = self.path.partition("?")[0][len("/wiki/"):]
+        version, text = server.pages.get(name, (0, ""))
+        self.send(self._FORM % {"name": name, "token": server.token,
+            "version": version, "text": text}, headers={"Set-Cookie": 
+            "trac_form_token=%s; Path=/" % server.token})
+
+    def do_POST(self):
+        server = self.server.test_server
+        server.requests.append(("POST", self.path))
+        name = self.path[len("/wiki/"):]
+        params = cgi.parse_qs(self.read_body())
+        if params["__FORM_TOKEN"][0] != server.token or \
+            "trac_form_token=%s" % server.token not in \
+                (self.headers.getheader("Cookie") or ""):
+            return self.send("Missing or invalid form token", 400)
+        version, text = server.pages.get(name, (0, ""))
+        if int(params["version"][0]) != version:
+            # rendered as a conflict warning in the edit form
+            return self.send(self._FORM % {"name": name, "version": version,
+                "token": server.token, "text": params["text"][0]})
+        server.pages[name] = (version + 1, params["text"][0])
+        self.send(self._PAGE % {"name": name, "version": version + 1})
+
+class PushTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TestServer(EditHandler).start()
+        self.server.pages = {}
+        self.server.requests = []
+        self.server.token = "token1"
+        self.pool = ConnectionPool()
+        self.wc = WebClient(self.server.url, pool=self.pool)
+
+    def tearDown(self):
+        self.wc.close()
+        self.pool.clear()
+        self.server.stop()
+
+    def test_push(self):
+        self.assertEqual(self.wc.push("Page1", "Text", version=0),
+            {"name": "Page1", "remote_version": 1})
+        self.assertEqual(len(self.server.requests), 2)
+        # the token and form fields of the session are reused
+        clone = self.wc.clone()
+        for i in range(2, 5):
+            self.assertEqual(clone.push("Page%s" % i, "Text", version=0),
+                {"name": "Page%s" % i, "remote_version": 1})
+        self.assertEqual(clone.push("Page1", "Changed", version=1),
+            {"name": "Page1", "remote_version": 2})
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.server.pages["Page1"], (2, "Changed"))
+
+    def test_stale_version(self):
+        self.wc.push("Page1", "Text", version=0)
+        self.server.pages["Page2"] = (3, "Remote text")
+        self.assertEqual(self.wc.push("Page2", "Text", version=2),
+            {"name": "Page2", "remote_version": 4})
+        self.assertEqual([r[0] for r in self.server.requests[2:]],
+            ["POST", "GET", "POST"])
+
+    def test_stale_token(self):
+        self.wc.push("Page1", "Text", version=0)
+        self.server.token = "token2"
+        self.assertEqual(self.wc.push("Page1", "Changed", version=1),
+            {"name": "Page1", "remote_version": 2})
+        self.assertEqual(len(self.server.requests), 5)
+
 class StringMaskTestCase(unittest.TestCase):
     
     def test_mask(self):
@@ -74,10 +331,60 @@ class StringMaskTestCase(unittest.TestCase):
         self.assertEqual(message, str_unmask(masked))
         self.assertRaises(ValueError, str_unmask, "clear text")
         
+class RegExpFilterTestCase(unittest.TestCase):
+
+    FILTERS = DEFAULT_IGNORELIST.split() + [
+        "^Exact$", "Opt?", r"Dot\.Name", r"Digit\d+", "(a)(b)\\2",
+        "(?i)lower", "(?P<x>Named)", "Alt|Other", "Plus+", "^$",
+    ]
+
+    NAMES = [
+        "", "CamelCase", "CamelCaseX", "Tra", "TracGuide", "Inter",
+        "InterMapTxt", "WikiStart", "WikiFormatting", "WikiStartX", "Exact",
+        "ExactX", "Op", "Opt", "Dot.Name", "DotXName", "Digit12", "DigitX",
+        "abb", "aba", "LOWERCASE", "Named", "Other", "Plu", "Plusss",
+        "SandBox/Child", "Local", "Sand",
+    ]
+
+    def test_matches(self):
+        regexes = [re.compile(f) for f in self.FILTERS]
+        f = RegExpFilter(self.FILTERS)
+        for name in self.NAMES:
+            expected = any([r.match(name) for r in regexes])
+            self.assertEqual(f.matches(name), expected, name)
+
+    def test_prefixes(self):
+        f = RegExpFilter("CamelCase Trac* Wiki.* ^Exact$")
+        self.assertEqual(f._regexes, [])
+        self.assertEqual(f._prefixes, {3: set(["Tra"]), 4: set(["Wiki"]),
+            9: set(["CamelCase"])})
+        self.assertEqual(f._exact, set(["Exact"]))
+
+    def test_many_groups(self):
+        filters = ["(G%s)(x)" % i for i in range(120)]
+        f = RegExpFilter(filters)
+        self.assertEqual(len(f._regexes), 3)
+        self.assertTrue(f.matches("G119x"))
+        self.assertFalse(f.matches("G119"))
+
+    def test_invalid(self):
+        self.assertRaises(re.error, RegExpFilter, "Valid (Invalid")
+
+    def test_cached(self):
+        f = get_regexp_filter(DEFAULT_IGNORELIST)
+        self.assertTrue(get_regexp_filter(DEFAULT_IGNORELIST) is f)
+        self.assertFalse(get_regexp_filter("Other") is f)
+        self.assertFalse(get_regexp_filter(None).matches("WikiStart"))
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(HTMLParserTestCase, "test"))
+    suite.addTest(unittest.makeSuite(StreamingHTMLParserTestCase, "test"))
+    suite.addTest(unittest.makeSuite(MultipartStreamTestCase, "test"))
+    suite.addTest(unittest.makeSuite(RemoteVersionsTestCase, "test"))
+    suite.addTest(unittest.makeSuite(PushTestCase, "test"))
     suite.addTest(unittest.makeSuite(StringMaskTestCase, "test"))
+    suite.addTest(unittest.makeSuite(RegExpFilterTestCase, "test"))
     return suite
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import threading, urllib2
+from bisect import bisect_left
+from hashlib import sha1
+from wikisync.metrics import METRICS
+from wikisync.util import safe_str, text_digest
+
+# version of the tree format, both instances must build identical trees
+TREE_VERSION = 1
+
+# nodes of at most this number of pages are leaves, listing their pages
+LEAF_SIZE = 64
+
+# maximum number of nodes requested at a time
+MAX_PREFIXES = 50
+
+# the local wiki entries by environment path, see local_entries()
+_ENTRIES = {}
+
+_ENTRIES_LOCK = threading.Lock()
+
+# the remote servers without a hash tree, by url, see compare_tree()
+_UNSUPPORTED = set()
+
+def tree_node(entries, prefix, memo=None):
+    """Returns the node of the hash tree of the pages starting with 'prefix'
+    as a dict of its 'hash', the 'count' of pages, and either the 'pages' of
+    a leaf, or the 'children' of an inner node as [prefix, hash, count]
+    lists, along with the page named 'prefix' if any.
+
+    The pages of an inner node are bucketed by the character following the
+    prefix, the prefix of a bucket is extended to the longest prefix common
+    to its pages. The tree of a set of pages is thus identical on both
+    instances, regardless of the pages outside the node.
+
+    @param entries: a sorted array of (name, version, digest) tuples.
+    @param prefix: the name prefix of the node.
+    @param memo: optional dict of the hashes already computed by prefix.
+    """
+    if memo is None:
+        memo = {}
+    lo, hi = _prefix_range(entries, prefix)
+    return _node(entries, lo, hi, prefix, memo)
+
+def _node(entries, lo, hi, prefix, memo):
+    if hi - lo <= LEAF_SIZE:
+        pages = entries[lo:hi]
+        return {"hash": _hash(pages, ()), "count": hi - lo,
+            "pages": [list(page) for page in pages]}
+    pages = []
+    i = lo
+    if entries[i][0] == prefix:
+        pages.append(entries[i])
+        i += 1
+    groups = []
+    while i < hi:
+        first = entries[i][0]
+        j = _prefix_range(entries, first[:len(prefix) + 1], i, hi)[1]
+        groups.append((_common_prefix(first, entries[j - 1][0]), i, j))
+        i = j
+    if not pages and len(groups) == 1:
+        # all the pages share a longer prefix, the node is skipped
+        return _node(entries, lo, hi, groups[0][0], memo)
+    children = [[child, _local_hash(entries, i, j, child, memo), j - i]
+        for child, i, j in groups]
+    return {"hash": _hash(pages, children), "count": hi - lo,
+        "pages": [list(page) for page in pages], "children": children}
+
+def _local_hash(entries, lo, hi, prefix, memo):
+    h = memo.get(prefix)
+    if h is None:
+        h = memo[prefix] = _node(entries, lo, hi, prefix, memo)["hash"]
+    return h
+
+def _hash(pages, children):
+    h = sha1()
+    for name, version, digest in pages:
+        h.update(safe_str(u"%s\t%s\t%s\n" % (name, version, digest or "")))
+    for child, child_hash, count in children:
+        h.update(safe_str(u"%s\t%s\n" % (child, child_hash)))
+    return h.hexdigest()
+
+def _prefix_range(entries, prefix, lo=0, hi=None):
+    """Returns the (start, end) indexes of the names starting with prefix"""
+    if hi is None:
+        hi = len(entries)
+    start = bisect_left(entries, (prefix,), lo, hi)
+    if prefix:
+        # the highest code point sorts after any name starting with prefix
+        end = bisect_left(entries, (prefix + u"\U0010ffff",), start, hi)
+    else:
+        end = hi
+    return start, end
+
+def _common_prefix(a, b):
+    i = 0
+    n = min(len(a), len(b))
+    while i < n and a[i] == b[i]:
+        i += 1
+    return a[:i]
+
+def local_entries(env):
+    """Returns a sorted array of the (name, version, digest) of the local
+    wikis. The digests are kept in memory and only computed for the wikis
+    changed since the previous call."""
+    db = env.get_read_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT name, MAX(version) FROM wiki GROUP BY name")
+    versions = dict(cursor.fetchall())
+    with _ENTRIES_LOCK:
+        cached = _ENTRIES.setdefault(env.path, {})
+        for name in cached.keys():
+            if name not in versions:
+                del cached[name]
+        stale = [name for name, version in versions.items()
+            if cached.get(name, (None,))[0] != version]
+        if len(stale) > len(versions) / 2:
+            cursor.execute("""
+                SELECT w.name, w.version, w.text FROM wiki w
+                INNER JOIN (
+                    SELECT name, MAX(version) AS version
+                    FROM wiki GROUP BY name
+                ) l ON w.name = l.name AND w.version = l.version
+            """)
+            for name, version, text in cursor:
+                cached[name] = (version, text_digest(text))
+        else:
+            for name in stale:
+                cursor.execute("""
+                    SELECT text FROM wiki WHERE name=%s AND version=%s
+                """, (name, versions[name]))
+                row = cursor.fetchone()
+                cached[name] = (versions[name], text_digest(row[0]))
+        return sorted([(name, version, digest)
+            for name, (version, digest) in cached.items()])
+
+def tree_supported(client):
+    """Returns False if the client cannot read the remote hash tree, or
+    the remote server did not provide it within this process"""
+    return hasattr(client, "get_remote_tree") and \
+        client.baseurl not in _UNSUPPORTED
+
+def compare_tree(client, entries):
+    """Walks the remote hash tree, descending into the nodes that differ
+    from the local 'entries'. Returns a (changed, removed) tuple, where
+    changed is an array of dict of the 'name', 'remote_version' and
+    'remote_digest' of the remote wikis that differ, and removed an array
+    of the names of the entries missing remotely.
+
+    @param client: a client providing get_remote_tree(), e.g. WebClient.
+    @param entries: a sorted array of the (name, version, digest) of the
+        remote wikis as last known.
+    """
+    changed = []
+    removed = []
+    memo = {}
+    pending = [u""]
+    while pending:
+        nodes = {}
+        for i in xrange(0, len(pending), MAX_PREFIXES):
+            try:
+                response = client.get_remote_tree(
+                    pending[i:i + MAX_PREFIXES])
+            except urllib2.HTTPError, e:
+                if e.code in (403, 404):
+                    # the remote server is missing the WikiSync plugin, or
+                    # denies the tree to the remote user, e.g. anonymous
+                    _UNSUPPORTED.add(client.baseurl)
+                raise
+            if response.get("version") != TREE_VERSION:
+                _UNSUPPORTED.add(client.baseurl)
+                raise ValueError("Unsupported tree version '%s'" % \
+                    response.get("version"))
+            nodes.update(response["nodes"])
+        prefixes, pending = pending, []
+        for prefix in prefixes:
+            node = nodes[prefix]
+            lo, hi = _prefix_range(entries, prefix)
+            if _local_hash(entries, lo, hi, prefix, memo) == node["hash"]:
+                continue
+            # the local pages of the node covered neither by the remote pages
+            # nor by the remote children are removed
+            covered = set([page[0] for page in node["pages"]])
+            for child, child_hash, count in node.get("children", ()):
+                c_lo, c_hi = _prefix_range(entries, child, lo, hi)
+                covered.update([e[0] for e in entries[c_lo:c_hi]])
+                if _local_hash(entries, c_lo, c_hi, child, memo) != child_hash:
+                    pending.append(child)
+            known = dict([(e[0], e) for e in entries[lo:hi]])
+            for name, version, digest in node["pages"]:
+                if known.get(name) != (name, version, digest):
+                    changed.append({"name": name, "remote_version": version,
+                        "remote_digest": digest})
+            removed.extend([e[0] for e in entries[lo:hi]
+                if e[0] not in covered])
+    METRICS.count("tree_changes", len(changed) + len(removed))
+    return changed, removed
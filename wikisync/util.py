@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
-import zlib, base64, os, tempfile, cookielib, urllib2, \
-    urllib, itertools, re
-from hashlib import md5
+import zlib, base64, os, urllib2, \
+    urllib, itertools, re, time, HTMLParser
+from hashlib import sha1
+from uuid import uuid4
 from StringIO import StringIO
-from genshi.input import HTMLParser
+from genshi.input import HTMLParser as GenshiHTMLParser
 from urlparse import urlparse, parse_qs
+from wikisync.connection import POOL, KeepAliveHandler, KeepAliveHTTPSHandler
+from wikisync.cache import CacheHandler
+from wikisync.metrics import METRICS
+from wikisync.session import SESSIONS, session_key
 try:
     import simplejson as json
 except ImportError:
@@ -59,6 +64,30 @@ def safe_int(value):
     except:
         return 0
         
+def text_digest(text):
+    """Returns the hex digest of a wiki text, line endings are normalized
+    before computing the digest."""
+    return sha1(safe_str(text or "").replace("\r\n", "\n")).hexdigest()
+
+def file_digest(source, target=None, bufsize=64 * 1024):
+    """Reads a file like object to the end, returns a (size, hex digest)
+    tuple of its content.
+    
+    @param target: optional file like object the content is copied to.
+    @param bufsize: number of bytes read at a time.
+    """
+    digest = sha1()
+    size = 0
+    while True:
+        data = source.read(bufsize)
+        if not data:
+            break
+        digest.update(data)
+        size += len(data)
+        if target:
+            target.write(data)
+    return size, digest.hexdigest()
+
 def str_mask(message):
     """Masks a string to make it unreadable.
     This is not to be used as a mean of encryption"""
@@ -76,11 +105,15 @@ def str_unmask(masked):
         raise ValueError("Unable to unmask string: %s" % e)
 
 def safe_urlencode(data):
-    """Returns an url encoded string, safely handles string encodings"""
+    """Returns an url encoded string, safely handles string encodings, list
+    values are encoded as repeated parameters"""
     safe = {}
     for k, v in data.items():
-        safe[safe_str(k)] = safe_str(v)
-    return urllib.urlencode(safe)
+        if isinstance(v, (list, tuple)):
+            safe[safe_str(k)] = [safe_str(i) for i in v]
+        else:
+            safe[safe_str(k)] = safe_str(v)
+    return urllib.urlencode(safe, True)
 
 def server_name(url):
     """Returns a readable server name"""
@@ -98,7 +131,7 @@ def parse_form_params(source, form_id=None, exclude=None):
         f = source
     else:
         raise AssertionError("Expect file like object, got %s" % source)
-    parser = HTMLParser(f)
+    parser = GenshiHTMLParser(f)
     params = {}
     def parse_input(kind, data):
         if kind == "END":
@@ -120,109 +153,558 @@ def parse_form_params(source, form_id=None, exclude=None):
             params[params["__textarea__"]] = data
             del params["__textarea__"]
     
-    parse_form_params.handler = parse_input
+    # the current handler, local to the call as the workers of BatchSync
+    # parse forms concurrently
+    handler = [parse_input]
     if form_id:
         def parse_form(kind, data):
             if kind == "START":
                 qname, attrs = data
                 if qname.localname == "form" \
                     and attrs.get("id", None) == form_id:
-                    parse_form_params.handler = parse_input
-        parse_form_params.handler = parse_form
+                    handler[0] = parse_input
+        handler[0] = parse_form
     for kind, data, pos in parser:
-        if parse_form_params.handler(kind, data):
+        if handler[0](kind, data):
             break
     return params
     
+def parse_attachments(source, path_prefix):
+    """Parses an attachment list HTML source and return an array of dict
+    containing the attachment 'filename', 'size' in bytes and 'time', the 
+    time is the remote date as displayed, only suitable for comparison.
+    
+    @param path_prefix: the url path of the raw attachments of the page,
+        e.g. '/raw-attachment/wiki/WikiStart'.
+    """
+    if hasattr(source, "read"):
+        source = source.read()
+    path_prefix = urllib.unquote(safe_str(path_prefix)).rstrip("/") + "/"
+    links = []
+    for m in _HREF_RE.finditer(source):
+        href = urllib.unquote(safe_str(_unescape(m.group(1))))
+        if href.startswith(path_prefix) and \
+            "/" not in href[len(path_prefix):]:
+            links.append((m, href[len(path_prefix):]))
+    attachments = {}
+    for i, (m, filename) in enumerate(links):
+        # the details follows the link, up to the next attachment
+        end = i + 1 < len(links) and links[i + 1][0].start() or len(source)
+        details = source[m.end():end]
+        size = _ATTACHMENT_SIZE_RE.search(details)
+        if not size:
+            continue
+        date = _ATTACHMENT_TIME_RE.search(details, size.end())
+        filename = safe_unicode(filename)
+        attachments[filename] = {
+            "filename": filename,
+            "size": safe_int(re.sub(r"\D", "", size.group(1))),
+            "time": date and safe_unicode(
+                urllib.unquote(date.group(1) or date.group(2))) or None
+        }
+    return attachments.values()
+
 def parse_recent_changes(source, path_prefix="/wiki"):
     """Parses the 'RecentChanges' HTML source and return an array of dict
     containing the wiki 'name' and 'remote_version'"""
-    return _parse_html_version_links(source, 
-        lambda data: data[1].get("id", None) == "wikipage", 
-        path_prefix
-    )
+    return _merge_version_links(iter_recent_changes(source, path_prefix))
 
-def parse_timeline(source, path_prefix="/wiki"):
+def parse_timeline(source, path_prefix="/wiki", versioned_only=False):
     """Parses the 'Timeline' HTML source and return an array of dict
-    containing the wiki 'name' and 'remote_version'"""
-    return _parse_html_version_links(source, 
-        lambda data: data[1].get("id", None) == "content", 
-        path_prefix
-    )
+    containing the wiki 'name' and 'remote_version'
+    
+    Set 'versioned_only' to ignore wiki links without a version, e.g. pages
+    mentioned in the change comments."""
+    return _merge_version_links(
+        iter_timeline(source, path_prefix, versioned_only))
 
 def parse_wiki(source, path_prefix="/wiki"):
     """Parses a wiki pageit HTML source and return an array of dict
     containing the wiki 'name' and 'remote_version'"""
-    return _parse_html_version_links(source, 
-        lambda data: data[1].get("class", None) == "trac-modifiedby", 
+    return _merge_version_links(iter_wiki(source, path_prefix))
+
+def iter_recent_changes(source, path_prefix="/wiki"):
+    """Streaming version of parse_recent_changes(), yields a dict of 'name'
+    and 'remote_version' for every wiki link found. A wiki may be yielded 
+    more than once."""
+    return iter_version_links(source, 
+        lambda attrs: attrs.get("id", None) == "wikipage",
+        path_prefix
+    )
+
+def iter_timeline(source, path_prefix="/wiki", versioned_only=False):
+    """Streaming version of parse_timeline(), see iter_recent_changes()"""
+    return iter_version_links(source, 
+        lambda attrs: attrs.get("id", None) == "content",
+        path_prefix,
+        versioned_only
+    )
+
+def iter_wiki(source, path_prefix="/wiki"):
+    """Streaming version of parse_wiki(), see iter_recent_changes()"""
+    return iter_version_links(source, 
+        lambda attrs: attrs.get("class", None) == "trac-modifiedby",
         path_prefix
     )
+
+def iter_version_links(source, check_attrs, path_prefix, 
+    versioned_only=False, bufsize=16 * 1024):
+    """Yields a dict of 'name' and 'remote_version' for every wiki link
+    found within the first HTML element matching 'check_attrs'.
+    
+    The source is read incrementally, reading stops as soon as the matching
+    element is closed.
     
-def _parse_html_version_links(source, check_data, path_prefix):
+    @param source: a HTML string or file like object.
+    @param check_attrs: a callable receiving the dict of attributes of a 
+        start tag, returns True if the links within the element should 
+        be parsed.
+    @param path_prefix: the url path of the wiki.
+    @param versioned_only: ignores wiki links without a version.
+    @param bufsize: number of bytes read from the source at a time.
+    """
     if isinstance(source, basestring):
-        f = StringIO(source)
+        chunks = (source[i:i + bufsize] \
+            for i in xrange(0, len(source), bufsize))
     elif hasattr(source, "read"):
-        f = source
+        chunks = iter(lambda: source.read(bufsize), "")
     else:
         raise AssertionError("Expect file like object, got %s" % source)
-    parser = HTMLParser(f)
-    counter = 0
-    found_level = -1
-    handler = None
+    scanner = _VersionLinkScanner(check_attrs, path_prefix, versioned_only)
+    for chunk in chunks:
+        for record in scanner.feed(chunk):
+            yield record
+        if scanner.done:
+            return
+    for record in scanner.feed("", final=True):
+        yield record
+
+def _merge_version_links(records):
     map = {}
-    path_prefix = path_prefix or "/"
-    if not path_prefix.endswith("/"):
-        path_prefix = "%s/" % path_prefix
-    path_prefix_len = len(path_prefix)
-    for kind, data, pos in parser:
-        if kind == "START":
-            counter += 1
-            if found_level != -1:
-                href = data[1].get("href", None)
-                if href and href.startswith(path_prefix):
-                    url = urlparse(href)
-                    path = safe_unicode(
-                        urllib.unquote(
-                            safe_str(url.path[path_prefix_len:])
-                        ).decode("utf-8")
-                    )
-                    if path in map:
-                        item = map[path]
-                    else:
-                        item = map[path] = {
-                            "name":path,
-                            "remote_version":1
-                        }
-                    if url.query:
-                        qs = parse_qs(url.query)
-                        version = "version" in qs and int(qs["version"][0]) or 0
-                        if item["remote_version"] < version:
-                            item["remote_version"] = version
-            elif check_data(data):
-               found_level = counter
-        elif kind == "END":
-            counter -= 1
-            if found_level and counter < found_level:
-                break
+    for record in records:
+        item = map.get(record["name"], None)
+        if not item:
+            map[record["name"]] = record
+        elif item["remote_version"] < record["remote_version"]:
+            item["remote_version"] = record["remote_version"]
     return map.values()
 
+_TAG_RE = re.compile(r"""<(/?)([a-zA-Z][-.a-zA-Z0-9:_]*)"""
+    r"""((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+
+_ATTR_RE = re.compile(r"""([^\s=/>]+)(?:\s*=\s*"""
+    r"""(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?""")
+
+_CDATA_ELEMS = ("script", "style")
+
+_HREF_RE = re.compile(r"""\shref\s*=\s*["']([^"']+)["']""")
+
+_ATTACHMENT_SIZE_RE = re.compile(r"""<span title="(\d[\d,.\s]*)""")
+
+_ATTACHMENT_TIME_RE = re.compile(
+    r"""[?&;]from=([^&"']+)|<span title="([^"]+)">""")
+
+# edit form fields specific to a wiki, the other fields are reused for all
+# the wikis of a session
+_EDIT_PAGE_FIELDS = ("__FORM_TOKEN", "version", "text", "comment")
+
+# maximum number of bytes of the remote index read by get_remote_versions()
+PROBE_MAX_BYTES = 256 * 1024
+
+_VERSION_QUERY_RE = re.compile(r"(?:^|&)version=(\d+)(?:&|$)")
+
+# the removal of the session cookie sent by trac along the response to an
+# expired session
+_EXPIRED_COOKIE = re.compile(r'\s*trac_auth=(?:"")?\s*(?:;|$)')
+
+_unescape = HTMLParser.HTMLParser().unescape
+
+def _parse_attrs(text):
+    attrs = {}
+    for m in _ATTR_RE.finditer(text):
+        name = m.group(1).lower()
+        value = m.group(2)
+        if value is None:
+            value = m.group(3)
+            if value is None:
+                value = m.group(4)
+                if value is None:
+                    value = name
+        if "&" in value:
+            value = _unescape(value)
+        attrs.setdefault(name, value)
+    return attrs
+
+class _VersionLinkScanner(object):
+    """Collects the wiki version links as the HTML source is fed.
+    
+    Only the tags are tokenized, text, comments and the content of script
+    and style elements are skipped. Tags are balanced the same way as
+    genshi.input.HTMLParser."""
+    
+    EMPTY_ELEMS = frozenset(["area", "base", "basefont", "br", "col", 
+        "frame", "hr", "img", "input", "isindex", "link", "meta", "param"])
+
+    def __init__(self, check_attrs, path_prefix, versioned_only=False):
+        self.check_attrs = check_attrs
+        self.versioned_only = versioned_only
+        path_prefix = path_prefix or "/"
+        if not path_prefix.endswith("/"):
+            path_prefix = "%s/" % path_prefix
+        self.path_prefix = path_prefix
+        self.done = False
+        self._buffer = ""
+        self._cdata = None
+        self._open_tags = []
+        self._found_level = -1
+
+    def feed(self, data, final=False):
+        """Returns the records found in the data fed so far"""
+        records = []
+        buf = self._buffer and self._buffer + data or data
+        pos = 0
+        size = len(buf)
+        while not self.done:
+            if self._cdata:
+                end = buf.lower().find("</%s" % self._cdata, pos)
+                if end < 0:
+                    break
+                self._cdata = None
+                pos = end
+            i = buf.find("<", pos)
+            if i < 0:
+                pos = size
+                break
+            if buf.startswith("<!--", i):
+                end = buf.find("-->", i + 4)
+                if end < 0:
+                    pos = i
+                    break
+                pos = end + 3
+                continue
+            m = _TAG_RE.match(buf, i)
+            if m:
+                pos = m.end()
+                if m.group(1):
+                    self._end_tag(m.group(2).lower())
+                else:
+                    self._start_tag(m.group(2).lower(), m.group(3), records)
+                continue
+            if buf.startswith("<!", i) or buf.startswith("<?", i):
+                end = buf.find(">", i)
+                if end < 0:
+                    pos = i
+                    break
+                pos = end + 1
+                continue
+            if buf.find("<", i + 1) < 0 and buf.find(">", i) < 0:
+                # incomplete tag, wait for more data
+                pos = i
+                break
+            # stray '<' within the text
+            pos = i + 1
+        self._buffer = not final and not self.done and buf[pos:] or ""
+        return records
+
+    def _start_tag(self, tag, attrs, records):
+        if attrs.endswith("/"):
+            attrs = attrs[:-1]
+            closed = True
+        else:
+            closed = False
+        if tag not in self.EMPTY_ELEMS:
+            self._open_tags.append(tag)
+        if self._found_level != -1:
+            if "href" in attrs.lower():
+                record = self._parse_href(_parse_attrs(attrs).get("href"))
+                if record:
+                    records.append(record)
+        elif self.check_attrs(_parse_attrs(attrs)):
+            self._found_level = len(self._open_tags)
+            if tag in self.EMPTY_ELEMS:
+                # an empty element closes immediately
+                self.done = True
+                return
+        if closed:
+            self._end_tag(tag)
+        elif tag in _CDATA_ELEMS:
+            self._cdata = tag
+
+    def _end_tag(self, tag):
+        if tag in self.EMPTY_ELEMS:
+            return
+        open_tags = self._open_tags
+        while open_tags:
+            if open_tags.pop() == tag:
+                break
+        if self._found_level != -1 and \
+            len(open_tags) < self._found_level:
+            self.done = True
+
+    def _parse_href(self, href):
+        if not href or not href.startswith(self.path_prefix):
+            return
+        if self.versioned_only and "version=" not in href:
+            return
+        if not isinstance(href, unicode):
+            href = href.decode("utf-8", "replace")
+        if ";" in href:
+            url = urlparse(href)
+            path, query = url.path, url.query
+        else:
+            path, _, query = href.partition("#")[0].partition("?")
+        path = safe_unicode(
+            urllib.unquote(
+                safe_str(path[len(self.path_prefix):])
+            ).decode("utf-8")
+        )
+        version = 1
+        if query:
+            m = _VERSION_QUERY_RE.search(query)
+            if m:
+                version = max(version, int(m.group(1)))
+            elif "version=" in query:
+                qs = parse_qs(query)
+                version = max(version, 
+                    "version" in qs and int(qs["version"][0]) or 0)
+        return {
+            "name": path,
+            "remote_version": version
+        }
+
+# regular expression special characters
+_REGEXP_SPECIAL = frozenset(".^$*+?{}[]\\|()")
+
+# patterns that cannot be combined with other patterns in a single regex,
+# group references and inline flags depends on the pattern position
+_REGEXP_STANDALONE_RE = re.compile(r"\\[1-9]|\(\?P|\(\?[iLmsux]")
+
+def _regexp_literal(pattern):
+    """Returns the text matched by a pattern without special characters,
+    or None if the pattern is not a literal."""
+    chars = []
+    escaped = False
+    for c in pattern:
+        if escaped:
+            if c.isalnum():
+                # character classes such as \d or \w
+                return None
+            chars.append(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in _REGEXP_SPECIAL:
+            return None
+        else:
+            chars.append(c)
+    if escaped:
+        return None
+    return "".join(chars)
+
+def _regexp_prefix(pattern):
+    """Returns a ('prefix' or 'exact', text) tuple for patterns matching 
+    names starting with (or equal to) a literal text, or None for other 
+    patterns. Patterns are matched at the beginning of names only, i.e.
+    'Trac*' matches all names starting with 'Tra'."""
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+    if not pattern or pattern == ".*":
+        return "prefix", ""
+    if pattern.endswith("$") and not pattern.endswith("\\$"):
+        literal = _regexp_literal(pattern[:-1])
+        return literal is not None and ("exact", literal) or None
+    if pattern.endswith(".*") and not pattern.endswith("\\.*"):
+        pattern = pattern[:-2]
+    elif len(pattern) > 1 and pattern[-1] in "*?" and \
+        pattern[-2] not in _REGEXP_SPECIAL and pattern[-3:-2] != "\\":
+        # the last character is optional
+        pattern = pattern[:-2]
+    if not pattern:
+        return "prefix", ""
+    literal = _regexp_literal(pattern)
+    return literal is not None and ("prefix", literal) or None
+
 class RegExpFilter(object):
-    """Helper class to match a string to multiple regular expressions."""
+    """Helper class to match a string to multiple regular expressions.
+    
+    Each expression is matched at the beginning of the string. Literal 
+    expressions and expressions matching a literal prefix such as 'Trac*'
+    or 'Wiki.*' are looked up in sets of prefixes, by prefix length. The
+    remaining expressions are combined into a single regular expression.
+    """
     
     def __init__(self, filters):
         if isinstance(filters, basestring):
             filters = filters.split()
-        self._regexes = filters and [re.compile(f) for f in filters] or []
+        filters = filters or []
+        self._exact = set()
+        self._prefixes = {}
+        patterns = []
+        standalone = []
+        groups = 0
+        for f in filters:
+            regex = re.compile(f)
+            prefix = _regexp_prefix(f)
+            if prefix and prefix[0] == "exact":
+                self._exact.add(prefix[1])
+            elif prefix:
+                self._prefixes.setdefault(len(prefix[1]), set()).add(
+                    prefix[1])
+            elif _REGEXP_STANDALONE_RE.search(f):
+                standalone.append(regex)
+            else:
+                # python limits the number of groups in an expression
+                if groups + regex.groups > 99:
+                    standalone.append(self._combine(patterns))
+                    patterns = []
+                    groups = 0
+                patterns.append(f)
+                groups += regex.groups
+        self._prefix_lengths = sorted(self._prefixes.keys())
+        self._regexes = standalone
+        if patterns:
+            self._regexes.insert(0, self._combine(patterns))
+    
+    def _combine(self, patterns):
+        return re.compile("|".join(["(?:%s)" % p for p in patterns]))
     
     def matches(self, name):
+        if name in self._exact:
+            return True
+        length = len(name)
+        for n in self._prefix_lengths:
+            if n > length:
+                break
+            if name[:n] in self._prefixes[n]:
+                return True
         for r in self._regexes:
             if r.match(name):
                 return True
         return False
+
+# RegExpFilter by filters, see get_regexp_filter()
+_REGEXP_FILTERS = {}
+
+_REGEXP_FILTERS_MAX = 16
+
+def get_regexp_filter(filters):
+    """Returns a RegExpFilter, reusing the filter previously built for the
+    same 'filters' string."""
+    filters = filters or ""
+    ignore_filter = _REGEXP_FILTERS.get(filters)
+    if ignore_filter is None:
+        ignore_filter = RegExpFilter(filters)
+        if len(_REGEXP_FILTERS) >= _REGEXP_FILTERS_MAX:
+            _REGEXP_FILTERS.clear()
+        _REGEXP_FILTERS[filters] = ignore_filter
+    return ignore_filter
         
+class _LimitedReader(object):
+    """Reads a file like object up to a number of bytes, then reads as
+    if the end of the file was reached"""
+
+    def __init__(self, f, limit):
+        self.f = f
+        self.remaining = limit
+        self.truncated = False
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            self.truncated = True
+            return ""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+class MultipartStream(object):
+    """A multipart/form-data request body, read incrementally by httplib.
+    
+    The files are read from disk as the body is sent, the size of the body
+    is known in advance for the Content-Length header.
+    """
+
+    def __init__(self, fields, files, bufsize=64 * 1024):
+        """
+        @param fields: a dict of form field values.
+        @param files: an array of (field name, filename, path) tuple.
+        """
+        self.boundary = "----wikisync%s" % uuid4().hex
+        self.content_type = "multipart/form-data; boundary=%s" % \
+            self.boundary
+        self.bufsize = bufsize
+        parts = []
+        for name, value in sorted(fields.items()):
+            parts.append("--%s\r\nContent-Disposition: form-data; "
+                "name=\"%s\"\r\n\r\n%s\r\n" % (self.boundary, 
+                    _quote_header(name), safe_str(value)))
+        for name, filename, path in files:
+            parts.append("--%s\r\nContent-Disposition: form-data; "
+                "name=\"%s\"; filename=\"%s\"\r\n"
+                "Content-Type: application/octet-stream\r\n\r\n" % \
+                (self.boundary, _quote_header(name), 
+                    _quote_header(filename)))
+            parts.append((path, os.path.getsize(path)))
+            parts.append("\r\n")
+        parts.append("--%s--\r\n" % self.boundary)
+        self._parts = parts
+        self._length = sum([part[1] if isinstance(part, tuple) else len(part)
+            for part in parts])
+        self._file = None
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset):
+        """Rewinds the body, e.g. to resend the request"""
+        assert offset == 0, "Only rewinding is supported"
+        self.close()
+        self._index = 0
+        self._buffer = ""
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            if self._buffer:
+                chunk = self._buffer[:remaining]
+                self._buffer = self._buffer[remaining:]
+            elif self._file:
+                chunk = self._file.read(min(remaining, self.bufsize))
+                if not chunk:
+                    self.close()
+                    continue
+            elif self._index < len(self._parts):
+                part = self._parts[self._index]
+                self._index += 1
+                if isinstance(part, tuple):
+                    self._file = open(part[0], "rb")
+                else:
+                    self._buffer = part
+                continue
+            else:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return "".join(chunks)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def _quote_header(value):
+    return safe_str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\r", " ").replace("\n", " ")
+
 class WebClient(object):
 
-    def __init__(self, baseurl, username=None, password=None, debug=False):
+    def __init__(self, baseurl, username=None, password=None, debug=False,
+        pool=None, cache=None, compress=True, log=None, sessions=None):
         assert isinstance(baseurl, basestring) and len(baseurl), \
             "'baseurl' expects string, got '%s'" % baseurl
         if baseurl.endswith("/"):
@@ -231,60 +713,116 @@ class WebClient(object):
         self.username = username
         self.password = password
         self.debug = debug
-        self._cookie_jar = None
+        self.pool = pool or POOL
+        self.cache = cache
+        self.compress = compress
+        self.log = log
+        self.sessions = sessions or SESSIONS
+        self._session = None
         self._opener = None
-        self._authenticated = False
     
-    def open(self, path, data=None, method="GET"):
+    def open(self, path, data=None, method="GET", headers=None):
+        """Opens a remote path, returns the response.
+        
+        @param data: a dict of parameters, or a file like request body,
+            e.g. a MultipartStream.
+        @param headers: a dict of additional request headers.
+        """
         self.authenticate()
+        generation = self._session.generation
         url = self.url(path)
-        qs = data and safe_urlencode(data) or None
+        if hasattr(data, "read"):
+            qs = data
+        else:
+            qs = data and safe_urlencode(data) or None
         try:
             if qs and method == "GET":
                 url = "%s?%s" % (url, qs)
                 qs = None
-            req = urllib2.Request(url)
-            return self.opener().open(req, qs)
+            req = urllib2.Request(url, headers=headers or {})
+            return self._request(req, qs)
         except urllib2.HTTPError, e:
-            if e.code in (401,):
-                self.authenticate()
-                return self.opener().open(req, data)
+            if self.username and self.password and self._expired(req, e):
+                if e.fp is not None:
+                    # releases the connection
+                    e.close()
+                self._login(generation)
+                if hasattr(qs, "seek"):
+                    qs.seek(0)
+                # a new request, the cookie header of the rejected request
+                # would be kept otherwise
+                req = urllib2.Request(url, headers=headers or {})
+                return self._request(req, qs)
             else:
                 raise e
+
+    def _expired(self, req, e):
+        """Returns True if the request was denied to an anonymous or
+        expired session, rather than for missing permissions"""
+        if e.code == 401:
+            return True
+        if e.code != 403:
+            return False
+        if "trac_auth=" not in (req.get_header("Cookie") or ""):
+            return True
+        # trac treats an expired session as anonymous, and removes its
+        # cookie
+        return any([_EXPIRED_COOKIE.match(header)
+            for header in e.info().getheaders("Set-Cookie")])
+
+    def _request(self, req, data):
+        METRICS.count("requests")
+        with METRICS.timed("http"):
+            return self.opener().open(req, data)
                 
     def opener(self, no_cache=False):
+        """Returns the opener of this client, using the cookies of the 
+        session shared by the process, see wikisync.session.
+        
+        @param no_cache: discards the session, forcing a new login.
+        """
         if not self._opener:
-            m = md5()
-            m.update(self.baseurl)
-            m.update(self.username or "username")
-            m.update(self.password or "password")
-            hash = m.hexdigest()
-            cookie_file = os.path.join(tempfile.gettempdir(), hash)
-            if no_cache and os.path.isfile(cookie_file):
-                os.remove(cookie_file)
-            has_cookie = os.path.isfile(cookie_file)
-            cookie_jar = cookielib.LWPCookieJar(cookie_file)
-            handlers = [urllib2.HTTPCookieProcessor(cookie_jar)]
-            if self.debug:
-                handlers.append(urllib2.HTTPHandler(debuglevel=1))
-            if has_cookie:
-                cookie_jar.load(ignore_discard=True)
-            opener = urllib2.build_opener(*handlers)
-            self._require_authentication = False
-            if self.username and self.password:
-                password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                password_mgr.add_password(None, self.baseurl, 
-                    self.username, self.password)
-                opener.add_handler(urllib2.HTTPBasicAuthHandler(password_mgr))
-                opener.add_handler(urllib2.HTTPDigestAuthHandler(password_mgr))
-                self._require_authentication = not has_cookie
-            self._opener = opener
-            self._cookie_jar = cookie_jar
+            if no_cache:
+                self.sessions.discard(self.baseurl, self.username, 
+                    self.password)
+            self._session = self.sessions.get(self.baseurl, self.username,
+                self.password)
+            handlers = [urllib2.HTTPCookieProcessor(
+                self._session.cookie_jar)]
+            self._opener = self._build_opener(handlers)
         return self._opener
     
+    def _credentials_hash(self):
+        return session_key(self.baseurl, self.username, self.password)
+    
+    def _build_opener(self, handlers):
+        debuglevel = self.debug and 1 or 0
+        handlers = handlers + [
+            KeepAliveHandler(self.pool, debuglevel, self.compress),
+            KeepAliveHTTPSHandler(self.pool, debuglevel, self.compress)
+        ]
+        if self.cache:
+            handlers.append(CacheHandler(self.cache, 
+                self._credentials_hash()))
+        opener = urllib2.build_opener(*handlers)
+        if self.username and self.password:
+            password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
+            password_mgr.add_password(None, self.baseurl, 
+                self.username, self.password)
+            opener.add_handler(urllib2.HTTPBasicAuthHandler(password_mgr))
+            opener.add_handler(urllib2.HTTPDigestAuthHandler(password_mgr))
+        return opener
+    
+    def clone(self):
+        """Returns a new WebClient sharing the authenticated session of
+        this instance. Each thread should use its own clone."""
+        self.authenticate()
+        return WebClient(self.baseurl, self.username, self.password, 
+            self.debug, self.pool, self.cache, self.compress, self.log,
+            self.sessions)
+    
     def close(self):
         self.save_cookie()
-        self._cookie_jar = None
         self._opener = None
     
     def test(self):
@@ -293,19 +831,24 @@ class WebClient(object):
         return self.open("wiki")
         
     def authenticate(self):
-        opener = self.opener()
-        if self._require_authentication:
-            try:
-                opener.open(urllib2.Request(self.url("login")))
-                self.save_cookie()
-                self._require_authentication = False
-            except Exception, e:
-                self.close()
-                raise e
+        """Logs in unless the session is already authenticated"""
+        self.opener()
+        if not self._session.authenticated:
+            self._login()
+
+    def _login(self, generation=None):
+        """Logs in, unless another client has logged in since the session
+        'generation' was rejected"""
+        def login():
+            METRICS.count("logins")
+            self._opener.open(urllib2.Request(self.url("login"))).close()
+        if self._session.login(login, generation) and self.log:
+            self.log.debug("Logged in to %s" % self.baseurl)
          
     def save_cookie(self):
-        if self._cookie_jar:
-            self._cookie_jar.save(ignore_discard=True)
+        """Writes the cookies of the session if they have changed"""
+        if self._session:
+            self._session.save()
 
     def url(self, path=""):
         return safe_url(self.baseurl, path)
@@ -313,47 +856,253 @@ class WebClient(object):
     def basepath(self, path=""):
         return urlparse(self.url(path)).path
     
+    def stats(self):
+        """Returns the connection pool counters, and the response cache 
+        counters prefixed with 'cache_'"""
+        stats = self.pool.stats()
+        if self.cache:
+            for k, v in self.cache.stats().items():
+                stats["cache_%s" % k] = v
+        return stats
+    
     def get_remote_list(self):
-        return parse_recent_changes(
-            self.open("wiki/RecentChanges"), self.basepath("wiki"))
+        return self._parse(parse_recent_changes, "wiki/RecentChanges")
     
     def get_remote_updates(self, date, days=10):
+        """Returns the wiki changed within the timeline window.
+        
+        @param date: a timestamp of the end of the window, the remote server
+            includes all changes until the end of that day.
+        @param days: number of days before 'date' to include.
+        """
         data = {
             "wiki": "on",
+            "from": time.strftime("%Y-%m-%d", time.gmtime(date)),
+            "daysback": days,
         }
-        return parse_timeline(
-            self.open("timeline", data, "GET"), self.basepath("wiki"))
+        f = self.open("timeline", data, "GET")
+        try:
+            with METRICS.timed("parse"):
+                return parse_timeline(f, self.basepath("wiki"), 
+                    versioned_only=True)
+        finally:
+            self._close(f)
     
     def get_remote_version(self, name):
-        return parse_wiki(
-            self.open("wiki/%s" % name), self.basepath("wiki"))
+        return self._parse(parse_wiki, "wiki/%s" % name)
+
+    def get_remote_tree(self, prefixes):
+        """Returns the nodes of the hash tree of the remote wikis by prefix,
+        served by the WikiSync plugin of the remote server, see
+        wikisync.tree.compare_tree()."""
+        f = self.open("wikisync/tree", {"prefix": list(prefixes)}, "GET")
+        try:
+            with METRICS.timed("parse"):
+                return json.load(f)
+        finally:
+            self._close(f)
+
+    def get_remote_versions(self, names, max_bytes=PROBE_MAX_BYTES):
+        """Returns a dict of the remote version of the wikis by name, read
+        from the remote 'RecentChanges' index in a single request. Wikis
+        missing from the index do not exist remotely and are mapped to None.
+        
+        The index is listed by date of change, reading stops as soon as the
+        versions of all the wikis are known, or after 'max_bytes' of the
+        index. The wikis whose version is still unknown are then left out
+        of the dict.
+        """
+        versions = dict.fromkeys(names)
+        pending = set(versions)
+        f = self.open("wiki/RecentChanges")
+        source = _LimitedReader(f, max_bytes)
+        try:
+            with METRICS.timed("parse"):
+                self._read_versions(source, versions, pending)
+        finally:
+            self._close(f)
+        if source.truncated:
+            for name in pending:
+                versions.pop(name, None)
+        return versions
+
+    def _read_versions(self, f, versions, pending):
+        current = None
+        for record in iter_recent_changes(f, self.basepath("wiki")):
+            name = record["name"]
+            if name != current:
+                # the version links of a wiki are listed together
+                pending.discard(current)
+                if not pending:
+                    break
+                current = name
+            if name in versions and \
+                versions[name] < record["remote_version"]:
+                versions[name] = record["remote_version"]
         
-    def pull(self, name, version=None):
+    def pull(self, name, version=None, base=None):
+        """Returns the text of a remote wiki.
+        
+        @param version: the remote version to read, None for the latest.
+        @param base: optional (remote version, text) tuple of a former 
+            version, the text is transferred as a delta of that version
+            when the remote server runs WikiSync, see wikisync.delta.
+        """
+        if base:
+            from wikisync.delta import pull_delta
+            text = pull_delta(self, name, version, base)
+            if text is not None:
+                return text
         data = { "format":"txt" }
         if version:
             data["version"] = version
         f = self.open("wiki/%s" % name, data, "GET")
-        return safe_unicode(f.read())
+        try:
+            return safe_unicode(f.read())
+        finally:
+            self._close(f)
     
-    def push(self, name, text, comments=None):
-        data = { "action":"edit" }
-        params = parse_form_params(
-            self.open("wiki/%s" % name, data, "GET"), 
-            form_id="edit", 
-            exclude=("cancel", "preview", "diff", "merge")
-        )
+    def push(self, name, text, comments=None, version=None, base=None):
+        """Saves the wiki text to the remote server, returns a dict of the
+        'name' and the new 'remote_version'.
+        
+        If the current remote 'version' is known, the text is posted 
+        directly with the form token of the session and the fields of a
+        previously fetched edit form. The edit form of the wiki is only
+        fetched when the post is rejected, e.g. when the token has expired
+        or the remote wiki has changed since.
+        
+        @param version: the current remote version, 0 for a new wiki.
+        @param base: optional (remote version, text) tuple of a former 
+            version, see pull().
+        """
+        if base:
+            from wikisync.delta import push_delta
+            info = push_delta(self, name, text, comments, version, base)
+            if info:
+                return info
+        path = "wiki/%s" % name
+        self.authenticate()
+        token = self._form_token()
+        edit_fields = self._session.edit_fields
+        if version is not None and token and edit_fields:
+            params = dict(edit_fields)
+            params.update({
+                "__FORM_TOKEN": token,
+                "version": version,
+                "text": text,
+                "comment": self._format_comment(comments),
+            })
+            try:
+                info = self._parse(parse_wiki, path, params, "POST")
+                if info and info[0]["remote_version"] > int(version):
+                    return info[0]
+            except urllib2.HTTPError, e:
+                # an invalid form token is rejected as a bad request
+                if e.code != 400:
+                    raise e
+            if self.log:
+                self.log.debug("Post of wiki '%s' version %s rejected, "
+                    "reading the edit form" % (name, version))
+        f = self.open(path, { "action":"edit" }, "GET")
+        try:
+            with METRICS.timed("parse"):
+                params = parse_form_params(f, form_id="edit", 
+                    exclude=("cancel", "preview", "diff", "merge"))
+        finally:
+            self._close(f)
         if not params:
             raise RuntimeError("Cannot parse form parameters from '%s'" % \
                 self.url(path))
+        edit_fields.update([(k, v) for k, v in params.items()
+            if k not in _EDIT_PAGE_FIELDS])
         params["text"] = text
         params["comment"] = self._format_comment(comments)
-        info = parse_wiki(
-            self.open("wiki/%s" % name, params, "POST"),
-            self.basepath("wiki")
-        )
+        info = self._parse(parse_wiki, path, params, "POST")
         if not info:
             raise RuntimeError("Unable to post data to remote server")
         return info[0]
+
+    def _form_token(self):
+        """Returns the form token of the session, as set by the remote 
+        server in the 'trac_form_token' cookie"""
+        for cookie in self._session.cookie_jar:
+            if cookie.name == "trac_form_token":
+                return cookie.value
+        return None
+    
+    def get_remote_attachments(self, name):
+        """Returns an array of dict of the 'filename', 'size' and 'time'
+        of the remote attachments of a wiki, see parse_attachments()."""
+        try:
+            f = self.open("attachment/wiki/%s/" % name)
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return []
+            raise e
+        try:
+            with METRICS.timed("parse"):
+                return parse_attachments(f, 
+                    self.basepath("raw-attachment/wiki/%s" % name))
+        finally:
+            self._close(f)
+
+    def download_attachment(self, name, filename, target):
+        """Copies a remote attachment to the 'target' file like object,
+        without buffering the whole content in memory. Returns a (size, 
+        hex digest) tuple, see file_digest()."""
+        f = self.open("raw-attachment/wiki/%s/%s" % (name, filename),
+            headers={"Cache-Control": "no-store"})
+        try:
+            return file_digest(f, target)
+        finally:
+            self._close(f)
+
+    def upload_attachment(self, name, filename, path, description=None):
+        """Uploads the file at 'path' as an attachment of a wiki, replacing
+        the existing attachment. The file is streamed from disk."""
+        path_info = "attachment/wiki/%s/" % name
+        f = self.open(path_info, { "action":"new" }, "GET")
+        try:
+            with METRICS.timed("parse"):
+                params = parse_form_params(f, form_id="attachment", 
+                    exclude=("cancel", "attachment"))
+        finally:
+            self._close(f)
+        if not params:
+            raise RuntimeError("Cannot parse form parameters from '%s'" % \
+                self.url(path_info))
+        params["replace"] = "on"
+        params["description"] = description or ""
+        body = MultipartStream(params, [("attachment", filename, path)])
+        try:
+            f = self.open(path_info, body, "POST", {
+                "Content-Type": body.content_type,
+                "Content-Length": str(len(body)),
+            })
+            self._close(f)
+        finally:
+            body.close()
+
+    def _parse(self, parser, path, data=None, method="GET"):
+        f = self.open(path, data, method)
+        try:
+            with METRICS.timed("parse"):
+                return parser(f, self.basepath("wiki"))
+        finally:
+            self._close(f)
+    
+    def _close(self, f):
+        """Closes a response, logging the bytes transferred"""
+        f.close()
+        transfer = getattr(f, "transfer", None)
+        if transfer:
+            METRICS.count("bytes_received", transfer.received)
+            METRICS.count("bytes_decoded", transfer.decoded)
+        if self.log and transfer:
+            self.log.debug("Read %s: %s bytes received, %s bytes decoded%s" % \
+                (transfer.url, transfer.received, transfer.decoded,
+                 transfer.encoding and " (%s)" % transfer.encoding or ""))
     
     def _format_comment(self, comments=""):
         from wikisync.plugin import DEFAULT_SIGNATURE